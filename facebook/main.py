@@ -1,18 +1,36 @@
 # https://blog.tati.digital/2021/03/29/automating-instagram-posts-with-python-and-instagram-graph-api/
 
-import requests
 from decouple import config
 import logging
 import json
 from pymongo import MongoClient
-import random
-import time
+import os
+import sys
+
+# The modules shared by all the bots live in ../utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+from enums import Platform
+from selection import mediaUrl
+from claims import fieldClaims
+from strategies import pickMediaObject
+from cooldown import loadEvaluator
+from accounts import defaultAccount
+from captions import CaptionTemplate, allTags, mediaTags, randomTags
+from fitting import fitCaption
+from http_client import client
 
 from templates import (
   single_image_template,
   multiple_image_template
 )
 
+single_image = CaptionTemplate(single_image_template)
+multiple_image = CaptionTemplate(multiple_image_template)
+
+# set by a long running process (scheduler.py) to select from memory, see utils/catalog.py
+catalog = None
+
 #================================================================
 # Caption Formatters
 
@@ -21,14 +39,18 @@ from templates import (
 def buildSingleImageText(mediaObject):
   try:
     url = mediaObject['projectURL'] if mediaObject['projectURL'] else config('DEFAULT_URL', cast=str)
-    random.shuffle(mediaObject['tagList'])
-    tags = ' '.join(['#' + tag for tag in mediaObject['tagList'][:5]])
-
-    text = single_image_template.format(
-      title=mediaObject['projectName'],
+    # trimmed to fit the platform's limits, see utils/fitting.py
+    text = fitCaption(
+      platform=Platform.FACEBOOK,
+      render=lambda body, tags: single_image.render(
+        title=mediaObject['projectName'],
+        body=body,
+        url=url,
+        tags=tags,
+      ),
       body=f"{ mediaObject['name'] } - { mediaObject['description'] }",
-      url=url,
-      tags=tags,
+      # 5 random '#'-prefixed tags, see utils/captions.py
+      tags=randomTags(mediaTags(mediaObject), 5)
     )
     return text
 
@@ -38,21 +60,21 @@ def buildSingleImageText(mediaObject):
 
 def buildMultiImageText(mediaObjects):
   try:
-    body = ""
-    tagList = []
-
-    for i, mediaObject in enumerate(mediaObjects):
-      body += f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n"
-      tagList += mediaObject['tagList']
-
-    tagList = list(set(tagList))
-    random.shuffle(tagList)
-    tags = ' '.join(['#' + tag for tag in tagList[:5]])
-
-    text = multiple_image_template.format(
-      title=mediaObjects[0]['projectName'],
+    body = ''.join([
+      f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n"
+      for i, mediaObject in enumerate(mediaObjects)
+    ])
+
+    text = fitCaption(
+      platform=Platform.FACEBOOK,
+      render=lambda body, tags: multiple_image.render(
+        title=mediaObjects[0]['projectName'],
+        body=body,
+        tags=tags
+      ),
       body=body,
-      tags=tags
+      # 5 random tags from all the mediaObjects
+      tags=randomTags(allTags(mediaObjects), 5)
     )
     return text
 
@@ -61,34 +83,6 @@ def buildMultiImageText(mediaObjects):
     return None
 
 
-#================================================================
-
-def getRandomMediaObject(max_tries=5, post_type=None):
-
-  try:
-    tries = 0
-    candidates = list(mongo_db['media'].find({'type':'image'}))
-    mediaObject = None
-
-    while not mediaObject:
-
-      candidate = random.choice(candidates)
-
-      if time.time() - candidate['lastFBPost'] > (config('POST_COOL_DOWN', cast=float, default=7.0) * 86400):
-        mediaObject = candidate
-
-      tries+=1
-      if tries >= max_tries:
-        break
-
-    logging.info(f"getRandomMediaObject() - tries: {tries} | mediaObject ID: {str(mediaObject['_id'])}, filename: {repr(mediaObject['filename'])}")
-
-  except Exception as e:
-    logging.error(f'getRandomMediaObject: {repr(e)}')
-
-  finally:
-    return mediaObject
-
 #================================================================
 # Upload A Photo
 # https://developers.facebook.com/docs/graph-api/reference/page/photos/
@@ -104,19 +98,57 @@ def uploadSinglePhoto(image_url=None, caption=None, fb_page_id=None, access_toke
     if caption:
       params.update({ 'caption': caption })
 
-    if not (response := requests.post(
+    if not (response := client.post(
       url=f"https://{ config('BASE_URL',cast=str) }/{ config('GRAPH_API_VERSION',cast=str) }/{ fb_page_id }/photos",
       params=params
     )).status_code == 200:
 
-      logging.info(f"response: {response.text}")
-        # raise Exception(f'No response from FB!')
+      # a Graph API error like {"error": {...}} isn't a post
+      logging.warning(f"uploadSinglePhoto() - { response.status_code }: { response.text }")
+      return None
 
     return response.json()
 
   except Exception as e:
     logging.error(f'uploadSinglePhoto(): {repr(e)}')
 
+#================================================================
+# RUN
+# A single posting job. Used by __main__ and by the scheduler in ../scheduler.py
+# Posts to the given AccountProfile, or to the page configured in .env
+
+def run(account=None, progress=None, job_key=None):
+  # progress and job_key are accepted for the job queue (see utils/jobs.py), a photo post has no steps to report or resume
+  account = account or defaultAccount(Platform.FACEBOOK)
+  access_token = account.credentials['PAGE_ACCESS_TOKEN']
+  fb_page_id = account.credentials['FACEBOOK_PAGE_ID']
+  # the cool downs for selecting and claiming, read once for the run
+  evaluator = loadEvaluator()
+
+  if not (mediaObject := pickMediaObject(mongo_db, Platform.FACEBOOK, account.lastPostField, evaluator, catalog)):
+    raise Exception('Failed to retrieve a mediaObject to post')
+
+  if not (text := buildSingleImageText(mediaObject)):
+    raise Exception("buildSingleImageText() returned an empty string")
+
+  # reserve it so no other worker posts it at the same time, it's released if the post fails
+  with fieldClaims(mongo_db, account.lastPostField, evaluator) as claims:
+    if not claims.claim(mediaObject):
+      raise Exception('mediaObject was claimed by another worker')
+
+    if not (result := uploadSinglePhoto(
+      image_url=mediaUrl(mediaObject, Platform.FACEBOOK),
+      caption=text,
+      fb_page_id=fb_page_id,
+      access_token=access_token
+    )) or not result.get('id'):
+      # raised so the claim is released and a queued job isn't marked published
+      raise Exception(f'Failed to create a photo post: { result }')
+
+    # set the lastFBPost (or per account) time
+    claims.commit([mediaObject])
+    return result
+
 #================================================================
 # MAIN
 
@@ -142,22 +174,9 @@ if __name__ == "__main__":
     # This will be used to interface with the collections within the database
     mongo_db = mongo_client[config('MONGO_DB')]
 
-    access_token = config('PAGE_ACCESS_TOKEN')
-    fb_page_id = config('FACEBOOK_PAGE_ID',cast=str)
-
-    if not (mediaObject := getRandomMediaObject()):
-      raise Exception('Failed to retrieve a mediaObject to post')
-
-    if not (text := buildSingleImageText(mediaObject)):
-      raise Exception("buildSingleImageText() returned an empty string")
+    run()
 
-    if not (result := uploadSinglePhoto(
-      image_url=mediaObject['url'],
-      caption=text,
-      fb_page_id=fb_page_id,
-      access_token=access_token
-    )):
-      raise Exception('Failed to create a photo post')
+    logging.debug(f'HTTP latency: { client.latencyStats() }')
 
   except Exception as e:
     logging.error(f'__main__(): {repr(e)}')
@@ -0,0 +1,45 @@
+# Posts once for every enabled account profile, all accounts in parallel.
+# Profiles are read from the accounts collection, or from the JSON file at
+# ACCOUNTS_PATH if it is set. See utils/accounts.py and AccountProfile in
+# utils/models.py.
+
+import logging
+import os
+import sys
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# The modules shared by all the bots live in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from bots import runAccounts
+from db import getMongoDatabase
+from http_client import client
+
+#================================================================
+# MAIN
+
+if __name__ == '__main__':
+  try:
+
+    logging.basicConfig(
+      level=config('LOG_LEVEL', default=20, cast=int),
+      format='[Fan Out] - %(levelname)s | %(threadName)s | %(message)s'
+    )
+
+    results = runAccounts(
+      mongo_db=getMongoDatabase(),
+      bots={},
+      path=config('ACCOUNTS_PATH', default=None),
+      workers=config('FANOUT_WORKERS', cast=int, default=8)
+    )
+    logging.info(f'results: { results }')
+
+    logging.debug(f'HTTP latency: { client.latencyStats() }')
+
+  except Exception as e:
+    logging.error(f'__main__(): {repr(e)}')
+  finally:
+    exit()
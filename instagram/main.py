@@ -1,18 +1,44 @@
 # https://blog.tati.digital/2021/03/29/automating-instagram-posts-with-python-and-instagram-graph-api/
 
-import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from decouple import config
 import logging
 import json
 from pymongo import MongoClient
 import random
 import time
+import os
+import sys
+
+# The modules shared by all the bots live in ../utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+from enums import JobState, Platform
+from selection import MEDIA_PROJECTION, mediaUrl
+from publish_state import clearPublishState, loadPublishState, savePublishState
+from claims import fieldClaims
+from cooldown import loadEvaluator
+from groups import eligibleGroupMembers
+from strategies import pickMediaObject
+from accounts import defaultAccount
+from captions import CaptionTemplate, allTags, mediaTags
+from fitting import fitCaption
+from http_client import client
 
 from templates import (
   single_caption_template,
   carousel_caption_template
 )
 
+single_caption = CaptionTemplate(single_caption_template)
+carousel_caption = CaptionTemplate(carousel_caption_template)
+
+# maximum number of carousel child containers created at the same time
+CONTAINER_WORKERS = config('CONTAINER_WORKERS', cast=int, default=4)
+
+# set by a long running process (scheduler.py) to select from memory, see utils/catalog.py
+catalog = None
+
 #================================================================
 # Caption Formatters
 
@@ -22,14 +48,18 @@ def buildSingleCaption(mediaObject):
     #randomly choose from the available captions
     body = random.choice(mediaObject['captionList'])
 
-    # prepend '#' and join tags into a single string
-    tags = ' '.join(['#' + tag for tag in mediaObject['tagList']])
-
-    caption = single_caption_template.format(
-      title=mediaObject['projectName'],
-      subtitle=f"{mediaObject['name']} - {mediaObject['description']}",
+    # trimmed to Instagram's caption and hashtag limits, see utils/fitting.py
+    caption = fitCaption(
+      platform=Platform.INSTAGRAM,
+      render=lambda body, tags: single_caption.render(
+        title=mediaObject['projectName'],
+        subtitle=f"{mediaObject['name']} - {mediaObject['description']}",
+        body=body,
+        tags=tags,
+      ),
       body=body,
-      tags=tags,
+      # '#'-prefixed tags, see utils/captions.py
+      tags=mediaTags(mediaObject)
     )
 
     logging.debug(f'buildSingleCaption caption: {repr(caption)}')
@@ -42,22 +72,21 @@ def buildSingleCaption(mediaObject):
 def buildCarouselCaption(mediaObjects):
   #build the caption
   try:
-    body = ""
-    tagList = []
-
-    for i, mediaObject in enumerate(mediaObjects):
-      body += f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n\n"
-      tagList += mediaObject['tagList']
-
-    body += f"{random.choice(mediaObjects[0]['captionList'])}\n\n"
-
-    tagList = list(set(tagList))
-    tags = ' '.join(['#' + tag for tag in tagList])
-
-    caption = carousel_caption_template.format(
-      title=mediaObjects[0]['projectName'],
+    body = ''.join([
+      f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n\n"
+      for i, mediaObject in enumerate(mediaObjects)
+    ] + [f"{random.choice(mediaObjects[0]['captionList'])}\n\n"])
+
+    caption = fitCaption(
+      platform=Platform.INSTAGRAM,
+      render=lambda body, tags: carousel_caption.render(
+        title=mediaObjects[0]['projectName'],
+        body=body,
+        tags=tags,
+      ),
       body=body,
-      tags=tags,
+      # the tags of all the mediaObjects without duplicates
+      tags=allTags(mediaObjects)
     )
 
     return caption
@@ -66,35 +95,6 @@ def buildCarouselCaption(mediaObjects):
     logging.error(f'buildCarouselCaption: {repr(e)}')
     return None
 
-#================================================================
-# Get Random Media Object
-
-def getRandomMediaObject(max_tries=5, post_type=None):
-
-  try:
-    tries = 0
-    mediaObject = None
-    candidates = list(mongo_db['media'].find({'type':'image'}))
-    
-    while not mediaObject:
-      candidate = random.choice(candidates)
-
-      lastIGPost = candidate['lastIGPost'] if 'lastIGPost' in candidate else 0
-      if time.time() - lastIGPost > (config('POST_COOL_DOWN', cast=float, default=7.0) * 86400):
-        mediaObject = candidate
-
-      tries+=1
-      if tries >= max_tries:
-        break
-
-    logging.info(f"getRandomMediaObject() - tries: {tries} | mediaObject ID: {str(mediaObject['_id'])}, filename: {repr(mediaObject['filename'])}")
-
-  except Exception as e:
-    logging.error(f'getRandomMediaObject: {repr(e)}')
-
-  finally:
-    return mediaObject
-
 #================================================================
 # createImageContainer
 
@@ -111,7 +111,9 @@ def createImageContainer(image_url=None, caption=None, ig_user_id=None, access_t
     if caption:
       params.update({ 'caption': caption })
 
-    response = requests.post(
+    # retrying is safe here, a duplicate container is never published
+    response = client.post(
+      idempotent=True,
       url=f"https://{ config('BASE_URL',cast=str) }/{ config('GRAPH_API_VERSION',cast=str) }/{ ig_user_id }/media",
       params=params
     )
@@ -135,7 +137,9 @@ def createCarouselContainer(children=None, caption=None, ig_user_id=None, access
   creation_id = None
 
   try:
-    response = requests.post(
+    # retrying is safe here, a duplicate container is never published
+    response = client.post(
+      idempotent=True,
       url=f"https://{ config('BASE_URL',cast=str) }/{ config('GRAPH_API_VERSION',cast=str) }/{ ig_user_id }/media",
       params = {
         'media_type': 'CAROUSEL',
@@ -157,12 +161,102 @@ def createCarouselContainer(children=None, caption=None, ig_user_id=None, access
   finally:
     return creation_id
 
+#================================================================
+# Container Status
+# ref: https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-container
+
+def getContainerStatuses(container_ids=None, access_token=None):
+  # fetches the status_code of many containers in one request using the ids parameter
+  response = client.get(
+    url=f"https://{ config('BASE_URL',cast=str) }/{ config('GRAPH_API_VERSION',cast=str) }/",
+    params={
+      'ids': ','.join(container_ids),
+      'fields': 'status_code',
+      'access_token': access_token
+    }
+  )
+
+  if response.status_code != 200:
+    raise Exception(f'status code: { response.status_code } - { response.text }')
+
+  return { container_id: result.get('status_code') for container_id, result in response.json().items() }
+
+def waitForContainers(container_ids=None, access_token=None, timeout=60.0):
+  # Polls until no container is IN_PROGRESS, backing off between polls.
+  # Returns the last known status of each container.
+  statuses = {}
+  delay = 1.0
+  deadline = time.time() + timeout
+
+  try:
+    while True:
+      statuses = getContainerStatuses(container_ids, access_token)
+      logging.debug(f'waitForContainers() - statuses: { statuses }')
+
+      if not [status for status in statuses.values() if status == 'IN_PROGRESS'] or time.time() + delay > deadline:
+        break
+
+      time.sleep(delay)
+      delay = min(delay * 2, 16.0)
+
+  except Exception as e:
+    logging.error(f'waitForContainers(): { repr(e) }')
+
+  finally:
+    return statuses
+
+#================================================================
+# createChildContainers
+
+def createChildContainers(mediaObjects=None, max_children=10, ig_user_id=None, access_token=None):
+  # Creates carousel item containers in parallel, in order of preference.
+  # No more containers are started than are still needed to reach max_children.
+  # Returns (mediaObject, container_id) pairs in the order the mediaObjects were given.
+  created = []
+  queue = iter(enumerate(mediaObjects))
+
+  with ThreadPoolExecutor(max_workers=CONTAINER_WORKERS) as executor:
+    in_flight = {}
+
+    while True:
+      while len(in_flight) < min(CONTAINER_WORKERS, max_children - len(created)):
+        if not (item := next(queue, None)):
+          break
+        # create the image container, with a caption incase we have to fall back to a single post
+        in_flight[executor.submit(
+          createImageContainer,
+          image_url=mediaUrl(item[1], Platform.INSTAGRAM),
+          ig_user_id=ig_user_id,
+          access_token=access_token,
+          caption=buildSingleCaption(item[1]),
+          is_carousel_item=True
+        )] = item
+
+      if not in_flight:
+        break
+
+      done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+      for future in done:
+        index, mediaObject = in_flight.pop(future)
+        if (image_container_id := future.result()):
+          created.append((index, mediaObject, image_container_id))
+
+  if len(created) >= max_children:
+    logging.debug('Reached maximum number of children for carousel post.')
+
+  created.sort(key=lambda item: item[0])
+  return [(mediaObject, image_container_id) for _, mediaObject, image_container_id in created]
+
+#================================================================
+# publishMediaPost
+
 def publishMediaPost(container_id, ig_user_id, access_token):
   creation_id = None
 
   try:
     #Publish the post
-    response = requests.post(
+    response = client.post(
       url=f"https://{config('BASE_URL',cast=str)}/{config('GRAPH_API_VERSION',cast=str)}/{ig_user_id}/media_publish",
       params = {
         'creation_id': container_id,
@@ -185,13 +279,16 @@ def publishMediaPost(container_id, ig_user_id, access_token):
 #================================================================
 # SINGLE POST
 
-def automatedSinglePost(mediaObject=None, ig_user_id=None, access_token=None):
+def automatedSinglePost(mediaObject=None, ig_user_id=None, access_token=None, claims=None, progress=None, state_key=None):
+  # claims holds mediaObject for this post, see utils/claims.py
+  # progress is set when run from the job queue, see utils/jobs.py
+  # state_key saves the container so a failed publish can be resumed, see publishContainers
   logging.info(f"automatedSinglePost() - mediaObject ID: {str(mediaObject['_id'])}, filename: {repr(mediaObject['filename'])}")
   try:
 
     # create the image container
     if not (image_container_id := createImageContainer(
-      image_url=mediaObject['url'],
+      image_url=mediaUrl(mediaObject, Platform.INSTAGRAM),
       ig_user_id=ig_user_id,
       caption=buildSingleCaption(mediaObject),
       access_token=access_token
@@ -199,19 +296,13 @@ def automatedSinglePost(mediaObject=None, ig_user_id=None, access_token=None):
       # if unsuccessful, raise and exception to pop out of the try block and log it
       raise Exception('failed to create image container')
 
-    mongo_db['media'].update_one(
-      { 'filename': mediaObject['filename'] },
-      { '$set': { 'lastIGPost': time.time() } }
-    )
+    if (status := waitForContainers([image_container_id], access_token).get(image_container_id)) != 'FINISHED':
+      raise Exception(f'image container not ready: { status }')
 
-    if not (publish_id := publishMediaPost(
-      container_id=image_container_id,
-      ig_user_id=ig_user_id,
-      access_token=access_token
-    )):
-      raise Exception('failed to publish single post')
+    if progress:
+      progress(JobState.CONTAINER_READY, containerIds=[image_container_id])
 
-    return publish_id
+    return publishContainers([(mediaObject, image_container_id)], ig_user_id, access_token, claims, state_key)
 
   except Exception as e:
     logging.error(f'automatedSinglePost: {repr(e)}')
@@ -220,25 +311,35 @@ def automatedSinglePost(mediaObject=None, ig_user_id=None, access_token=None):
 #================================================================
 # CAROUSEL POST
 
-def automatedCarouselPost(mediaObject=None, ig_user_id=None, access_token=None):
+def automatedCarouselPost(mediaObject=None, ig_user_id=None, access_token=None, claims=None, progress=None, state_key=None, evaluator=None):
+  # claims holds mediaObject for this post, the rest of the group is claimed here, see utils/claims.py
+  # progress is set when run from the job queue, see utils/jobs.py
+  # state_key saves the containers so a failed publish can be resumed, see publishContainers
+  # evaluator holds the run's cool downs, see utils/cooldown.py
   logging.info(f"automatedCarouselPost() - mediaObject ID: {str(mediaObject['_id'])}, filename: {repr(mediaObject['filename'])}")
 
   try:
     #select a group at random from groupList
     group = random.choice(mediaObject['groupList'])
 
-    #find all other members of the group
-    groupMembers = mongo_db['media'].find({'groupList' : {'$eq': group}})
+    max_children = random.randrange(
+      config('CAROUSEL_RANGE_MIN', cast=int, default=2),
+      config('CAROUSEL_RANGE_MAX', cast=int, default=11)
+    )
 
-    #build a list of mediaObjects
-    logging.debug(f'Looking for mediaObjects in group: {group}, groupMembers: {groupMembers}')
-    mediaObjectsToPublish = []
-    for candidate in groupMembers:
-      # check that the last post was not sooner than the cool down duration
-      coolDownCheck = time.time() - candidate['lastIGPost'] > (config('POST_COOL_DOWN', cast=float, default=7.0) * 86400)
-      # if it passes the cool down check and is not the mediaObject add it to the list
-      if candidate['filename'] != mediaObject['filename'] and coolDownCheck:
-        mediaObjectsToPublish.append(candidate)
+    # a random sample of the other members of the group that have cooled down, see utils/groups.py
+    # with spares in case some of the containers fail
+    mediaObjectsToPublish = claims.claimAll(eligibleGroupMembers(
+      mongo_db=mongo_db,
+      group=group,
+      exclude=[mediaObject['filename']],
+      field=claims.fields[0],
+      evaluator=evaluator or loadEvaluator(),
+      k=2 * max_children,
+      catalog=catalog,
+      platform=Platform.INSTAGRAM
+    ))
+    logging.debug(f'Looking for candidates in group: { group }, found: { len(mediaObjectsToPublish) }')
 
     # if the list of mediaObjects is empty, create a single post using the mediaObject
     if len(mediaObjectsToPublish) == 0:
@@ -246,86 +347,183 @@ def automatedCarouselPost(mediaObject=None, ig_user_id=None, access_token=None):
       if not (publish_id := automatedSinglePost(
         mediaObject=mediaObject,
         ig_user_id=ig_user_id,
-        access_token=access_token
+        access_token=access_token,
+        claims=claims,
+        progress=progress,
+        state_key=state_key
       )):
         raise Exception('Fall back to single post failed.')
       return publish_id
 
-    # mix them all up
-    random.shuffle(mediaObjectsToPublish)
     # put the mediaObject first
     mediaObjectsToPublish.insert(0, mediaObject)
 
-    # build the children image_containers and save them in a list
-    publishedMediaObjects = []
-    children = []
-
-    max_children = random.randrange(
-      config('CAROUSEL_RANGE_MIN', cast=int, default=2),
-      config('CAROUSEL_RANGE_MAX', cast=int, default=11)
+    # build the children image_containers in parallel
+    created = createChildContainers(
+      mediaObjects=mediaObjectsToPublish,
+      max_children=max_children,
+      ig_user_id=ig_user_id,
+      access_token=access_token
     )
 
-    for mediaObject in mediaObjectsToPublish:
+    # wait for all of them to finish processing before publishing
+    statuses = waitForContainers(
+      container_ids=[image_container_id for _, image_container_id in created],
+      access_token=access_token
+    ) if created else {}
 
-      # stop once we've reached the max
-      if len(children) >= max_children:
-        logging.debug('Reached maximum number of children for carousel post.')
-        break
+    # keep the children that are ready
+    children = [(mediaObject, image_container_id) for mediaObject, image_container_id in created if statuses.get(image_container_id) == 'FINISHED']
 
-      # create the image container, with a caption incase we have to fall back to a single post
-      if (image_container_id := createImageContainer(
-        image_url=mediaObject['url'],
-        ig_user_id=ig_user_id,
-        access_token=access_token,
-        caption=buildSingleCaption(mediaObject),
-        is_carousel_item=True
-      )):
-        # set the lastIGPost time to the current time
-        mongo_db['media'].update_one(
-          { 'filename' : mediaObject['filename'] },
-          { '$set': { 'lastIGPost': time.time() } }
-        )
-        children.append(image_container_id)
-        publishedMediaObjects.append(mediaObject)
+    for mediaObject, image_container_id in created:
+      if statuses.get(image_container_id) != 'FINISHED':
+        logging.warning(f"automatedCarouselPost() - container { image_container_id } for { repr(mediaObject['filename']) } not ready: { statuses.get(image_container_id) }")
 
     if not children:
       raise Exception('Carousel has no children!')
-    elif len(children) == 1:
-      logging.debug(f"automatedCarouselPost() - Carousel only has one child. Publishing that child")
-      if not (publish_id := publishMediaPost(
-        container_id=children[0],
+
+    if progress:
+      progress(JobState.CONTAINER_READY, containerIds=[image_container_id for _, image_container_id in children])
+
+    return publishContainers(children, ig_user_id, access_token, claims, state_key)
+
+  except Exception as e:
+    logging.error(f'automatedCarouselPost: {repr(e)}')
+    return None
+
+#================================================================
+# PUBLISH AND RESUME
+
+def publishContainers(children=None, ig_user_id=None, access_token=None, claims=None, state_key=None, carousel_container_id=None, resuming=False):
+  # Publishes (mediaObject, container_id) pairs that have FINISHED processing:
+  # a single child on its own, more than one as a carousel.
+  # With a state_key each step is saved first, so if publishing fails the next
+  # run can pick up from there with resumePost instead of creating everything again.
+  # Raises an exception if anything fails.
+  if state_key:
+    savePublishState(
+      mongo_db,
+      state_key,
+      # new containers start their own 24 hours and resumes
+      fresh=not resuming,
+      children=[{ 'filename': mediaObject['filename'], 'containerId': container_id } for mediaObject, container_id in children],
+      carouselId=carousel_container_id
+    )
+
+  mediaObjects = [mediaObject for mediaObject, _ in children]
+
+  if len(children) == 1:
+    logging.debug(f"publishContainers() - Only one child. Publishing that child")
+    container_id = children[0][1]
+
+  else:
+    if not carousel_container_id:
+      if not (carousel_caption := buildCarouselCaption(
+        mediaObjects=mediaObjects
+      )):
+        raise Exception('buildCarouselCaption failed')
+
+      if not (carousel_container_id := createCarouselContainer(
+        children=[container_id for _, container_id in children],
+        caption=carousel_caption,
         ig_user_id=ig_user_id,
-        access_token=access_token
+        access_token=access_token,
       )):
-        raise Exception('Fall back to single post failed.')
-      return publish_id
+        raise Exception('failed to create carousel container')
 
-    if not (carousel_caption := buildCarouselCaption(
-      mediaObjects=publishedMediaObjects
-    )):
-      raise Exception('buildCarouselCaption failed')
+      if state_key:
+        savePublishState(mongo_db, state_key, carouselId=carousel_container_id)
 
-    if not (carousel_container_id := createCarouselContainer(
-      children=children,
-      caption=carousel_caption,
-      ig_user_id=ig_user_id,
-      access_token=access_token,
-    )):
-      raise Exception('failed to create carousel container')
+    container_id = carousel_container_id
 
-    if not (publish_id := publishMediaPost(
-      container_id=carousel_container_id,
-      ig_user_id=ig_user_id,
-      access_token=access_token
-    )):
-      raise Exception('failed to publish carousel')
+  if not (publish_id := publishMediaPost(
+    container_id=container_id,
+    ig_user_id=ig_user_id,
+    access_token=access_token
+  )):
+    raise Exception('failed to publish')
+
+  # only now that it's published, set the lastIGPost (or per account) time of the
+  # children that made it into the post, the rest are released by run()
+  claims.commit(mediaObjects)
+
+  if state_key:
+    clearPublishState(mongo_db, state_key)
+
+  return publish_id
+
+def resumePost(state=None, ig_user_id=None, access_token=None, claims=None, progress=None):
+  # Publishes the containers saved by a post that failed, see utils/publish_state.py
+  # Containers that expired and mediaObjects another worker posted since are dropped.
+  logging.info(f"resumePost() - { state['_id'] }: { len(state['children']) } container(s), carousel: { state.get('carouselId') }")
 
-    return publish_id
+  try:
+    documents = {
+      document['filename']: document
+      for document in mongo_db['media'].find({ 'filename': { '$in': [child['filename'] for child in state['children']] } }, MEDIA_PROJECTION)
+    }
+    children = [(documents[child['filename']], child['containerId']) for child in state['children'] if child['filename'] in documents]
+
+    claimed = { mediaObject['filename'] for mediaObject in claims.claimAll([mediaObject for mediaObject, _ in children]) }
+    statuses = getContainerStatuses([container_id for _, container_id in children], access_token) if children else {}
+
+    if not (ready := [(mediaObject, container_id) for mediaObject, container_id in children if mediaObject['filename'] in claimed and statuses.get(container_id) == 'FINISHED']):
+      clearPublishState(mongo_db, state['_id'])
+      raise Exception('no containers left to resume')
+
+    if progress:
+      progress(JobState.CONTAINER_READY, containerIds=[container_id for _, container_id in ready])
+
+    return publishContainers(
+      children=ready,
+      ig_user_id=ig_user_id,
+      access_token=access_token,
+      claims=claims,
+      state_key=state['_id'],
+      # the carousel container only fits if every child is still there
+      carousel_container_id=state.get('carouselId') if len(ready) == len(state['children']) else None,
+      resuming=True
+    )
 
   except Exception as e:
-    logging.error(f'automatedCarouselPost: {repr(e)}')
+    logging.error(f'resumePost: {repr(e)}')
     return None
 
+#================================================================
+# RUN
+# A single posting job. Used by __main__ and by the scheduler in ../scheduler.py
+# Posts to the given AccountProfile, or to the account configured in .env
+
+def run(account=None, progress=None, job_key=None):
+  # job_key is set when run from the job queue, see utils/jobs.py
+  account = account or defaultAccount(Platform.INSTAGRAM)
+  access_token = account.credentials['SYSTEM_USER_TOKEN']
+  ig_user_id = account.credentials['INSTAGRAM_ACCOUNT_ID']
+  # jobs for the same account can run at once, each keeps its own state, see utils/publish_state.py
+  state_key = job_key or account.name
+  # the cool downs for selecting and claiming, read once for the run
+  evaluator = loadEvaluator()
+
+  # whatever is claimed but not committed is released at the end
+  with fieldClaims(mongo_db, account.lastPostField, evaluator) as claims:
+    # finish a post that failed before starting a new one. If resuming fails too the state is
+    # kept for the next try, until it expires or runs out of resumes, see utils/publish_state.py
+    if (state := loadPublishState(mongo_db, state_key)):
+      return resumePost(state, ig_user_id, access_token, claims, progress)
+
+    if not (mediaObject := pickMediaObject(mongo_db, Platform.INSTAGRAM, account.lastPostField, evaluator, catalog)):
+      return None
+
+    # reserve it so no other worker posts it at the same time
+    if not claims.claim(mediaObject):
+      return None
+
+    randPostType = random.random()
+    if randPostType < config('CAROUSEL_CHANCE_PERCENT', cast=int, default=20) * 0.01:
+      return automatedCarouselPost(mediaObject, ig_user_id, access_token, claims, progress, state_key, evaluator)
+
+    return automatedSinglePost(mediaObject, ig_user_id, access_token, claims, progress, state_key)
+
 #================================================================
 # MAIN
 
@@ -351,18 +549,9 @@ if __name__ == "__main__":
     # This will be used to interface with the collections within the database
     mongo_db = mongo_client[config('MONGO_DB')]
 
-    access_token = config('SYSTEM_USER_TOKEN',cast=str)
-    access_token_app = f"{config('APP_ID',cast=str)}|{config('APP_SECRET',cast=str)}"
-    ig_user_id = config('INSTAGRAM_ACCOUNT_ID',cast=str)
-
-    mediaObject = getRandomMediaObject()
+    run()
 
-    if mediaObject:
-      randPostType = random.random()
-      if randPostType < config('CAROUSEL_CHANCE_PERCENT', cast=int, default=20) * 0.01:
-        automatedCarouselPost(mediaObject, ig_user_id, access_token)
-      else:
-        automatedSinglePost(mediaObject, ig_user_id, access_token)
+    logging.debug(f'HTTP latency: { client.latencyStats() }')
 
   except Exception as e:
     logging.error(f'Unhandled exception in __main__(): {repr(e)}')
@@ -0,0 +1,63 @@
+# Prints the captions the bots would write for a sample of artworks, without
+# posting anything. Handy after editing a templates.py or the spreadsheet.
+
+import argparse
+import os
+import sys
+
+# The modules shared by all the bots live in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from bots import BOT_DIRECTORIES, loadBot
+from db import getMongoDatabase
+from enums import Platform
+from selection import MEDIA_PROJECTION
+
+# the single image caption builder of each bot
+CAPTION_BUILDERS = {
+  Platform.INSTAGRAM: 'buildSingleCaption',
+  Platform.FACEBOOK: 'buildSingleImageText',
+  Platform.X: 'buildSingleImageText'
+}
+
+#================================================================
+
+def previewCaptions(mediaObjects, bots):
+  # renders every bot's caption for every mediaObject in one batch
+  return [
+    (mediaObject, { platform: getattr(bot, CAPTION_BUILDERS[platform])(mediaObject) for platform, bot in bots.items() })
+    for mediaObject in mediaObjects
+  ]
+
+#================================================================
+# Executed while run as a script
+
+if __name__ == '__main__':
+
+  try:
+    parser = argparse.ArgumentParser(
+      prog='Preview Captions',
+      description='Prints the captions the bots would write for a random sample of media'
+    )
+    parser.add_argument('count', type=int, nargs='?', default=5)
+    parser.add_argument('--platform', choices=[platform.value for platform in BOT_DIRECTORIES], action='append')
+    args = parser.parse_args()
+
+    mongo_db = getMongoDatabase()
+    platforms = [Platform(platform) for platform in args.platform] if args.platform else list(BOT_DIRECTORIES)
+    bots = { platform: loadBot(platform, mongo_db) for platform in platforms }
+
+    mediaObjects = mongo_db['media'].aggregate([
+      { '$match': { 'type': 'image' } },
+      { '$sample': { 'size': args.count } },
+      { '$project': MEDIA_PROJECTION }
+    ])
+
+    for mediaObject, captions in previewCaptions(mediaObjects, bots):
+      for platform, caption in captions.items():
+        print(f"==== { mediaObject['filename'] } | { platform.value } ====\n{ caption }\n")
+
+  except Exception as e:
+    print(f"Oops! {repr(e)}")
+  finally:
+    exit()
@@ -0,0 +1,166 @@
+# Publishes one artwork to Instagram, Facebook and X at the same time.
+# The artwork is selected once (it must have cooled down on all three), each
+# platform's caption is built by that bot, the image is downloaded once into the
+# shared image cache for the X upload (Instagram and Facebook fetch it from the
+# url themselves), the three
+# posts are published concurrently and the lastXXPost fields of the platforms
+# that succeeded are written in a single update.
+
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# The modules shared by all the bots live in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from accounts import defaultAccount
+from bots import loadBot
+from claims import Claims
+from cooldown import loadEvaluator
+from db import getMongoDatabase
+from enums import Platform
+from http_client import client
+from image_cache import cache
+from selection import LAST_POST_FIELDS, getMediaEligibleEverywhere, mediaUrl
+
+PLATFORMS = (Platform.INSTAGRAM, Platform.FACEBOOK, Platform.X)
+
+#================================================================
+# One publish function per platform. Each returns the id of the new post or None
+
+def publishInstagram(bot, mediaObject, caption):
+  credentials = defaultAccount(Platform.INSTAGRAM).credentials
+
+  if not (container_id := bot.createImageContainer(
+    image_url=mediaUrl(mediaObject, Platform.INSTAGRAM),
+    caption=caption,
+    ig_user_id=credentials['INSTAGRAM_ACCOUNT_ID'],
+    access_token=credentials['SYSTEM_USER_TOKEN']
+  )):
+    return None
+
+  if bot.waitForContainers([container_id], credentials['SYSTEM_USER_TOKEN']).get(container_id) != 'FINISHED':
+    return None
+
+  return bot.publishMediaPost(
+    container_id=container_id,
+    ig_user_id=credentials['INSTAGRAM_ACCOUNT_ID'],
+    access_token=credentials['SYSTEM_USER_TOKEN']
+  )
+
+def publishFacebook(bot, mediaObject, caption):
+  credentials = defaultAccount(Platform.FACEBOOK).credentials
+
+  result = bot.uploadSinglePhoto(
+    image_url=mediaUrl(mediaObject, Platform.FACEBOOK),
+    caption=caption,
+    fb_page_id=credentials['FACEBOOK_PAGE_ID'],
+    access_token=credentials['PAGE_ACCESS_TOKEN']
+  )
+  return result.get('id') if result else None
+
+def publishX(bot, mediaObject, caption):
+  auth = bot.authFor(defaultAccount(Platform.X).credentials)
+
+  # streamed from the image cache by openMediaSource, see x/main.py
+  if not (upload_result := bot.upload_media_chunked(mediaObject=mediaObject, auth=auth)):
+    return None
+
+  result = bot.submit_post(
+    text=caption,
+    media={ 'media_ids': [upload_result['media_id_string']] },
+    auth=auth
+  )
+  return result['data']['id'] if result else None
+
+#================================================================
+
+def publishEverywhere(mongo_db, bots, catalog=None):
+  # with a Catalog (see utils/catalog.py) the cool downs of all the platforms are checked in memory
+  # POST_COOL_DOWN, <PLATFORM>_POST_COOL_DOWN and GROUP_COOL_DOWNS, see utils/cooldown.py
+  evaluator = loadEvaluator()
+  cool_down_days = { platform: evaluator.fieldDays(LAST_POST_FIELDS[platform]) for platform in PLATFORMS }
+
+  if not (mediaObject := catalog.sampleEverywhere(PLATFORMS, evaluator) if catalog else getMediaEligibleEverywhere(
+    mongo_db=mongo_db,
+    platforms=PLATFORMS,
+    cool_down_days=cool_down_days,
+    group_days=evaluator.group_days
+  )):
+    return None
+
+  logging.info(f"publishEverywhere() - mediaObject ID: { str(mediaObject['_id']) }, filename: { repr(mediaObject['filename']) }")
+
+  # reserve it on every platform so no other worker posts it at the same time, see utils/claims.py
+  with Claims(
+    mongo_db,
+    [LAST_POST_FIELDS[platform] for platform in PLATFORMS],
+    { LAST_POST_FIELDS[platform]: days for platform, days in cool_down_days.items() },
+    group_days=evaluator.group_days
+  ) as claims:
+    if not claims.claim(mediaObject):
+      return None
+
+    captions = {
+      Platform.INSTAGRAM: bots[Platform.INSTAGRAM].buildSingleCaption(mediaObject),
+      Platform.FACEBOOK: bots[Platform.FACEBOOK].buildSingleImageText(mediaObject),
+      Platform.X: bots[Platform.X].buildSingleImageText(mediaObject)
+    }
+
+    if (missing := [platform.value for platform, caption in captions.items() if not caption]):
+      raise Exception(f'Failed to build captions for { missing }')
+
+    # download the image into the shared cache (see utils/image_cache.py) before posting anywhere,
+    # only the X upload needs it and reads it from there
+    if bots[Platform.X].IMAGE_CACHE:
+      cache.fetch(mediaUrl(mediaObject, Platform.X))
+
+    with ThreadPoolExecutor(max_workers=len(PLATFORMS)) as executor:
+      futures = {
+        Platform.INSTAGRAM: executor.submit(publishInstagram, bots[Platform.INSTAGRAM], mediaObject, captions[Platform.INSTAGRAM]),
+        Platform.FACEBOOK: executor.submit(publishFacebook, bots[Platform.FACEBOOK], mediaObject, captions[Platform.FACEBOOK]),
+        Platform.X: executor.submit(publishX, bots[Platform.X], mediaObject, captions[Platform.X])
+      }
+
+    results = {}
+    for platform, future in futures.items():
+      try:
+        results[platform] = future.result()
+      except Exception as e:
+        logging.error(f"publishEverywhere() - { platform.value }: { repr(e) }")
+        results[platform] = None
+
+    # one write for every platform that published, the other leases are released
+    claims.commit([mediaObject], fields=[LAST_POST_FIELDS[platform] for platform, post_id in results.items() if post_id])
+
+  logging.info(f"publishEverywhere() - results: { { platform.value: post_id for platform, post_id in results.items() } }")
+  return results
+
+def loadBots(mongo_db):
+  return { platform: loadBot(platform, mongo_db) for platform in PLATFORMS }
+
+#================================================================
+# MAIN
+
+if __name__ == '__main__':
+  try:
+
+    logging.basicConfig(
+      level=config('LOG_LEVEL', default=20, cast=int),
+      format='[Publish] - %(levelname)s | %(threadName)s | %(message)s'
+    )
+
+    mongo_db = getMongoDatabase()
+    publishEverywhere(mongo_db, loadBots(mongo_db))
+
+    logging.debug(f'HTTP latency: { client.latencyStats() }')
+
+  except Exception as e:
+    logging.error(f'__main__(): {repr(e)}')
+  finally:
+    exit()
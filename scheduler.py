@@ -0,0 +1,165 @@
+# Runs the Instagram, Facebook and X bots from one long running process.
+# Instead of cron starting a fresh process (imports, .env, Mongo authentication)
+# for every post, the scheduler does that once and then runs each bot's posting
+# job on its own cadence in one asyncio event loop.
+#
+# NOTE: python-decouple reads a single .env, the first one it finds from this
+# directory upwards, so the scheduler needs one .env here holding the settings
+# of every bot it runs.
+
+import asyncio
+import logging
+import os
+import random
+import signal
+import sys
+import time
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# The modules shared by all the bots live in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from bots import BOT_DIRECTORIES, loadBot, runAccounts
+from catalog import Catalog
+from db import getMongoDatabase
+from enums import Platform
+from http_client import client
+from jobs import enqueueJob
+from publish import PLATFORMS, publishEverywhere
+
+#================================================================
+
+class Job:
+
+  def __init__(self, name, run, interval, jitter):
+    self.name = name
+    self.run = run
+    # both in seconds
+    self.interval = interval
+    self.jitter = jitter
+
+  def nextDelay(self):
+    return max(0.0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+def loadJobs(mongo_db, catalog=None):
+  # <PLATFORM>_INTERVAL_MINUTES enables a bot, e.g. INSTAGRAM_INTERVAL_MINUTES=240
+  # FANOUT_INTERVAL_MINUTES enables posting to every account profile, see utils/accounts.py
+  # PUBLISH_INTERVAL_MINUTES enables posting one artwork to every platform, see publish.py
+  jobs = []
+  bots = {}
+
+  for name in [platform.name for platform in BOT_DIRECTORIES] + ['FANOUT', 'PUBLISH']:
+    if not (interval := config(f'{ name }_INTERVAL_MINUTES', cast=float, default=0.0)):
+      continue
+
+    jitter = config(f'{ name }_JITTER_MINUTES', cast=float, default=config('SCHEDULER_JITTER_MINUTES', cast=float, default=5.0))
+
+    if name == 'FANOUT':
+      run = lambda: runAccounts(
+        mongo_db=mongo_db,
+        bots=bots,
+        path=config('ACCOUNTS_PATH', default=None),
+        workers=config('FANOUT_WORKERS', cast=int, default=8),
+        catalog=catalog
+      )
+    elif name == 'PUBLISH':
+      for platform in set(PLATFORMS) - bots.keys():
+        bots[platform] = loadBot(platform, mongo_db, catalog)
+      run = lambda: publishEverywhere(mongo_db, bots, catalog)
+    elif config('QUEUE_JOBS', cast=bool, default=False):
+      # queue a job for worker.py to post, with retries, instead of posting here
+      run = lambda platform=Platform[name]: enqueueJob(mongo_db, platform)
+    else:
+      bots[Platform[name]] = loadBot(Platform[name], mongo_db, catalog)
+      run = bots[Platform[name]].run
+
+    jobs.append(Job(name.lower(), run, interval * 60, jitter * 60))
+    logging.info(f"scheduling { name.lower() } every { interval } minutes (+/- { jitter })")
+
+  return jobs
+
+#================================================================
+
+async def runJob(job):
+  logging.info(f"{ job.name } - starting")
+  start = time.monotonic()
+
+  try:
+    # the bots are blocking code, run them on a worker thread
+    result = await asyncio.to_thread(job.run)
+    logging.info(f"{ job.name } - finished in {time.monotonic() - start:.1f}s, result: { repr(result) }")
+  except Exception as e:
+    logging.error(f"{ job.name } - { repr(e) }")
+
+async def schedule(job, stopping):
+  task = None
+  next_run = time.monotonic() + job.nextDelay()
+
+  while not stopping.is_set():
+    try:
+      await asyncio.wait_for(stopping.wait(), timeout=max(0.0, next_run - time.monotonic()))
+      break
+    except asyncio.TimeoutError:
+      pass
+
+    next_run += job.nextDelay()
+
+    # never let two runs of the same bot overlap
+    if task and not task.done():
+      logging.warning(f"{ job.name } - previous run still in progress, skipping")
+      continue
+
+    task = asyncio.create_task(runJob(job))
+
+  # let a run that already started finish before shutting down
+  if task:
+    await task
+
+async def main():
+  mongo_db = getMongoDatabase()
+
+  # keep the media collection in memory so selection doesn't query MongoDB, see utils/catalog.py
+  catalog = None
+  if config('CATALOG', cast=bool, default=True):
+    catalog = Catalog(
+      mongo_db,
+      poll_seconds=config('CATALOG_POLL_SECONDS', cast=float, default=30.0),
+      reload_minutes=config('CATALOG_RELOAD_MINUTES', cast=float, default=60.0)
+    ).load().watch()
+
+  if not (jobs := loadJobs(mongo_db, catalog)):
+    raise Exception('No bots enabled. Set <PLATFORM>_INTERVAL_MINUTES in .env')
+
+  stopping = asyncio.Event()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
+
+  await asyncio.gather(*[schedule(job, stopping) for job in jobs])
+
+  if catalog:
+    catalog.stop()
+
+  logging.info(f'HTTP latency: { client.latencyStats() }')
+  mongo_db.client.close()
+
+#================================================================
+# MAIN
+
+if __name__ == '__main__':
+  try:
+
+    logging.basicConfig(
+      level=config('LOG_LEVEL', default=20, cast=int),
+      format='[Scheduler] - %(levelname)s | %(threadName)s | %(message)s'
+    )
+
+    asyncio.run(main())
+    logging.info('shutdown complete')
+
+  except Exception as e:
+    logging.error(f'__main__(): {repr(e)}')
+  finally:
+    exit()
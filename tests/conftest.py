@@ -0,0 +1,74 @@
+# Shared fixtures for the tests.
+# The bots read their credentials from the environment when they're imported,
+# so placeholder values are set before any of them is loaded. Tests talk to a
+# mongomock database and to local stand-in servers, never to the platforms.
+
+import os
+import sys
+
+import mongomock
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'utils'))
+# for the top level scripts, e.g. worker.py
+sys.path.insert(0, REPO_ROOT)
+
+for name in (
+  'API_KEY', 'API_SECRET', 'OAUTH1_TOKEN', 'OAUTH1_TOKEN_SECRET',
+  'SYSTEM_USER_TOKEN', 'INSTAGRAM_ACCOUNT_ID', 'FACEBOOK_PAGE_ID', 'PAGE_ACCESS_TOKEN'
+):
+  os.environ.setdefault(name, 'test')
+os.environ.setdefault('DEFAULT_URL', 'https://example.com')
+os.environ.setdefault('BASE_URL', 'https://graph.example.com')
+os.environ.setdefault('GRAPH_API_VERSION', 'v20.0')
+
+from bots import loadBot
+
+#================================================================
+
+@pytest.fixture
+def mongo_db():
+  return mongomock.MongoClient().db
+
+@pytest.fixture
+def bot(mongo_db):
+  # loadBot(platform) with the test database
+  return lambda platform: loadBot(platform, mongo_db)
+
+def mediaDocument(filename, **fields):
+  # a media entry that passes MediaObject validation
+  return {
+    'filename': filename,
+    'name': filename,
+    'type': 'image',
+    'url': f'https://media.example.com/{ filename }',
+    'description': '',
+    'projectName': 'A project',
+    'projectURL': None,
+    'tagList': [],
+    'groupList': [],
+    'captionList': ['A caption'],
+    'accountPosts': {},
+    'lastIGPost': 0.0,
+    'lastXPost': 0.0,
+    'lastFBPost': 0.0,
+    'lastLIPost': 0.0,
+    'lastTTPost': 0.0,
+    **fields
+  }
+
+def sheetRow(filename, **fields):
+  # a spreadsheet row as csv.DictReader gives it, every value a string
+  return {
+    'filename': filename,
+    'name': filename,
+    'type': 'image',
+    'description': '',
+    'projectName': 'A project',
+    'projectURL': '',
+    'tagList': '[]',
+    'groupList': '[]',
+    'captionList': '["A caption"]',
+    **fields
+  }
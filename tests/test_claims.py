@@ -0,0 +1,84 @@
+# Leases on mediaObjects: claim, commit and release
+
+import pytest
+
+from claims import Claims
+from conftest import mediaDocument
+from groups import rebuildGroups
+
+NOW = 1_000_000_000.0
+
+#================================================================
+
+@pytest.fixture
+def media(mongo_db):
+  mongo_db['media'].insert_many([
+    mediaDocument('first.jpg', groupList=['series-a']),
+    mediaDocument('second.jpg', groupList=['series-a']),
+    mediaDocument('posted.jpg', lastXPost=NOW - 86400)
+  ])
+  rebuildGroups(mongo_db)
+  return { document['filename']: document for document in mongo_db['media'].find() }
+
+def lease(mongo_db, filename):
+  return (mongo_db['media'].find_one({ 'filename': filename }).get('leases') or {}).get('lastXPost')
+
+#================================================================
+
+def test_claim_holds_off_other_workers_until_released(mongo_db, media):
+  with Claims(mongo_db, ['lastXPost'], 7.0) as claims:
+    assert claims.claim(media['first.jpg'], NOW)
+    assert lease(mongo_db, 'first.jpg')['expiresAt'] == NOW + 15 * 60
+
+    with Claims(mongo_db, ['lastXPost'], 7.0) as other:
+      assert not other.claim(media['first.jpg'], NOW)
+      # and claiming again from the same post is fine
+      assert claims.claim(media['first.jpg'], NOW)
+
+  # leaving the with block released it
+  assert lease(mongo_db, 'first.jpg') is None
+  with Claims(mongo_db, ['lastXPost'], 7.0) as other:
+    assert other.claim(media['first.jpg'], NOW)
+
+def test_claim_skips_what_is_cooling_down(mongo_db, media):
+  with Claims(mongo_db, ['lastXPost'], 7.0) as claims:
+    assert claims.claimAll(list(media.values()), NOW) == [media['first.jpg'], media['second.jpg']]
+
+def test_expired_lease_can_be_taken(mongo_db, media):
+  crashed = Claims(mongo_db, ['lastXPost'], 7.0, lease_minutes=1.0)
+  assert crashed.claim(media['first.jpg'], NOW)
+
+  with Claims(mongo_db, ['lastXPost'], 7.0) as claims:
+    assert not claims.claim(media['first.jpg'], NOW + 30)
+    assert claims.claim(media['first.jpg'], NOW + 61)
+
+  # the crashed worker's release doesn't give back a lease it lost
+  assert crashed.release() == 0
+
+def test_commit_records_only_what_was_published(mongo_db, media):
+  with Claims(mongo_db, ['lastXPost'], 7.0) as claims:
+    claims.claimAll([media['first.jpg'], media['second.jpg']], NOW)
+    assert claims.commit([media['first.jpg']], now=NOW) == 1
+
+  first = mongo_db['media'].find_one({ 'filename': 'first.jpg' })
+  second = mongo_db['media'].find_one({ 'filename': 'second.jpg' })
+  assert first['lastXPost'] == NOW
+  assert first['updatedAt'] == NOW
+  assert second['lastXPost'] == 0.0
+  assert lease(mongo_db, 'first.jpg') is None
+  assert lease(mongo_db, 'second.jpg') is None
+
+  # the groups collection is kept in step
+  members = { member['filename']: member for member in mongo_db['groups'].find_one({ '_id': 'series-a' })['members'] }
+  assert members['first.jpg']['lastXPost'] == NOW
+  assert members['second.jpg']['lastXPost'] == 0.0
+
+def test_commit_without_fields_only_releases(mongo_db, media):
+  with Claims(mongo_db, ['lastXPost', 'lastIGPost'], 7.0) as claims:
+    claims.claim(media['first.jpg'], NOW)
+    # e.g. publishEverywhere when every platform failed
+    assert claims.commit([media['first.jpg']], fields=[], now=NOW) == 1
+
+  first = mongo_db['media'].find_one({ 'filename': 'first.jpg' })
+  assert (first['lastXPost'], first['lastIGPost']) == (0.0, 0.0)
+  assert not first.get('leases')
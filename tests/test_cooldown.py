@@ -0,0 +1,55 @@
+# Group cool down overrides, checked the same way by MongoDB, the catalog and claims
+
+import time
+
+import pytest
+
+from catalog import Catalog
+from claims import Claims
+from conftest import mediaDocument
+from cooldown import CooldownEvaluator
+from enums import Platform
+from selection import eligibleQuery
+
+DAY = 86400
+GROUP_DAYS = { 'series-a': 30.0, 'series-b': 3.0 }
+
+#================================================================
+
+@pytest.fixture
+def now(mongo_db):
+  now = time.time()
+  mongo_db['media'].insert_many([
+    # cooled down for the default 7 days, not for its group's 30
+    mediaDocument('a.jpg', groupList=['series-a'], lastXPost=now - 10 * DAY),
+    # not for the default, but for its group's 3
+    mediaDocument('b.jpg', groupList=['series-b'], lastXPost=now - 5 * DAY),
+    mediaDocument('c.jpg', lastXPost=now - 10 * DAY, lastIGPost=now - 1 * DAY),
+    # the longest of its groups wins
+    mediaDocument('d.jpg', groupList=['series-a', 'series-b'], lastXPost=now - 20 * DAY)
+  ])
+  return now
+
+#================================================================
+
+def test_mongo_and_catalog_agree(mongo_db, now):
+  mongo = { document['filename'] for document in mongo_db['media'].find(eligibleQuery(Platform.X, 7.0, now=now, group_days=GROUP_DAYS)) }
+  catalog = { document['filename'] for document in Catalog(mongo_db).load().eligible(Platform.X, 7.0, now=now, group_days=GROUP_DAYS) }
+
+  assert mongo == catalog == { 'b.jpg', 'c.jpg' }
+
+def test_claims_use_the_group_overrides(mongo_db, now):
+  for filename, claimed in (('a.jpg', False), ('b.jpg', True), ('c.jpg', True), ('d.jpg', False)):
+    with Claims(mongo_db, ['lastXPost'], 7.0, group_days=GROUP_DAYS) as claims:
+      assert claims.claim({ 'filename': filename }, now) is claimed
+
+def test_masks_cover_every_field_in_one_pass(mongo_db, now):
+  catalog = Catalog(mongo_db).load()
+  evaluator = CooldownEvaluator(7.0, platform_days={ Platform.INSTAGRAM: 0.5 }, group_days=GROUP_DAYS)
+  rows = sorted(catalog.byFilename[filename] for filename in ('a.jpg', 'b.jpg', 'c.jpg'))
+
+  rows, masks = evaluator.masks(catalog, rows, ['lastXPost', 'lastIGPost'], now)
+
+  assert [catalog.records[row].filename for row in rows[masks['lastXPost']]] == ['b.jpg', 'c.jpg']
+  assert [catalog.records[row].filename for row in rows[masks['lastIGPost']]] == ['a.jpg', 'b.jpg', 'c.jpg']
+  assert catalog.sampleEverywhere([Platform.X, Platform.INSTAGRAM], evaluator)['filename'] in ('b.jpg', 'c.jpg')
@@ -0,0 +1,38 @@
+# Expanding a group for a carousel or a multi image post
+
+import time
+
+import pytest
+
+from conftest import mediaDocument
+from cooldown import CooldownEvaluator
+from groups import eligibleGroupMembers, rebuildGroups
+
+#================================================================
+
+@pytest.fixture
+def group(mongo_db):
+  now = time.time()
+  mongo_db['media'].insert_many([
+    mediaDocument('first.jpg', groupList=['series-a']),
+    mediaDocument('second.jpg', groupList=['series-a']),
+    mediaDocument('posted.jpg', groupList=['series-a'], lastXPost=now),
+    mediaDocument('broken.jpg', groupList=['series-a'], healthy=False),
+    mediaDocument('other.jpg', groupList=['series-b'])
+  ])
+  return 'series-a'
+
+def members(mongo_db, group):
+  return sorted(member['filename'] for member in eligibleGroupMembers(mongo_db, group, ['first.jpg'], 'lastXPost', CooldownEvaluator(7.0)))
+
+#================================================================
+
+def test_members_from_the_groups_collection(mongo_db, group):
+  rebuildGroups(mongo_db)
+
+  assert members(mongo_db, group) == ['second.jpg']
+
+def test_members_before_the_groups_collection_is_built(mongo_db, group):
+  assert 'groups' not in mongo_db.list_collection_names()
+
+  assert members(mongo_db, group) == ['second.jpg']
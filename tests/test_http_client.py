@@ -0,0 +1,41 @@
+# The shared HTTP client against a local server that never answers in time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+import requests
+
+from http_client import HttpClient
+
+#================================================================
+
+class StalledHandler(BaseHTTPRequestHandler):
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    self.server.requests += 1
+    time.sleep(1.0)
+
+@pytest.fixture
+def stalled():
+  server = ThreadingHTTPServer(('127.0.0.1', 0), StalledHandler)
+  server.requests = 0
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+#================================================================
+
+def test_stalled_request_times_out_and_is_retried(stalled):
+  client = HttpClient(retries=1, backoff=0.01, timeout=0.2)
+
+  with pytest.raises(requests.Timeout):
+    client.get(f'http://127.0.0.1:{ stalled.server_port }/')
+
+  assert stalled.requests == 2
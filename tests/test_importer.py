@@ -0,0 +1,72 @@
+# The --sync import against a mongomock media collection, with the rows
+# parsed in this process (workers=1) like a small spreadsheet would be
+
+from conftest import sheetRow
+from importer import syncImport
+
+MEDIA_BASE_URL = 'https://media.example.com'
+
+#================================================================
+
+def sync(mongo_db, rows, **kwargs):
+  return syncImport(mongo_db, rows, MEDIA_BASE_URL, workers=1, **kwargs)
+
+#================================================================
+
+def test_unchanged_rows_are_skipped_and_changed_fields_written(mongo_db):
+  rows = [sheetRow('a.jpg'), sheetRow('b.jpg')]
+  report = sync(mongo_db, rows)
+  assert report['added'] == ['a.jpg', 'b.jpg']
+  entry = mongo_db['media'].find_one({ 'filename': 'a.jpg' })
+  assert entry['url'] == f'{ MEDIA_BASE_URL }/a.jpg'
+  assert entry['lastXPost'] == 0.0
+  assert entry['rowHash']
+
+  # post history is kept when the row is written again
+  mongo_db['media'].update_one({ 'filename': 'b.jpg' }, { '$set': { 'lastXPost': 100.0 } })
+  updated_at = entry['updatedAt']
+
+  report = sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg', description='New', tagList='["tag"]')])
+  assert report['summary']['unchanged'] == 1
+  assert report['changed'] == { 'b.jpg': ['description', 'tagList'] }
+
+  entry = mongo_db['media'].find_one({ 'filename': 'b.jpg' })
+  assert entry['description'] == 'New'
+  assert entry['tagList'] == ['tag']
+  assert entry['lastXPost'] == 100.0
+  assert mongo_db['media'].find_one({ 'filename': 'a.jpg' })['updatedAt'] == updated_at
+
+def test_dry_run_writes_nothing(mongo_db):
+  report = sync(mongo_db, [sheetRow('a.jpg')], dry_run=True)
+  assert report['added'] == ['a.jpg']
+  assert mongo_db['media'].count_documents({}) == 0
+
+def test_bad_rows_are_reported_and_not_pruned(mongo_db):
+  sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg')])
+
+  report = sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg', tagList='not json')], prune='flag')
+  assert report['summary']['invalid'] == 1
+  assert report['removed'] == []
+  assert 'removedAt' not in mongo_db['media'].find_one({ 'filename': 'b.jpg' })
+
+def test_missing_rows_are_flagged_and_come_back_when_readded(mongo_db):
+  sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg')])
+
+  report = sync(mongo_db, [sheetRow('a.jpg')], prune='flag')
+  assert report['removed'] == ['b.jpg']
+  assert mongo_db['media'].find_one({ 'filename': 'b.jpg' })['removedAt']
+
+  # an entry that's already flagged isn't flagged again
+  report = sync(mongo_db, [sheetRow('a.jpg')], prune='flag')
+  assert report['removed'] == []
+
+  report = sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg')], prune='flag')
+  assert report['changed'] == { 'b.jpg': ['removedAt'] }
+  assert 'removedAt' not in mongo_db['media'].find_one({ 'filename': 'b.jpg' })
+
+def test_missing_rows_are_deleted(mongo_db):
+  sync(mongo_db, [sheetRow('a.jpg'), sheetRow('b.jpg')])
+
+  report = sync(mongo_db, [sheetRow('a.jpg')], prune='delete')
+  assert report['removed'] == ['b.jpg']
+  assert [entry['filename'] for entry in mongo_db['media'].find()] == ['a.jpg']
@@ -0,0 +1,77 @@
+# The post job queue running a Facebook post through worker.jobHandler,
+# with the Graph API replaced by canned responses
+
+import pytest
+
+from conftest import mediaDocument
+from enums import JobState, Platform
+from groups import rebuildGroups
+from http_client import client
+from jobs import claimJob, enqueueJob, runJob
+from worker import jobHandler
+
+#================================================================
+
+class GraphResponse:
+
+  def __init__(self, status_code, body):
+    self.status_code = status_code
+    self.body = body
+    self.text = repr(body)
+
+  def json(self):
+    return self.body
+
+@pytest.fixture
+def queued(mongo_db):
+  # one image in a group, and one Facebook job ready to run
+  mongo_db['media'].insert_one(mediaDocument('image.jpg', groupList=['series-a']))
+  rebuildGroups(mongo_db)
+  enqueueJob(mongo_db, Platform.FACEBOOK, now=0.0)
+  return claimJob(mongo_db, 'test-worker')
+
+def graphApi(monkeypatch, response):
+  requests = []
+  monkeypatch.setattr(client, 'post', lambda url, **kwargs: requests.append(url) or response)
+  return requests
+
+#================================================================
+
+def test_published_job_records_the_post(mongo_db, queued, monkeypatch):
+  requests = graphApi(monkeypatch, GraphResponse(200, { 'id': '1', 'post_id': '1_2' }))
+
+  assert runJob(mongo_db, queued, jobHandler(mongo_db, {})) == { 'id': '1', 'post_id': '1_2' }
+
+  assert len(requests) == 1
+  job = mongo_db['jobs'].find_one({ '_id': queued['_id'] })
+  assert job['state'] == JobState.PUBLISHED.value
+  assert 'leaseUntil' not in job
+
+  media = mongo_db['media'].find_one({ 'filename': 'image.jpg' })
+  assert media['lastFBPost'] > 0
+  assert 'lastFBPost' not in media.get('leases', {})
+  # the groups collection is kept in step without array_filters
+  assert mongo_db['groups'].find_one({ '_id': 'series-a' })['members'][0]['lastFBPost'] == media['lastFBPost']
+
+  # and it's cooling down for the next job
+  enqueueJob(mongo_db, Platform.FACEBOOK, now=60.0)
+  assert runJob(mongo_db, claimJob(mongo_db, 'test-worker'), jobHandler(mongo_db, {})) is None
+  assert len(requests) == 1
+
+def test_failed_job_is_retried_later(mongo_db, queued, monkeypatch):
+  graphApi(monkeypatch, GraphResponse(400, { 'error': { 'message': 'Invalid parameter' } }))
+
+  assert runJob(mongo_db, queued, jobHandler(mongo_db, {}), backoff=60.0) is None
+
+  job = mongo_db['jobs'].find_one({ '_id': queued['_id'] })
+  assert job['state'] == JobState.UPLOADING.value
+  assert job['attempts'] == 1
+  assert job['nextAttemptAt'] >= job['updatedAt']
+  assert 'Failed to create a photo post' in job['lastError']
+  assert 'leaseUntil' not in job
+
+  # nothing was published, so nothing is cooling down or leased
+  media = mongo_db['media'].find_one({ 'filename': 'image.jpg' })
+  assert media['lastFBPost'] == 0.0
+  assert 'lastFBPost' not in media.get('leases', {})
+  assert mongo_db['groups'].find_one({ '_id': 'series-a' })['members'][0]['lastFBPost'] == 0.0
@@ -0,0 +1,95 @@
+# Preflight reading image headers from a local stand-in for the media server
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import struct
+import threading
+import zlib
+
+import pytest
+
+from image_cache import cache
+from preflight import HEADER_BYTES, inspectImage
+
+#================================================================
+
+class StandInMediaServer(ThreadingHTTPServer):
+  # serves files with Range support, recording each request's Range header
+
+  def __init__(self, files):
+    super().__init__(('127.0.0.1', 0), StandInMediaHandler)
+    self.files = files
+    self.requests = []
+
+  def url(self, name):
+    return f'http://127.0.0.1:{ self.server_port }/{ name }'
+
+class StandInMediaHandler(BaseHTTPRequestHandler):
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    data = self.server.files[self.path.lstrip('/')]
+    self.server.requests.append(self.headers.get('Range'))
+
+    if (requested := self.headers.get('Range')):
+      start, end = (int(value) for value in requested.removeprefix('bytes=').split('-'))
+      body = data[start:end + 1]
+      self.send_response(206)
+      self.send_header('Content-Range', f'bytes { start }-{ start + len(body) - 1 }/{ len(data) }')
+    else:
+      body = data
+      self.send_response(200)
+
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+def png(width, height, size):
+  # a PNG header padded out to size bytes
+  header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+  data = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(header)) + b'IHDR' + header + struct.pack('>I', zlib.crc32(b'IHDR' + header))
+  return data + b'\0' * (size - len(data))
+
+def jpeg(width, height, profile_bytes):
+  # a JPEG whose start of frame comes after an APP2 segment of profile_bytes
+  data = b'\xff\xd8'
+  while profile_bytes > 0:
+    length = min(profile_bytes, 65533)
+    data += b'\xff\xe2' + struct.pack('>H', length + 2) + b'\0' * length
+    profile_bytes -= length
+  return data + b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 3) + b'\0' * 9 + b'\xff\xd9'
+
+@pytest.fixture
+def media_server(tmp_path, monkeypatch):
+  monkeypatch.setattr(cache, 'directory', str(tmp_path))
+  server = StandInMediaServer({
+    'image.png': png(1600, 1200, 3 * 1024 * 1024),
+    'profile.jpg': jpeg(1200, 1200, 100 * 1024)
+  })
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+#================================================================
+
+def test_header_is_read_with_a_ranged_get(media_server):
+  filename, fields = inspectImage('image.png', media_server.url('image.png'))
+
+  assert media_server.requests == [f'bytes=0-{ HEADER_BYTES - 1 }']
+  info = fields['imageInfo']
+  assert (info['format'], info['width'], info['height'], info['bytes']) == ('png', 1600, 1200, 3 * 1024 * 1024)
+  # Instagram only takes JPEGs, and without DERIVATIVE_DIR nothing is downloaded to convert it
+  assert info['rejected'] == ['instagram']
+  assert fields['derivatives'] == {}
+
+def test_header_past_the_range_downloads_the_image(media_server):
+  filename, fields = inspectImage('profile.jpg', media_server.url('profile.jpg'))
+
+  assert media_server.requests == [f'bytes=0-{ HEADER_BYTES - 1 }', None]
+  info = fields['imageInfo']
+  assert (info['format'], info['width'], info['height']) == ('jpeg', 1200, 1200)
+  assert info['bytes'] == len(media_server.files['profile.jpg'])
+  assert info['rejected'] == []
@@ -0,0 +1,32 @@
+# Resuming a failed Instagram post from its saved containers
+
+import pytest
+
+from enums import Platform
+from publish_state import loadPublishState, savePublishState
+
+#================================================================
+
+def test_state_is_resumed_until_it_runs_out_of_resumes(mongo_db):
+  savePublishState(mongo_db, 'job', fresh=True, children=[{ 'filename': 'image.jpg', 'containerId': '1' }])
+
+  for resumes in range(3):
+    assert loadPublishState(mongo_db, 'job', max_resumes=3)['resumes'] == resumes
+
+  assert loadPublishState(mongo_db, 'job', max_resumes=3) is None
+  assert mongo_db['publishState'].count_documents({}) == 0
+
+def test_failed_resume_keeps_the_state_for_the_retry(mongo_db, bot, monkeypatch):
+  instagram = bot(Platform.INSTAGRAM)
+  savePublishState(mongo_db, 'job', fresh=True, children=[{ 'filename': 'image.jpg', 'containerId': '1' }])
+
+  resumed = []
+  monkeypatch.setattr(instagram, 'resumePost', lambda state, *args: resumed.append(state['resumes']))
+  monkeypatch.setattr(instagram, 'pickMediaObject', lambda *args: pytest.fail('started a new post'))
+
+  assert instagram.run(job_key='job') is None
+  assert instagram.run(job_key='job') is None
+
+  # each retry resumed the same saved post
+  assert resumed == [0, 1]
+  assert mongo_db['publishState'].find_one({ '_id': 'job' })['resumes'] == 2
@@ -0,0 +1,39 @@
+# The default row by row import behind update.py, against a mongomock media collection
+
+import io
+import json
+
+from conftest import sheetRow
+from importer import rowImport
+
+MEDIA_BASE_URL = 'https://media.example.com'
+
+#================================================================
+
+def test_new_rows_are_inserted_and_bad_rows_reported(mongo_db):
+  error_report = io.StringIO()
+  rows = [sheetRow('a.jpg', tagList='["tag"]'), sheetRow('b.jpg', type='hologram'), sheetRow('c.jpg', groupList='[')]
+
+  summary = rowImport(mongo_db, rows, MEDIA_BASE_URL, error_report=error_report)
+  assert summary == { 'rows': 3, 'invalid': 2, 'updated': 0, 'inserted': 1 }
+
+  entry = mongo_db['media'].find_one({ 'filename': 'a.jpg' })
+  assert entry['url'] == f'{ MEDIA_BASE_URL }/a.jpg'
+  assert entry['tagList'] == ['tag']
+  assert entry['lastIGPost'] == 0.0
+  assert entry['updatedAt']
+
+  errors = [json.loads(line) for line in error_report.getvalue().splitlines()]
+  assert [(error['row'], error['filename'], error['field']) for error in errors] == [(3, 'b.jpg', 'type'), (4, 'c.jpg', 'groupList')]
+
+def test_existing_rows_keep_their_post_history(mongo_db):
+  rowImport(mongo_db, [sheetRow('a.jpg')], MEDIA_BASE_URL)
+  mongo_db['media'].update_one({ 'filename': 'a.jpg' }, { '$set': { 'lastXPost': 100.0, 'rowHash': 'old' } })
+
+  summary = rowImport(mongo_db, [sheetRow('a.jpg', description='New')], MEDIA_BASE_URL)
+  assert summary['updated'] == 1
+
+  entry = mongo_db['media'].find_one({ 'filename': 'a.jpg' })
+  assert entry['description'] == 'New'
+  assert entry['lastXPost'] == 100.0
+  assert 'rowHash' not in entry
@@ -0,0 +1,127 @@
+# Chunked X media uploads against a local stand-in for upload.twitter.com
+
+import email
+from email import policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import parse_qs
+
+import pytest
+
+from enums import Platform
+
+#================================================================
+
+class StandInUploadServer(ThreadingHTTPServer):
+  # records each INIT/APPEND/FINALIZE command with its fields
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), StandInUploadHandler)
+    self.commands = []
+    # returned by FINALIZE and STATUS when set, like X does for media it's still processing
+    self.processing_info = None
+
+  @property
+  def url(self):
+    return f'http://127.0.0.1:{ self.server_port }/1.1/media/upload.json'
+
+class StandInUploadHandler(BaseHTTPRequestHandler):
+
+  def log_message(self, *args):
+    pass
+
+  def respond(self, status, body):
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write(json.dumps(body).encode())
+
+  def do_GET(self):
+    command = { key: values[0] for key, values in parse_qs(self.path.split('?', 1)[1]).items() }
+    self.server.commands.append(command)
+    self.respond(200, { 'media_id_string': '1234', 'processing_info': self.server.processing_info })
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers['Content-Length']))
+
+    if self.headers['Content-Type'].startswith('multipart/form-data'):
+      message = email.message_from_bytes(
+        f"Content-Type: { self.headers['Content-Type'] }\r\n\r\n".encode() + body,
+        policy=policy.default
+      )
+      fields = { part.get_param('name', header='content-disposition'): part.get_payload(decode=True) for part in message.iter_parts() }
+      command = { key: value.decode() for key, value in fields.items() if key != 'media' }
+      command['media'] = fields['media']
+    else:
+      command = { key: values[0] for key, values in parse_qs(body.decode()).items() }
+
+    self.server.commands.append(command)
+
+    if command['command'] == 'APPEND':
+      self.send_response(204)
+      self.end_headers()
+      return
+
+    if command['command'] == 'FINALIZE' and self.server.processing_info:
+      self.respond(201, { 'media_id_string': '1234', 'processing_info': self.server.processing_info })
+      return
+
+    self.respond(201 if command['command'] == 'FINALIZE' else 202, { 'media_id_string': '1234' })
+
+@pytest.fixture
+def stand_in():
+  server = StandInUploadServer()
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+@pytest.fixture
+def x_bot(bot, stand_in, monkeypatch):
+  x_bot = bot(Platform.X)
+  monkeypatch.setattr(x_bot, 'UPLOAD_URL', stand_in.url)
+  monkeypatch.setattr(x_bot, 'UPLOAD_CHUNK_SIZE', 1000)
+  return x_bot
+
+def checkUpload(result, commands, data, media_type):
+  assert result['media_id_string'] == '1234'
+  assert [command['command'] for command in commands] == ['INIT', 'APPEND', 'APPEND', 'APPEND', 'FINALIZE']
+
+  init = commands[0]
+  assert int(init['total_bytes']) == len(data)
+  assert init['media_type'] == media_type
+
+  appends = commands[1:-1]
+  assert [int(append['segment_index']) for append in appends] == [0, 1, 2]
+  assert all(append['media_id'] == '1234' for append in appends)
+  assert b''.join(append['media'] for append in appends) == data
+  assert commands[-1]['media_id'] == '1234'
+
+#================================================================
+
+def test_chunked_upload_from_bytes(x_bot, stand_in):
+  data = bytes(range(256)) * 10
+
+  result = x_bot.upload_media_chunked(source=data, media_type='image/png')
+
+  checkUpload(result, stand_in.commands, data, 'image/png')
+
+def test_chunked_upload_from_file(x_bot, stand_in, tmp_path):
+  data = b'\xff\xd8' + bytes(range(256)) * 10
+  path = tmp_path / 'image.jpg'
+  path.write_bytes(data)
+
+  result = x_bot.upload_media_chunked(source=str(path))
+
+  checkUpload(result, stand_in.commands, data, 'image/jpeg')
+
+def test_media_stuck_processing_is_given_up(x_bot, stand_in, monkeypatch):
+  monkeypatch.setattr(x_bot, 'PROCESSING_TIMEOUT', 1.5)
+  stand_in.processing_info = { 'state': 'in_progress', 'check_after_secs': 1 }
+
+  assert x_bot.upload_media_chunked(source=bytes(2500), media_type='image/png') is None
+
+  # one STATUS check fits before the deadline, the next one wouldn't
+  assert [command['command'] for command in stand_in.commands][-2:] == ['FINALIZE', 'STATUS']
@@ -0,0 +1,79 @@
+# Account profiles for posting to many accounts from one process.
+# Profiles are read from the accounts collection, or from a JSON file holding
+# a list of profiles. See AccountProfile in models.py for the fields.
+# Without any profiles, each bot posts to the single account in its .env
+
+import json
+import time
+from pymongo.errors import DuplicateKeyError
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# Imports the shared helpers
+from enums import Platform
+from models import AccountProfile
+from selection import LAST_POST_FIELDS
+
+# The .env settings that identify and authenticate an account on each platform
+ACCOUNT_CREDENTIALS = {
+  Platform.INSTAGRAM: ('INSTAGRAM_ACCOUNT_ID', 'SYSTEM_USER_TOKEN'),
+  Platform.FACEBOOK: ('FACEBOOK_PAGE_ID', 'PAGE_ACCESS_TOKEN'),
+  Platform.X: ('OAUTH1_TOKEN', 'OAUTH1_TOKEN_SECRET')
+}
+
+#================================================================
+
+def defaultAccount(platform):
+  # the account configured in .env, using the shared lastXXPost cool down field
+  return AccountProfile(
+    name=f'default-{ platform.value }',
+    platform=platform,
+    credentials={ key: config(key, cast=str) for key in ACCOUNT_CREDENTIALS[platform] },
+    coolDownField=LAST_POST_FIELDS[platform]
+  )
+
+def loadAccounts(mongo_db=None, path=None, platforms=None):
+  if path:
+    with open(path) as file:
+      documents = json.load(file)
+  else:
+    documents = list(mongo_db['accounts'].find({}, { '_id': 0 }))
+
+  accounts = [
+    account for account in (AccountProfile(**document) for document in documents)
+    if account.enabled and (not platforms or account.platform in platforms)
+  ]
+
+  # names key the per account cool down fields, so they must not clash
+  if len({ account.name for account in accounts }) != len(accounts):
+    raise Exception('Account names must be unique')
+
+  return accounts
+
+#================================================================
+
+def claimAccountRun(mongo_db, account, now=None):
+  # Enforces minIntervalMinutes between runs of an account across every process
+  # sharing the database. Returns False if the account ran too recently.
+  if not account.minIntervalMinutes:
+    return True
+
+  now = time.time() if now is None else now
+
+  try:
+    # if the account ran too recently the filter doesn't match and the upsert
+    # tries to insert a second document with the same _id, which fails
+    mongo_db['accountRuns'].find_one_and_update(
+      filter={
+        '_id': account.name,
+        'lastRunAt': { '$not': { '$gt': now - account.minIntervalMinutes * 60 } }
+      },
+      update={ '$set': { 'lastRunAt': now } },
+      upsert=True
+    )
+    return True
+
+  except DuplicateKeyError:
+    return False
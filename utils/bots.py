@@ -0,0 +1,94 @@
+# Loads the bots into a single process so they can share one MongoClient and
+# the pooled HTTP sessions. Each bot directory has its own main.py and
+# templates.py, so every bot is loaded under a unique module name with its own
+# directory at the front of sys.path while it imports.
+# fanOut then runs the bots for many accounts at once, see accounts.py
+
+import importlib.util
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Imports the shared helpers
+from accounts import claimAccountRun, loadAccounts
+from enums import Platform
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_DIRECTORIES = {
+  Platform.INSTAGRAM: 'instagram',
+  Platform.FACEBOOK: 'facebook',
+  Platform.X: 'x'
+}
+
+# modules that exist under the same name in more than one bot directory
+BOT_LOCAL_MODULES = ('templates', 'oauth_helper')
+
+#================================================================
+
+def loadBot(platform, mongo_db, catalog=None):
+  directory = os.path.join(REPO_ROOT, BOT_DIRECTORIES[platform])
+
+  for name in BOT_LOCAL_MODULES:
+    sys.modules.pop(name, None)
+  sys.path.insert(0, directory)
+
+  try:
+    spec = importlib.util.spec_from_file_location(f'{ platform.value }_bot', os.path.join(directory, 'main.py'))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+  finally:
+    sys.path.remove(directory)
+    # the bot keeps references to what it imported, drop them so the next bot gets its own
+    for name in BOT_LOCAL_MODULES:
+      sys.modules.pop(name, None)
+
+  # the bots expect mongo_db to be set up by their __main__ block
+  bot.mongo_db = mongo_db
+  # and select from the database unless they're given a Catalog, see catalog.py
+  bot.catalog = catalog
+  return bot
+
+#================================================================
+
+def fanOut(bots, accounts, mongo_db, workers=8):
+  # Runs the matching bot for every account in parallel.
+  # bots maps each Platform to a bot loaded with loadBot.
+  # Returns the result of each account's run by account name.
+  results = {}
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = {}
+
+    for account in accounts:
+      if account.platform not in bots:
+        logging.warning(f"fanOut() - no bot loaded for { account.name } ({ account.platform.value })")
+        continue
+
+      if not claimAccountRun(mongo_db, account):
+        logging.info(f"fanOut() - { account.name } ran less than { account.minIntervalMinutes } minutes ago, skipping")
+        continue
+
+      futures[executor.submit(bots[account.platform].run, account)] = account
+
+    for future in as_completed(futures):
+      account = futures[future]
+      try:
+        results[account.name] = future.result()
+        logging.info(f"fanOut() - { account.name } finished, result: { repr(results[account.name]) }")
+      except Exception as e:
+        results[account.name] = None
+        logging.error(f"fanOut() - { account.name }: { repr(e) }")
+
+  return results
+
+def runAccounts(mongo_db, bots, path=None, workers=8, catalog=None):
+  # loads the account profiles (see accounts.py) and fans out over all of them,
+  # loading any bot that isn't already in bots
+  accounts = loadAccounts(mongo_db, path)
+
+  for platform in { account.platform for account in accounts } - bots.keys():
+    bots[platform] = loadBot(platform, mongo_db, catalog)
+
+  return fanOut(bots, accounts, mongo_db, workers)
@@ -0,0 +1,50 @@
+# Caption rendering shared by the bots.
+# Templates from each bot's templates.py are compiled once into literal text and
+# field names, so rendering is a single join. Normalized hashtags are cached by
+# the tag list they came from, so an entry whose tagList changes simply gets a
+# new cache entry. Nothing here modifies the mediaObjects passed in.
+
+import random
+from functools import lru_cache
+from string import Formatter
+
+#================================================================
+
+class CaptionTemplate:
+
+  def __init__(self, template):
+    self.parts = []
+
+    for literal, field, spec, conversion in Formatter().parse(template):
+      # the templates only use plain {name} fields
+      if spec or conversion:
+        raise ValueError(f'Unsupported field in caption template: { field }')
+      self.parts.append((literal, field))
+
+  def render(self, **fields):
+    return ''.join([
+      literal + (str(fields[field]) if field is not None else '')
+      for literal, field in self.parts
+    ])
+
+#================================================================
+# Hashtags
+
+@lru_cache(maxsize=4096)
+def normalizedTags(tags):
+  # '#'-prefixed tags without spaces or duplicates, in their original order
+  # tags must be a tuple so it can be used as the cache key
+  return tuple(dict.fromkeys(
+    '#' + tag for tag in (''.join(tag.split()).lstrip('#') for tag in tags) if tag
+  ))
+
+def mediaTags(mediaObject):
+  return normalizedTags(tuple(mediaObject.get('tagList', [])))
+
+def allTags(mediaObjects):
+  # the union of the tags of several mediaObjects, in order of first appearance
+  return tuple(dict.fromkeys(tag for mediaObject in mediaObjects for tag in mediaTags(mediaObject)))
+
+def randomTags(tags, count):
+  # a random selection of up to count tags, leaving tags untouched
+  return random.sample(tags, min(count, len(tags)))
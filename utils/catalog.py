@@ -0,0 +1,324 @@
+# An in-memory copy of the media collection for long running processes.
+# The documents are validated against MediaObject, indexed by filename, type and
+# group, loaded once and then kept fresh from a change stream. Change streams
+# need a replica set, on a standalone server the catalog polls for documents with
+# a newer updatedAt instead, and reloads everything every reload_minutes to catch
+# deletions.
+# ref: https://www.mongodb.com/docs/manual/changeStreams/
+#
+# To keep large catalogs small each entry is a slotted MediaRecord with interned
+# strings and integer group ids, and the post timestamps live in one array('d')
+# column per field, indexed by the record's row. Cool down checks read the
+# columns directly with NumPy, see cooldown.py.
+# Callers get plain documents (or MediaObjects) back.
+
+from array import array
+import logging
+import random
+import sys
+import threading
+import time
+from pydantic import ValidationError
+from pymongo.errors import PyMongoError
+
+# Imports the shared helpers
+from cooldown import CooldownEvaluator
+from enums import MediaType
+from models import MediaObject
+from selection import LAST_POST_FIELDS, MEDIA_PROJECTION
+
+CATALOG_PROJECTION = { **MEDIA_PROJECTION, 'updatedAt': 1 }
+
+#================================================================
+
+class MediaRecord:
+  # one catalog entry without its timestamps, see Catalog.columns
+  __slots__ = ('_id', 'row', 'filename', 'type', 'url', 'name', 'description', 'projectName', 'projectURL', 'tags', 'groups', 'captions', 'rejected', 'derivatives', 'healthy')
+
+  def __init__(self, document, row, groups):
+    self._id = document['_id']
+    self.row = row
+    self.filename = document['filename']
+    self.type = sys.intern(document['type'])
+    self.url = document['url']
+    self.name = document['name']
+    self.description = document.get('description', '')
+    # repeated across many records
+    self.projectName = sys.intern(document.get('projectName') or '')
+    self.projectURL = sys.intern(document['projectURL']) if document.get('projectURL') else None
+    self.tags = tuple(sys.intern(tag) for tag in document.get('tagList', []))
+    self.groups = groups
+    self.captions = tuple(document.get('captionList', []))
+    # from preflight.py, most images have neither
+    self.rejected = tuple(sys.intern(platform) for platform in (document.get('imageInfo') or {}).get('rejected', []))
+    self.derivatives = document.get('derivatives') or None
+    # from scan.py
+    self.healthy = document.get('healthy', True)
+
+#================================================================
+
+class Catalog:
+
+  def __init__(self, mongo_db, poll_seconds=30.0, reload_minutes=60.0):
+    self.mongo_db = mongo_db
+    self.poll_seconds = poll_seconds
+    self.reload_minutes = reload_minutes
+    self.lock = threading.RLock()
+    self.stopping = threading.Event()
+    self.thread = None
+    self.clear()
+
+  def clear(self):
+    self.records = []
+    self.freeRows = []
+    # a column of post timestamps per lastXXPost or 'accountPosts.<name>' field
+    self.columns = { field: array('d') for field in LAST_POST_FIELDS.values() }
+    self.groupIds = {}
+    self.groupNames = []
+    self.byId = {}
+    self.byFilename = {}
+    self.byType = {}
+    self.byGroup = {}
+    # rows preflight.py found a platform won't accept, by platform, and rows scan.py found broken
+    self.rejected = {}
+    self.unhealthy = set()
+    self.updatedAt = 0.0
+
+  def __len__(self):
+    return len(self.byId)
+
+  #----------------------------------------------------------------
+  # Loading
+
+  def load(self):
+    with self.lock:
+      self.clear()
+      for document in self.mongo_db['media'].find({}, CATALOG_PROJECTION):
+        self.upsert(document)
+      self.loadedAt = time.time()
+    logging.info(f"Catalog.load() - { len(self) } media objects")
+    return self
+
+  def groupId(self, group):
+    if (group_id := self.groupIds.get(group)) is None:
+      group_id = self.groupIds[group] = len(self.groupNames)
+      self.groupNames.append(sys.intern(group))
+    return group_id
+
+  def column(self, field):
+    # account fields get a column the first time they're seen
+    if (column := self.columns.get(field)) is None:
+      column = self.columns[field] = array('d', bytes(8 * len(self.records)))
+    return column
+
+  def upsert(self, document):
+    try:
+      MediaObject(**document)
+    except ValidationError as e:
+      logging.warning(f"Catalog.upsert() - skipping invalid { repr(document.get('filename')) }: { e.error_count() } validation errors")
+      self.remove(document['_id'])
+      return
+
+    with self.lock:
+      self.remove(document['_id'])
+
+      # dropped from the spreadsheet, see importer.syncImport
+      if document.get('removedAt'):
+        return
+
+      if self.freeRows:
+        row = self.freeRows.pop()
+      else:
+        row = len(self.records)
+        self.records.append(None)
+        for column in self.columns.values():
+          column.append(0.0)
+
+      record = MediaRecord(document, row, tuple(self.groupId(group) for group in document.get('groupList', [])))
+      self.records[row] = record
+
+      for field in LAST_POST_FIELDS.values():
+        self.columns[field][row] = document.get(field, 0.0)
+      for name, timestamp in document.get('accountPosts', {}).items():
+        self.column(f'accountPosts.{ name }')[row] = timestamp
+
+      self.byId[record._id] = row
+      self.byFilename[record.filename] = row
+      self.byType.setdefault(record.type, set()).add(row)
+      for group_id in record.groups:
+        self.byGroup.setdefault(group_id, set()).add(row)
+      for platform in record.rejected:
+        self.rejected.setdefault(platform, set()).add(row)
+      if not record.healthy:
+        self.unhealthy.add(row)
+      self.updatedAt = max(self.updatedAt, document.get('updatedAt', 0.0))
+
+  def remove(self, _id):
+    with self.lock:
+      if (row := self.byId.pop(_id, None)) is None:
+        return
+      record = self.records[row]
+      self.byFilename.pop(record.filename, None)
+      self.byType[record.type].discard(row)
+      for group_id in record.groups:
+        self.byGroup[group_id].discard(row)
+      for platform in record.rejected:
+        self.rejected[platform].discard(row)
+      self.unhealthy.discard(row)
+      for column in self.columns.values():
+        column[row] = 0.0
+      self.records[row] = None
+      self.freeRows.append(row)
+
+  #----------------------------------------------------------------
+  # Conversion at the edges
+
+  def document(self, row):
+    # the record as the bots get it from MongoDB
+    record = self.records[row]
+    document = {
+      '_id': record._id,
+      'filename': record.filename,
+      'type': record.type,
+      'url': record.url,
+      'name': record.name,
+      'description': record.description,
+      'projectName': record.projectName,
+      'projectURL': record.projectURL,
+      'tagList': list(record.tags),
+      'groupList': [self.groupNames[group_id] for group_id in record.groups],
+      'captionList': list(record.captions),
+      'accountPosts': {},
+      'imageInfo': { 'rejected': list(record.rejected) },
+      'derivatives': dict(record.derivatives or {}),
+      'healthy': record.healthy
+    }
+    for field, column in self.columns.items():
+      if field.startswith('accountPosts.'):
+        if column[row]:
+          document['accountPosts'][field.split('.', 1)[1]] = column[row]
+      else:
+        document[field] = column[row]
+    return document
+
+  def mediaObject(self, filename):
+    with self.lock:
+      row = self.byFilename.get(filename)
+      return MediaObject(**self.document(row)) if row is not None else None
+
+  #----------------------------------------------------------------
+  # Lookups
+
+  def get(self, filename):
+    with self.lock:
+      row = self.byFilename.get(filename)
+      return self.document(row) if row is not None else None
+
+  def getById(self, _id):
+    with self.lock:
+      row = self.byId.get(_id)
+      return self.document(row) if row is not None else None
+
+  def ofType(self, media_type=MediaType.IMAGE):
+    with self.lock:
+      return [self.document(row) for row in self.byType.get(media_type.value, ())]
+
+  def inGroup(self, group):
+    with self.lock:
+      if (group_id := self.groupIds.get(group)) is None:
+        return []
+      return [self.document(row) for row in self.byGroup.get(group_id, ())]
+
+  def accepted(self, rows, platform=None):
+    # rows without the broken ones and the ones platform rejects, only copied if there are any
+    if self.unhealthy:
+      rows = rows - self.unhealthy
+    if platform and (rejected := self.rejected.get(platform.value)):
+      rows = rows - rejected
+    return rows
+
+  def eligibleRows(self, platform, cool_down_days, media_type=MediaType.IMAGE, now=None, field=None, group_days=None):
+    # the same predicate as selection.eligibleQuery, checked on the whole column at once
+    return CooldownEvaluator(cool_down_days, group_days=group_days).eligibleRows(
+      self, field or LAST_POST_FIELDS[platform], self.accepted(self.byType.get(media_type.value, set()), platform), now
+    )
+
+  def eligible(self, platform, cool_down_days, media_type=MediaType.IMAGE, now=None, field=None, group_days=None):
+    with self.lock:
+      return [self.document(row) for row in self.eligibleRows(platform, cool_down_days, media_type, now, field, group_days)]
+
+  def eligibleInGroup(self, group, field, evaluator, now=None, platform=None):
+    # the members of a group that have cooled down, with any per platform or group overrides,
+    # and that platform (if given) will accept
+    with self.lock:
+      if (group_id := self.groupIds.get(group)) is None:
+        return []
+      rows = self.accepted(self.byGroup.get(group_id, set()), platform)
+      return [self.document(row) for row in evaluator.eligibleRows(self, field, rows, now)]
+
+  def sample(self, platform, cool_down_days, media_type=MediaType.IMAGE, field=None, group_days=None):
+    with self.lock:
+      if not (rows := self.eligibleRows(platform, cool_down_days, media_type, field=field, group_days=group_days)):
+        logging.warning(f"Catalog.sample() - nothing eligible to post to { platform.value } (cool down: { cool_down_days } days)")
+        return None
+      return self.document(random.choice(rows))
+
+  def sampleEverywhere(self, platforms, evaluator, media_type=MediaType.IMAGE):
+    # a document that has cooled down on every one of platforms, like selection.getMediaEligibleEverywhere
+    with self.lock:
+      rows = self.byType.get(media_type.value, set())
+      for platform in platforms:
+        rows = self.accepted(rows, platform)
+      if not (rows := evaluator.eligibleEverywhere(self, [LAST_POST_FIELDS[platform] for platform in platforms], rows)):
+        logging.warning(f"Catalog.sampleEverywhere() - nothing eligible to post to { [platform.value for platform in platforms] }")
+        return None
+      return self.document(random.choice(rows))
+
+  #----------------------------------------------------------------
+  # Keeping fresh
+
+  def watch(self):
+    # starts a daemon thread following changes to the media collection
+    self.thread = threading.Thread(target=self.follow, name='catalog', daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopping.set()
+    if self.thread:
+      self.thread.join(timeout=self.poll_seconds + 5)
+
+  def follow(self):
+    try:
+      self.followChangeStream()
+    except PyMongoError as e:
+      logging.warning(f"Catalog.follow() - change stream unavailable, polling every { self.poll_seconds }s: { repr(e) }")
+      self.poll()
+
+  def followChangeStream(self):
+    with self.mongo_db['media'].watch(full_document='updateLookup') as stream:
+      while not self.stopping.is_set() and stream.alive:
+        if not (change := stream.try_next()):
+          # try_next returns None when there's nothing new, wait a little
+          self.stopping.wait(1.0)
+          continue
+
+        if change['operationType'] == 'delete':
+          self.remove(change['documentKey']['_id'])
+        elif change.get('fullDocument'):
+          self.upsert(change['fullDocument'])
+        elif change['operationType'] in ('drop', 'rename', 'invalidate'):
+          self.load()
+
+  def poll(self):
+    while not self.stopping.wait(self.poll_seconds):
+      try:
+        if time.time() - self.loadedAt > self.reload_minutes * 60:
+          self.load()
+          continue
+
+        for document in self.mongo_db['media'].find({ 'updatedAt': { '$gt': self.updatedAt } }, CATALOG_PROJECTION):
+          self.upsert(document)
+
+      except PyMongoError as e:
+        logging.error(f"Catalog.poll() - { repr(e) }")
@@ -0,0 +1,118 @@
+# Claims reserve mediaObjects for one post so that workers running at the same
+# time (or a retry of a run that died) can't post the same thing twice.
+# A claim is a lease written with find_one_and_update under leases.<field>, and
+# only succeeds if the mediaObject has cooled down on field and nobody else holds
+# an unexpired lease on it. After publishing, commit() records the post time for
+# exactly the mediaObjects that went out, and release() (or leaving the with
+# block) gives the rest back. A worker that dies without releasing holds its
+# leases until they expire after lease_minutes.
+# ref: https://www.mongodb.com/docs/manual/reference/method/db.collection.findOneAndUpdate/
+
+import logging
+import time
+import uuid
+
+# Imports the shared helpers
+from cooldown import loadEvaluator
+from selection import coolDownQuery, markPosted
+from strategies import rollbackPicks, settlePicks
+
+#================================================================
+
+class Claims:
+
+  def __init__(self, mongo_db, fields, cool_down_days, lease_minutes=15.0, group_days=None):
+    # fields are the lastXXPost (or per account) fields the post will record
+    # cool_down_days is a number or a dict of days by field, group_days the
+    # group overrides on top of it, see cooldown.loadEvaluator
+    self.mongo_db = mongo_db
+    self.fields = list(fields)
+    self.cool_down_days = cool_down_days if isinstance(cool_down_days, dict) else { field: cool_down_days for field in self.fields }
+    self.group_days = group_days
+    self.lease_minutes = lease_minutes
+    # one token for everything claimed for this post
+    self.token = uuid.uuid4().hex
+    self.held = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.release()
+
+  def leases(self, value):
+    return { f'leases.{ field }': value for field in self.fields }
+
+  def ownLeases(self, filenames):
+    return {
+      'filename': { '$in': list(filenames) },
+      **{ f'leases.{ field }.token': self.token for field in self.fields }
+    }
+
+  #----------------------------------------------------------------
+
+  def claim(self, mediaObject, now=None):
+    # True if mediaObject is now reserved for this post
+    if mediaObject['filename'] in self.held:
+      return True
+
+    now = time.time() if now is None else now
+
+    if not self.mongo_db['media'].find_one_and_update(
+      {
+        'filename': mediaObject['filename'],
+        # the same cool downs the mediaObject was selected with, see selection.eligibleQuery
+        '$and': [coolDownQuery(field, self.cool_down_days[field], self.group_days, now) for field in self.fields],
+        **{ f'leases.{ field }.expiresAt': { '$not': { '$gt': now } } for field in self.fields }
+      },
+      { '$set': self.leases({ 'token': self.token, 'expiresAt': now + self.lease_minutes * 60 }) },
+      projection={ '_id': 1 }
+    ):
+      logging.info(f"Claims.claim() - { repr(mediaObject['filename']) } was posted or claimed by another worker")
+      rollbackPicks([mediaObject.get('_id')])
+      return False
+
+    self.held[mediaObject['filename']] = mediaObject
+    return True
+
+  def claimAll(self, mediaObjects, now=None):
+    # the mediaObjects that could be claimed, in the same order
+    return [mediaObject for mediaObject in mediaObjects if self.claim(mediaObject, now)]
+
+  def commit(self, mediaObjects, fields=None, now=None):
+    # records the post on fields (default: all of them) for the mediaObjects that were
+    # published and gives up their leases, publishEverywhere may only succeed on some fields
+    now = time.time() if now is None else now
+    fields = self.fields if fields is None else list(fields)
+
+    if not (filenames := [mediaObject['filename'] for mediaObject in mediaObjects if mediaObject['filename'] in self.held]):
+      return 0
+
+    if fields:
+      # the post went out, so it's recorded even if a lease expired in the meantime
+      markPosted(self.mongo_db, filenames, fields, now)
+      settlePicks([self.held[filename].get('_id') for filename in filenames])
+
+    self.release(filenames)
+    return len(filenames)
+
+  def release(self, filenames=None):
+    # gives back the leases on filenames, by default everything claimed but not committed
+    filenames = list(self.held) if filenames is None else list(filenames)
+    if not filenames:
+      return 0
+
+    # a lease that expired and was taken by another worker isn't ours to give back
+    result = self.mongo_db['media'].update_many(self.ownLeases(filenames), { '$unset': self.leases('') })
+    # anything picked by a selection policy but not published can be picked again
+    rollbackPicks([self.held[filename].get('_id') for filename in filenames if filename in self.held])
+    for filename in filenames:
+      self.held.pop(filename, None)
+    return result.modified_count
+
+#================================================================
+
+def fieldClaims(mongo_db, field, evaluator=None, lease_minutes=15.0):
+  # Claims for a post recording one field, with the cool downs of evaluator, see cooldown.py
+  evaluator = evaluator or loadEvaluator()
+  return Claims(mongo_db, [field], evaluator.fieldDays(field), lease_minutes, evaluator.group_days)
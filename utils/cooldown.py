@@ -0,0 +1,107 @@
+# Vectorized cool down checks.
+# A CooldownEvaluator compares whole columns of post timestamps against the cool
+# down at once with NumPy instead of checking candidates one by one in python.
+# The cool down is POST_COOL_DOWN days unless a platform or a group overrides it.
+# A group override wins over the platform's, and when a mediaObject is in several
+# groups with overrides the longest one applies.
+# ref: https://numpy.org/doc/stable/reference/generated/numpy.frombuffer.html
+
+import numpy as np
+import time
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import Csv, config
+
+# Imports the shared helpers
+from enums import Platform
+from selection import LAST_POST_FIELDS, lastPostTime
+
+PLATFORM_FIELDS = { field: platform for platform, field in LAST_POST_FIELDS.items() }
+
+#================================================================
+
+class CooldownEvaluator:
+
+  def __init__(self, default_days=7.0, platform_days=None, group_days=None):
+    self.default_days = default_days
+    self.platform_days = platform_days or {}
+    self.group_days = group_days or {}
+
+  def fieldDays(self, field):
+    # per account fields ('accountPosts.<name>') use the default
+    return self.platform_days.get(PLATFORM_FIELDS.get(field), self.default_days)
+
+  def groupDays(self, groups):
+    # the longest override of any of the groups, or nan if none of them has one
+    return max((self.group_days[group] for group in groups if group in self.group_days), default=np.nan)
+
+  #----------------------------------------------------------------
+  # Catalog columns, see catalog.py
+  # NOTE: the catalog's lock must be held, its columns can't grow while NumPy reads them
+
+  def groupRowDays(self, catalog, rows):
+    # the group override of each of rows, nan where none of its groups has one
+    days = np.full(len(rows), np.nan)
+    for group, group_days in self.group_days.items():
+      if (group_id := catalog.groupIds.get(group)) is not None and (members := catalog.byGroup.get(group_id)):
+        members = np.isin(rows, np.fromiter(members, dtype=np.intp, count=len(members)))
+        days[members] = np.fmax(days[members], group_days)
+    return days
+
+  def timestamps(self, catalog, field):
+    # a view of the column without copying it, fields nothing was posted to read as never posted
+    if (column := catalog.columns.get(field)) is None:
+      return np.zeros(len(catalog.records))
+    return np.frombuffer(column, dtype=np.float64)
+
+  def masks(self, catalog, rows, fields=None, now=None):
+    # Eligibility of rows for every platform and account field (default: all of them) in one pass.
+    # Returns rows as an array and { field: boolean mask over it }. The group overrides
+    # are looked up once for all the fields, and only for the rows given.
+    now = time.time() if now is None else now
+    rows = np.fromiter(rows, dtype=np.intp, count=len(rows))
+    days = self.groupRowDays(catalog, rows)
+
+    return rows, {
+      field: self.timestamps(catalog, field)[rows] < now - np.where(np.isnan(days), self.fieldDays(field), days) * 86400
+      for field in (fields or list(catalog.columns))
+    }
+
+  def eligibleRows(self, catalog, field, rows, now=None):
+    rows, masks = self.masks(catalog, rows, [field], now)
+    return rows[masks[field]].tolist()
+
+  def eligibleEverywhere(self, catalog, fields, rows, now=None):
+    # the rows that have cooled down on every one of fields
+    rows, masks = self.masks(catalog, rows, fields, now)
+    return rows[np.logical_and.reduce(list(masks.values()))].tolist()
+
+  #----------------------------------------------------------------
+  # Documents straight from MongoDB
+
+  def filter(self, documents, field, now=None):
+    documents = list(documents)
+    timestamps = np.fromiter((lastPostTime(document, field) for document in documents), dtype=np.float64, count=len(documents))
+    days = np.fromiter((self.groupDays(document.get('groupList', [])) for document in documents), dtype=np.float64, count=len(documents))
+    cutoffs = (time.time() if now is None else now) - np.where(np.isnan(days), self.fieldDays(field), days) * 86400
+    return [document for document, eligible in zip(documents, timestamps < cutoffs) if eligible]
+
+#================================================================
+
+def loadEvaluator():
+  # POST_COOL_DOWN=7
+  # X_POST_COOL_DOWN=3                      # per platform
+  # GROUP_COOL_DOWNS=series-a:30,series-b:14 # per group
+  # NOTE: call this after the bot has read its .env, python-decouple caches the first one it finds
+  return CooldownEvaluator(
+    default_days=config('POST_COOL_DOWN', cast=float, default=7.0),
+    platform_days={
+      platform: days for platform in Platform
+      if (days := config(f'{ platform.name }_POST_COOL_DOWN', cast=float, default=0.0))
+    },
+    group_days={
+      group.strip(): float(days)
+      for group, days in (override.rsplit(':', 1) for override in config('GROUP_COOL_DOWNS', cast=Csv(), default=''))
+    }
+  )
@@ -0,0 +1,22 @@
+from pymongo import MongoClient
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+#================================================================
+
+def getMongoDatabase():
+  # Create an instance of the MongoDB client
+  # ref: https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
+  mongo_client = MongoClient(
+    host=config('MONGO_URL', cast=str),
+    username=config('MONGO_USERNAME', cast=str),
+    password=config('MONGO_PASSWORD', cast=str),
+    authSource=config('MONGO_AUTH_SOURCE', cast=str, default=config('MONGO_DB', cast=str)),
+    authMechanism='SCRAM-SHA-256'
+  )
+
+  # Get the instance of the database from the client
+  # This will be used to interface with the collections within the database
+  return mongo_client[config('MONGO_DB')]
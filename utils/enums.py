@@ -8,3 +8,26 @@ from enum import Enum
 class MediaType(str, Enum):
   IMAGE = "image"
   VIDEO = "video"
+
+# Platform is a subclass of Enum.
+# It specifies the platforms the bots publish to.
+# Each one has a matching lastXXPost field in MediaObject.
+
+class Platform(str, Enum):
+  INSTAGRAM = "instagram"
+  X = "x"
+  FACEBOOK = "facebook"
+  LINKEDIN = "linkedin"
+  TIKTOK = "tiktok"
+
+# JobState is a subclass of Enum.
+# It specifies the states of a post job in the jobs collection, see jobs.py
+# A job is pending until a worker picks it up, then uploading, container_ready
+# once the platform has the media, and finally published or failed.
+
+class JobState(str, Enum):
+  PENDING = "pending"
+  UPLOADING = "uploading"
+  CONTAINER_READY = "container_ready"
+  PUBLISHED = "published"
+  FAILED = "failed"
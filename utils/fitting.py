@@ -0,0 +1,107 @@
+# Pre-flight caption fitting.
+# Measures a caption the way each platform does and trims it until it fits,
+# so an over long caption never gets as far as an API call (or an upload).
+# Tags are dropped first, from the end, then the body is shortened.
+# ref: https://docs.x.com/resources/fundamentals/counting-characters
+# ref: https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-user/media
+
+import logging
+import re
+import unicodedata
+
+# Imports Platform from enums.py
+from enums import Platform
+
+CAPTION_LIMITS = {
+  Platform.X: { 'length': 280, 'hashtags': None },
+  Platform.INSTAGRAM: { 'length': 2200, 'hashtags': 30 },
+  Platform.FACEBOOK: { 'length': 63206, 'hashtags': None }
+}
+
+# X counts every url as the length of a t.co link
+X_URL_LENGTH = 23
+# Like X, bare domains only count when they end in a known top level domain,
+# so filenames like image.jpg or names like Phillip.Stearns aren't taken for urls.
+URL_TLDS = (
+  'com', 'org', 'net', 'edu', 'gov', 'info', 'biz', 'io', 'co', 'me', 'tv', 'ai', 'app', 'dev',
+  'art', 'gallery', 'studio', 'design', 'xyz', 'online', 'site', 'blog', 'news', 'shop', 'store',
+  'us', 'uk', 'ca', 'au', 'de', 'fr', 'nl', 'es', 'it', 'jp', 'cn', 'in', 'br', 'ru', 'eu', 'ly', 'gl', 'be', 'fm'
+)
+URL_PATTERN = re.compile(
+  r'(?:https?://|www\.)\S+'
+  r'|\b(?:[\w-]+\.)+(?:' + '|'.join(URL_TLDS) + r')\b(?![\w-]|\.\w)(?:/\S*)?',
+  re.IGNORECASE
+)
+
+# code points X counts once, everything else (CJK, emoji, ...) counts twice
+X_LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+
+HASHTAG_PATTERN = re.compile(r'(?:^|\s)#\w+')
+
+#================================================================
+
+def weightedLength(text):
+  # X's weighted length. Emoji sequences are counted per code point,
+  # which can only overestimate, so a caption that fits here fits on X
+  text = unicodedata.normalize('NFC', text)
+  length = 0
+  position = 0
+
+  for match in URL_PATTERN.finditer(text):
+    length += codePointWeight(text[position:match.start()]) + X_URL_LENGTH
+    position = match.end()
+
+  return length + codePointWeight(text[position:])
+
+def codePointWeight(text):
+  return sum(
+    1 if any(low <= ord(character) <= high for low, high in X_LIGHT_RANGES) else 2
+    for character in text
+  )
+
+def captionLength(text, platform):
+  return weightedLength(text) if platform == Platform.X else len(text)
+
+def hashtagCount(text):
+  return len(HASHTAG_PATTERN.findall(text))
+
+def fits(text, platform):
+  limits = CAPTION_LIMITS[platform]
+  return captionLength(text, platform) <= limits['length'] and (
+    limits['hashtags'] is None or hashtagCount(text) <= limits['hashtags']
+  )
+
+def truncate(text, length):
+  return text if length >= len(text) else text[:length].rstrip() + '…'
+
+#================================================================
+
+def fitCaption(platform, render, body, tags):
+  # render(body, tags) builds the caption from a body and a space separated tag string.
+  # Returns the longest caption that fits, or None if even an empty body doesn't.
+  tags = list(tags)
+
+  while not fits(caption := render(body, ' '.join(tags)), platform) and tags:
+    tags.pop()
+
+  if fits(caption, platform):
+    return caption
+
+  # the longest body that fits, found by bisecting its length
+  fitted = None
+  low, high = 0, len(body)
+
+  while low <= high:
+    middle = (low + high) // 2
+    if fits(candidate := render(truncate(body, middle), ''), platform):
+      fitted = candidate
+      low = middle + 1
+    else:
+      high = middle - 1
+
+  if fitted is None:
+    logging.warning(f"fitCaption() - caption doesn't fit on { platform.value } even without a body")
+  else:
+    logging.debug(f"fitCaption() - trimmed caption body to fit on { platform.value }")
+
+  return fitted
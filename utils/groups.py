@@ -0,0 +1,70 @@
+# The groups collection indexes group membership for carousels and multi image posts.
+# Each document is one group: { _id: <group>, members: [{ filename, groupList,
+# lastXXPost..., accountPosts }] }, just enough to check cool downs without
+# reading the members' full media documents. It's rebuilt from the media
+# collection by utils/update.py after every import, and markPosted (see
+# selection.py) keeps the members' timestamps up to date between imports.
+# A group that isn't in the collection yet, e.g. before update.py first runs on an
+# existing database, is read from the media collection's groupList index instead.
+# ref: https://www.mongodb.com/docs/manual/reference/operator/aggregation/out/
+
+import logging
+import random
+
+# Imports the shared helpers
+from selection import LAST_POST_FIELDS, MEDIA_PROJECTION, postable
+
+# The fields kept for each member of a group
+GROUP_MEMBER_FIELDS = ['filename', 'groupList', 'accountPosts', *LAST_POST_FIELDS.values()]
+
+#================================================================
+
+def rebuildGroups(mongo_db):
+  # replaces the groups collection in one aggregation, groups with no members left disappear
+  mongo_db['media'].aggregate([
+    { '$match': { 'groupList.0': { '$exists': True } } },
+    { '$project': { '_id': 0, 'group': '$groupList', **{ field: 1 for field in GROUP_MEMBER_FIELDS } } },
+    { '$unwind': '$group' },
+    { '$group': {
+      '_id': '$group',
+      'members': { '$push': { field: f'${ field }' for field in GROUP_MEMBER_FIELDS } }
+    } },
+    { '$out': 'groups' }
+  ])
+  count = mongo_db['groups'].count_documents({})
+  logging.info(f"rebuildGroups() - { count } groups")
+  return count
+
+def eligibleGroupMembers(mongo_db, group, exclude, field, evaluator, k=None, catalog=None, platform=None):
+  # The members of group that have cooled down on field, except the filenames in exclude,
+  # as full media documents in random order. k limits how many are returned.
+  # evaluator is a CooldownEvaluator, see cooldown.py
+  # Members scan.py found broken are left out, and with platform, the ones preflight.py
+  # found platform won't accept.
+  exclude = set(exclude)
+
+  if catalog:
+    members = [member for member in catalog.eligibleInGroup(group, field, evaluator, platform=platform) if member['filename'] not in exclude]
+    return random.sample(members, len(members) if k is None else min(k, len(members)))
+
+  if not (document := mongo_db['groups'].find_one({ '_id': group })):
+    # not indexed yet (the groups collection is built by utils/update.py), read the members from media instead
+    logging.warning(f"eligibleGroupMembers() - group { repr(group) } isn't indexed, reading it from media, run utils/update.py")
+    members = [
+      member for member in evaluator.filter(mongo_db['media'].find({ 'groupList': group }, MEDIA_PROJECTION), field)
+      if member['filename'] not in exclude and postable(member, platform)
+    ]
+    return random.sample(members, len(members) if k is None else min(k, len(members)))
+
+  members = [member for member in evaluator.filter(document['members'], field) if member['filename'] not in exclude]
+  chosen = [member['filename'] for member in random.sample(members, len(members) if k is None else min(k, len(members)))]
+
+  if not chosen:
+    return []
+
+  # keep the random order of the sample
+  documents = { document['filename']: document for document in mongo_db['media'].find({ 'filename': { '$in': chosen } }, MEDIA_PROJECTION) }
+  return [
+    documents[filename] for filename in chosen
+    if filename in documents and postable(documents[filename], platform)
+  ]
@@ -0,0 +1,223 @@
+# A shared HTTP client for the bots.
+# Keeps a pooled keep-alive session per host, retries 429 and 5xx responses with
+# jittered exponential backoff, reads the platform rate limit headers to pause
+# an endpoint before its limit is hit, and records the latency of each endpoint.
+# No wait is longer than max_backoff. When a server asks for longer, the 429 is
+# returned (or RateLimitError raised) so the caller can try again later instead
+# of holding its claims and leases while it sleeps.
+# ref: https://developer.x.com/en/docs/x-api/rate-limits
+# ref: https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Meta reports usage as a percentage of the limit for each of these
+META_USAGE_HEADERS = ('X-App-Usage', 'X-Ad-Account-Usage', 'X-Business-Use-Case-Usage')
+
+#================================================================
+
+class RateLimitError(requests.RequestException):
+  # raised instead of waiting longer than max_backoff for an endpoint's limit to reset
+  pass
+
+#================================================================
+
+class HttpClient:
+
+  def __init__(self, retries=None, backoff=1.0, max_backoff=60.0, pool_maxsize=None, usage_threshold=90.0, usage_pause=60.0, timeout=None):
+    # retries, pool_maxsize and timeout default to the HTTP_RETRIES, HTTP_POOL_SIZE and HTTP_TIMEOUT settings
+    self.retries = retries
+    # seconds to wait for a connection or a response, so a stalled request is retried instead of hanging its thread
+    self.timeout = timeout
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.pool_maxsize = pool_maxsize
+    # pause requests to a Meta host for usage_pause seconds once usage reaches usage_threshold percent
+    self.usage_threshold = usage_threshold
+    self.usage_pause = usage_pause
+
+    self.lock = threading.Lock()
+    self.sessions = {}
+    self.paused_until = {}
+    self.stats = {}
+
+  #================================================================
+
+  def readSettings(self):
+    # Settings are read on first use rather than on import.
+    # python-decouple only loads the .env found next to the first module that
+    # reads a setting, and that should be the bot, not this module.
+    if self.retries is None:
+      self.retries = config('HTTP_RETRIES', cast=int, default=3)
+    if self.pool_maxsize is None:
+      self.pool_maxsize = config('HTTP_POOL_SIZE', cast=int, default=10)
+    if self.timeout is None:
+      self.timeout = config('HTTP_TIMEOUT', cast=float, default=30.0)
+
+  def session(self, host):
+    with self.lock:
+      if host not in self.sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.sessions[host] = session
+      return self.sessions[host]
+
+  def request(self, method, url, idempotent=None, **kwargs):
+    # POSTs are only retried on 429 unless the caller says they're safe to repeat
+    if idempotent is None:
+      idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    self.readSettings()
+    kwargs.setdefault('timeout', self.timeout)
+
+    parts = urlsplit(url)
+    endpoint = f"{ method.upper() } { parts.netloc }{ endpointPath(parts.path) }"
+
+    for attempt in range(self.retries + 1):
+      self.throttle(endpoint)
+
+      start = time.monotonic()
+      try:
+        response = self.session(parts.netloc).request(method, url, **kwargs)
+      except (requests.ConnectionError, requests.Timeout):
+        self.record(endpoint, time.monotonic() - start, None)
+        if not idempotent or attempt == self.retries:
+          raise
+        time.sleep(self.retryDelay(None, attempt))
+        continue
+
+      self.record(endpoint, time.monotonic() - start, response.status_code)
+      self.readRateLimits(endpoint, response)
+
+      retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+      if not retryable or attempt == self.retries:
+        return response
+
+      if (delay := self.retryDelay(response, attempt)) is None:
+        logging.warning(f"{ endpoint } returned { response.status_code }, not retrying before its limit resets")
+        return response
+      logging.warning(f"{ endpoint } returned { response.status_code }, retrying in {delay:.1f}s")
+      response.close()
+      time.sleep(delay)
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def delete(self, url, **kwargs):
+    return self.request('DELETE', url, **kwargs)
+
+  #================================================================
+  # Retries and rate limits
+
+  def retryDelay(self, response, attempt):
+    # None when the server wants us to wait longer than max_backoff
+    if response is not None:
+      # honor the server when it says how long to wait
+      delay = None
+      if (retry_after := response.headers.get('Retry-After', '')).isdigit():
+        delay = float(retry_after)
+      elif response.status_code == 429 and (reset := response.headers.get('x-rate-limit-reset', '')).isdigit():
+        delay = max(0.0, float(reset) - time.time())
+      if delay is not None:
+        return delay if delay <= self.max_backoff else None
+
+    # "full jitter" exponential backoff
+    # ref: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+  def readRateLimits(self, endpoint, response):
+    # X's limits are per endpoint, so pauses are too
+    paused_until = 0.0
+
+    # X: requests left in the current window and when the window resets
+    if response.headers.get('x-rate-limit-remaining') == '0':
+      if (reset := response.headers.get('x-rate-limit-reset', '')).isdigit():
+        paused_until = float(reset)
+
+    # Meta: percentage of the app/page/business usage limits consumed
+    for header in META_USAGE_HEADERS:
+      if (usage := response.headers.get(header)) and metaUsage(usage) >= self.usage_threshold:
+        paused_until = max(paused_until, time.time() + self.usage_pause)
+
+    if paused_until > time.time():
+      logging.warning(f"rate limit nearly reached for { endpoint }, pausing requests for {paused_until - time.time():.0f}s")
+      with self.lock:
+        self.paused_until[endpoint] = max(self.paused_until.get(endpoint, 0.0), paused_until)
+
+  def throttle(self, endpoint):
+    with self.lock:
+      delay = self.paused_until.get(endpoint, 0.0) - time.time()
+    if delay > self.max_backoff:
+      raise RateLimitError(f"{ endpoint } is rate limited for another {delay:.0f}s")
+    if delay > 0:
+      time.sleep(delay)
+
+  #================================================================
+  # Latency stats
+
+  def record(self, endpoint, elapsed, status_code):
+    with self.lock:
+      stats = self.stats.setdefault(endpoint, { 'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0 })
+      stats['count'] += 1
+      stats['total'] += elapsed
+      stats['max'] = max(stats['max'], elapsed)
+      if status_code is None or status_code >= 400:
+        stats['errors'] += 1
+
+  def latencyStats(self):
+    with self.lock:
+      return {
+        endpoint: {
+          'count': stats['count'],
+          'errors': stats['errors'],
+          'mean': stats['total'] / stats['count'],
+          'max': stats['max']
+        }
+        for endpoint, stats in self.stats.items()
+      }
+
+#================================================================
+
+def endpointPath(path):
+  # collapse ids so stats are grouped by endpoint, e.g. /v20.0/1784.../media -> /v20.0/{id}/media
+  return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+def metaUsage(header):
+  # X-App-Usage is a flat object, X-Business-Use-Case-Usage maps ids to lists of objects
+  try:
+    usage = json.loads(header)
+  except ValueError:
+    return 0.0
+
+  if isinstance(usage, dict) and usage and all(isinstance(value, list) for value in usage.values()):
+    usage = [entry for entries in usage.values() for entry in entries]
+  else:
+    usage = [usage]
+
+  return max(
+    [float(value) for entry in usage for key, value in entry.items() if key in ('call_count', 'total_cputime', 'total_time')] or [0.0]
+  )
+
+#================================================================
+
+# The client shared by everything in the process
+client = HttpClient()
@@ -0,0 +1,194 @@
+# An on-disk cache of the images the bots download, shared by every bot on the machine.
+# Images are stored once under the sha256 of their content. Each url has a small
+# entry pointing at its image along with the ETag and Last-Modified from the
+# origin, so a cached image is revalidated with a conditional GET and only
+# downloaded again if it changed. Least recently used images are evicted once the
+# cache grows past max_bytes. Reads are memory-mapped, so the upload path never
+# copies the whole image into memory.
+# Entries are written with os.replace, so bots in separate processes can share it.
+# ref: https://developer.mozilla.org/en-US/docs/Web/HTTP/Caching#validation
+
+from contextlib import contextmanager, suppress
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# Imports the shared helpers
+from http_client import client
+
+#================================================================
+
+class ImageCache:
+
+  def __init__(self, directory=None, max_bytes=None, fresh_seconds=None):
+    # default to the IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB and IMAGE_CACHE_FRESH_SECONDS settings
+    self.directory = directory
+    self.max_bytes = max_bytes
+    # how long a cached image is used without asking the origin if it changed
+    self.fresh_seconds = fresh_seconds
+    self.lock = threading.Lock()
+
+  def readSettings(self):
+    # read on first use rather than on import, see HttpClient.readSettings
+    if self.directory is None:
+      self.directory = config('IMAGE_CACHE_DIR', cast=str, default=os.path.join(tempfile.gettempdir(), 'philbots-image-cache'))
+    if self.max_bytes is None:
+      self.max_bytes = config('IMAGE_CACHE_MAX_MB', cast=float, default=512.0) * 1024 * 1024
+    if self.fresh_seconds is None:
+      self.fresh_seconds = config('IMAGE_CACHE_FRESH_SECONDS', cast=float, default=300.0)
+
+    os.makedirs(os.path.join(self.directory, 'entries'), exist_ok=True)
+    os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+
+  #----------------------------------------------------------------
+  # Entries and objects
+
+  def entryPath(self, url):
+    return os.path.join(self.directory, 'entries', hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+  def objectPath(self, digest):
+    return os.path.join(self.directory, 'objects', digest)
+
+  def readEntry(self, url):
+    try:
+      with open(self.entryPath(url)) as file:
+        entry = json.load(file)
+    except (OSError, ValueError):
+      return None
+    # the image may have been evicted by another process
+    return entry if os.path.isfile(self.objectPath(entry['object'])) else None
+
+  def writeEntry(self, url, entry):
+    path = self.entryPath(url)
+    with open(f'{ path }.{ os.getpid() }.{ threading.get_ident() }', 'w') as file:
+      json.dump(entry, file)
+    os.replace(file.name, path)
+
+  def touch(self, url, entry):
+    # the object's mtime is its last use, for LRU eviction
+    os.utime(self.objectPath(entry['object']))
+    entry['checkedAt'] = time.time()
+    self.writeEntry(url, entry)
+
+  #----------------------------------------------------------------
+
+  def fetch(self, url):
+    # returns the cache entry for url, downloading or revalidating as needed
+    self.readSettings()
+    entry = self.readEntry(url)
+
+    if entry and time.time() - entry['checkedAt'] < self.fresh_seconds:
+      os.utime(self.objectPath(entry['object']))
+      return entry
+
+    headers = {}
+    if entry and entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('lastModified'):
+      headers['If-Modified-Since'] = entry['lastModified']
+
+    with client.get(url, headers=headers, stream=True) as response:
+      if entry and response.status_code == 304:
+        logging.debug(f"ImageCache.fetch() - { url } not modified")
+        self.touch(url, entry)
+        return entry
+
+      if response.status_code != 200:
+        raise Exception(f"Failed to fetch image data. { response.status_code }")
+
+      # stream to a temporary file, hashing as we go
+      digest = hashlib.sha256()
+      size = 0
+      with tempfile.NamedTemporaryFile(dir=os.path.join(self.directory, 'objects'), prefix='.', delete=False) as file:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+          digest.update(chunk)
+          file.write(chunk)
+          size += len(chunk)
+      os.replace(file.name, self.objectPath(digest.hexdigest()))
+
+      entry = {
+        'url': url,
+        'object': digest.hexdigest(),
+        'size': size,
+        'contentType': response.headers.get('Content-Type', '').split(';')[0] or None,
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'checkedAt': time.time()
+      }
+
+    self.writeEntry(url, entry)
+    logging.debug(f"ImageCache.fetch() - cached { url } ({ size } bytes)")
+    self.evict()
+    return entry
+
+  @contextmanager
+  def mapped(self, entry):
+    # a read only memoryview of a fetched image, valid inside the with block
+    with open(self.objectPath(entry['object']), 'rb') as file:
+      if not entry['size']:
+        yield memoryview(b'')
+        return
+      with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+          yield view
+        finally:
+          view.release()
+
+  @contextmanager
+  def open(self, url):
+    # yields (entry, memoryview of the image) for url
+    entry = self.fetch(url)
+    with self.mapped(entry) as view:
+      yield entry, view
+
+  def evict(self):
+    # removes the least recently used images until the cache fits in max_bytes
+    with self.lock:
+      objects = {}
+      entries = {}
+
+      for name in os.listdir(os.path.join(self.directory, 'objects')):
+        if not name.startswith('.'):
+          with suppress(FileNotFoundError):
+            stat = os.stat(self.objectPath(name))
+            objects[name] = (stat.st_mtime, stat.st_size)
+
+      if (total := sum(size for _, size in objects.values())) <= self.max_bytes:
+        return 0
+
+      # the urls pointing at each image
+      for name in os.listdir(os.path.join(self.directory, 'entries')):
+        if name.endswith('.json'):
+          try:
+            with open(os.path.join(self.directory, 'entries', name)) as file:
+              entries.setdefault(json.load(file)['object'], []).append(name)
+          except (OSError, ValueError):
+            continue
+
+      evicted = 0
+      for digest, (_, size) in sorted(objects.items(), key=lambda item: item[1][0]):
+        if total <= self.max_bytes:
+          break
+        # another process may be evicting at the same time
+        with suppress(FileNotFoundError):
+          for name in entries.get(digest, []):
+            os.remove(os.path.join(self.directory, 'entries', name))
+          os.remove(self.objectPath(digest))
+        total -= size
+        evicted += 1
+
+      logging.debug(f"ImageCache.evict() - evicted { evicted } image(s)")
+      return evicted
+
+# One cache for the whole process
+cache = ImageCache()
@@ -0,0 +1,320 @@
+# Helpers for importing a .tsv spreadsheet into the media collection.
+# The bulk import streams the spreadsheet in chunks and sends each chunk as a
+# single bulk_write of upserts, so there is no find_one before each write.
+# The sync import also keeps a hash of each row's fields on its entry, skips the
+# rows whose hash hasn't changed and only writes the fields that did, so running
+# it again on a mostly unchanged spreadsheet costs one read per chunk.
+# The row by row import is the default, it checks each row the same way before
+# its find_one and write.
+# The bulk and sync imports parse and validate the rows in a process pool a few
+# chunks ahead of the writes. Bad rows are skipped and reported, with the field and pydantic's error,
+# instead of stopping the import.
+# ref: https://pymongo.readthedocs.io/en/stable/examples/bulk.html
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+from itertools import islice
+import os
+import time
+from pydantic import ValidationError
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Imports MediaObject from models.py
+from models import MediaObject
+from selection import LAST_POST_FIELDS
+
+# lastXXPost values given to new entries
+LAST_POST_DEFAULTS = { field: 0.0 for field in LAST_POST_FIELDS.values() }
+
+# The fields that come from the spreadsheet
+SHEET_FIELDS = [field for field in MediaObject.model_fields if field not in LAST_POST_DEFAULTS]
+
+# The columns holding JSON lists
+JSON_FIELDS = ('tagList', 'groupList', 'captionList')
+
+#================================================================
+
+def formatRow(row, media_base_url):
+  # This step pre-formats some of the data we know that we want to store
+  # the JSON columns have already been decoded by readRow
+  row.update({
+    "projectURL": row['projectURL'] if row.get('projectURL') else None,
+    "url": f"{media_base_url}/{row['filename']}",
+    **{ field: row.get(field, []) for field in JSON_FIELDS }
+  })
+  return row
+
+def chunked(iterable, size):
+  # yields lists of up to size items without reading the whole iterable
+  iterator = iter(iterable)
+  while (chunk := list(islice(iterator, size))):
+    yield chunk
+
+def sheetDocument(row, media_base_url):
+  # the validated spreadsheet fields of a row read by readRow, as they're stored
+  document = MediaObject(**{ **LAST_POST_DEFAULTS, **formatRow(dict(row), media_base_url) }).model_dump(mode="json")
+  return { field: document[field] for field in SHEET_FIELDS }
+
+#================================================================
+# Parsing
+
+def rowError(number, filename, field, message, error_type):
+  # one line of the error report
+  return { 'row': number, 'filename': filename, 'field': field, 'message': message, 'type': error_type }
+
+def readRow(number, row):
+  # returns (a copy of the row with the JSON columns decoded, the reasons it can't be imported)
+  # row numbers count the header as row 1
+  filename = row.get('filename')
+  if not filename:
+    return row, [rowError(number, filename, 'filename', 'Row is missing a filename', 'missing')]
+
+  row = dict(row)
+  errors = []
+  for field in JSON_FIELDS:
+    try:
+      if field in row:
+        row[field] = json.loads(row[field])
+    except (TypeError, ValueError) as e:
+      errors.append(rowError(number, filename, field, str(e), 'json_invalid'))
+  return row, errors
+
+def parseChunk(numbered_rows, media_base_url):
+  # runs in a worker process, returns (documents, errors) for a list of (row number, row)
+  documents = []
+  errors = []
+
+  for number, row in numbered_rows:
+    row, found = readRow(number, row)
+    if found:
+      errors += found
+      continue
+    try:
+      documents.append(sheetDocument(row, media_base_url))
+    except ValidationError as e:
+      errors += [
+        rowError(number, row['filename'], '.'.join(str(part) for part in error['loc']), error['msg'], error['type'])
+        for error in e.errors()
+      ]
+
+  return documents, errors
+
+def parseRows(rows, media_base_url, batch_size=1000, workers=None):
+  # yields (rows read, documents, errors) for each chunk of rows, in order
+  chunks = chunked(enumerate(rows, start=2), batch_size)
+  workers = workers or os.cpu_count()
+
+  if workers == 1:
+    for chunk in chunks:
+      yield len(chunk), *parseChunk(chunk, media_base_url)
+    return
+
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    # keep a couple of chunks per worker in flight rather than reading the whole file
+    pending = deque()
+    for chunk in chunks:
+      pending.append((len(chunk), executor.submit(parseChunk, chunk, media_base_url)))
+      if len(pending) >= 2 * workers:
+        count, future = pending.popleft()
+        yield count, *future.result()
+    while pending:
+      count, future = pending.popleft()
+      yield count, *future.result()
+
+def reportErrors(errors, error_report=None):
+  # prints the errors and writes them to error_report (an open file) as JSON lines, returns the number of bad rows
+  for error in errors:
+    print(f"Invalid row { error['row'] } for { error['filename'] }: { error['field'] }: { error['message'] }")
+    if error_report:
+      error_report.write(json.dumps(error) + '\n')
+  return len({ error['row'] for error in errors })
+
+#================================================================
+
+def upsertOperation(document):
+  # The lastXXPost fields are written with $setOnInsert so existing entries keep their post history.
+  return UpdateOne(
+    filter={ 'filename': document['filename'] },
+    # the row hash is only kept up to date by syncImport
+    update={ '$set': { **document, 'updatedAt': time.time() }, '$setOnInsert': LAST_POST_DEFAULTS, '$unset': { 'rowHash': '' } },
+    upsert=True
+  )
+
+def bulkImport(mongo_db, rows, media_base_url, batch_size=1000, ordered=True, workers=None, error_report=None):
+  summary = { 'rows': 0, 'invalid': 0, 'matched': 0, 'modified': 0, 'upserted': 0, 'errors': 0 }
+
+  for count, documents, errors in parseRows(rows, media_base_url, batch_size, workers):
+    summary['rows'] += count
+    summary['invalid'] += reportErrors(errors, error_report)
+    operations = [upsertOperation(document) for document in documents]
+
+    if not operations:
+      continue
+
+    try:
+      result = mongo_db['media'].bulk_write(operations, ordered=ordered).bulk_api_result
+    except BulkWriteError as e:
+      # in ordered mode the batch stops at the first error, unordered carries on
+      result = e.details
+      for error in result['writeErrors']:
+        print(f"Write error at batch index {error['index']}: {error['errmsg']}")
+
+    summary['matched'] += result['nMatched']
+    summary['modified'] += result['nModified']
+    summary['upserted'] += result['nUpserted']
+    summary['errors'] += len(result['writeErrors'])
+    print(f"batch of {len(operations)}: matched: {result['nMatched']}, modified: {result['nModified']}, upserted: {result['nUpserted']}")
+
+    if ordered and result['writeErrors']:
+      print("Stopping import after write error (ordered mode)")
+      break
+
+  return summary
+
+#================================================================
+# Row by row
+
+def rowImport(mongo_db, rows, media_base_url, error_report=None):
+  # the default import, one find_one and one write per row
+  summary = { 'rows': 0, 'invalid': 0, 'updated': 0, 'inserted': 0 }
+
+  # numbered like the spreadsheet
+  for number, row in enumerate(rows, start=2):
+    summary['rows'] += 1
+    # Skip the row if it's missing a filename or doesn't validate
+    documents, errors = parseChunk([(number, row)], media_base_url)
+    if errors:
+      summary['invalid'] += reportErrors(errors, error_report)
+      continue
+    document = documents[0]
+
+    # Look for an entry matching this query
+    query = { 'filename': document['filename'] }
+
+    # If there an entry for the given filename, update it
+    # Only the spreadsheet fields are set, so the lastXXPost fields keep their post history
+    if (find_result := mongo_db['media'].find_one(query, { 'filename': 1 })):
+      print(f"found mediaObject ID: { str(find_result['_id']) }, filename: { find_result['filename'] }")
+      update_result = mongo_db['media'].update_one(
+        filter=query,
+        update={ '$set': { **document, 'updatedAt': time.time() }, '$unset': { 'rowHash': '' } }
+      )
+      print(f"documents matched: { update_result.matched_count }, documents modified: { update_result.modified_count }")
+      summary['updated'] += 1
+      continue
+
+    # There wasn't a matching entry for the filename query, insert it with no post history
+    media_object_id = mongo_db['media'].insert_one({ **LAST_POST_DEFAULTS, **document, 'updatedAt': time.time() }).inserted_id
+    print(f"Entry for { document['filename'] } created. ID: { media_object_id }")
+    summary['inserted'] += 1
+
+  return summary
+
+#================================================================
+# Sync
+
+def rowHash(document):
+  return hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()
+
+def syncOperation(document, existing, now):
+  # returns (operation or None, the names of the changed fields or None for a new entry)
+  digest = rowHash(document)
+
+  if existing is None:
+    return UpdateOne(
+      filter={ 'filename': document['filename'] },
+      update={ '$set': { **document, 'rowHash': digest, 'updatedAt': now }, '$setOnInsert': LAST_POST_DEFAULTS },
+      upsert=True
+    ), None
+
+  if existing.get('rowHash') == digest and not existing.get('removedAt'):
+    return None, []
+
+  # entries written before there was a hash are compared field by field
+  changed = [field for field in SHEET_FIELDS if existing.get(field) != document[field]]
+  update = { '$set': { **{ field: document[field] for field in changed }, 'rowHash': digest } }
+  if changed or existing.get('removedAt'):
+    update['$set']['updatedAt'] = now
+  if existing.get('removedAt'):
+    # back in the spreadsheet
+    update['$unset'] = { 'removedAt': '' }
+    changed.append('removedAt')
+
+  return UpdateOne({ '_id': existing['_id'] }, update), changed
+
+def syncImport(mongo_db, rows, media_base_url, batch_size=1000, prune=None, dry_run=False, workers=None, error_report=None):
+  # prune is None to leave entries missing from the spreadsheet alone,
+  # 'flag' to set removedAt on them so the bots skip them, or 'delete'
+  report = {
+    'summary': { 'rows': 0, 'invalid': 0, 'unchanged': 0, 'added': 0, 'changed': 0, 'removed': 0 },
+    'added': [],
+    'changed': {},
+    'removed': []
+  }
+  summary = report['summary']
+  seen = set()
+  now = time.time()
+
+  for count, parsed, errors in parseRows(rows, media_base_url, batch_size, workers):
+    summary['rows'] += count
+    summary['invalid'] += reportErrors(errors, error_report)
+    documents = { document['filename']: document for document in parsed }
+    # bad rows are still in the spreadsheet, don't prune their entries
+    seen.update(documents, (error['filename'] for error in errors if error['filename']))
+
+    # one read for the chunk, only the stored spreadsheet fields
+    existing = {
+      document['filename']: document
+      for document in mongo_db['media'].find(
+        { 'filename': { '$in': list(documents) } },
+        { **{ field: 1 for field in SHEET_FIELDS }, 'rowHash': 1, 'removedAt': 1 }
+      )
+    }
+
+    operations = []
+    for filename, document in documents.items():
+      operation, changed = syncOperation(document, existing.get(filename), now)
+      if changed is None:
+        summary['added'] += 1
+        report['added'].append(filename)
+      elif changed:
+        summary['changed'] += 1
+        report['changed'][filename] = changed
+      else:
+        summary['unchanged'] += 1
+      if operation:
+        operations.append(operation)
+
+    if operations and not dry_run:
+      mongo_db['media'].bulk_write(operations, ordered=False)
+
+  if prune:
+    # the whole collection's filenames, a small projection even for big catalogs
+    missing = []
+    for document in mongo_db['media'].find({} if prune == 'delete' else { 'removedAt': None }, { 'filename': 1 }):
+      if document['filename'] not in seen:
+        missing.append(document['_id'])
+        report['removed'].append(document['filename'])
+    summary['removed'] = len(missing)
+
+    if missing and not dry_run:
+      mongo_db['media'].bulk_write([
+        DeleteMany({ '_id': { '$in': batch } }) if prune == 'delete'
+        else UpdateMany({ '_id': { '$in': batch } }, { '$set': { 'removedAt': now, 'updatedAt': now } })
+        for batch in chunked(missing, batch_size)
+      ], ordered=False)
+
+  return report
+
+def printReport(report):
+  # a diff of the spreadsheet against the media collection
+  for filename in report['added']:
+    print(f"+ { filename }")
+  for filename, fields in report['changed'].items():
+    print(f"~ { filename }: { ', '.join(fields) }")
+  for filename in report['removed']:
+    print(f"- { filename }")
+  print(f"summary: { report['summary'] }")
@@ -0,0 +1,127 @@
+# This script declares the indexes the bots rely on and makes sure they exist.
+# Running it again is harmless: indexes that already exist are left as they are.
+# It then asks MongoDB to explain each of the queries the bots make and reports
+# any query that would fall back to a full collection scan.
+# ref: https://www.mongodb.com/docs/manual/indexes/
+
+import argparse
+from pymongo import ASCENDING, IndexModel
+
+# Imports the shared helpers
+from db import getMongoDatabase
+from enums import Platform
+from selection import LAST_POST_FIELDS, eligibleQuery
+
+# The indexes on the media collection
+# NOTE: groupList holds an array, so MongoDB builds a multikey index for it
+MEDIA_INDEXES = [
+  IndexModel([('filename', ASCENDING)], name='filename_unique', unique=True),
+  IndexModel([('groupList', ASCENDING)], name='groupList'),
+  # polled by catalogs when change streams aren't available, see catalog.py
+  IndexModel([('updatedAt', ASCENDING)], name='updatedAt'),
+  *[
+    IndexModel([('type', ASCENDING), (field, ASCENDING)], name=f'type_{field}')
+    for field in LAST_POST_FIELDS.values()
+  ]
+]
+
+# The indexes on the groups collection, see groups.py
+# NOTE: groups are looked up by _id, this one is for keeping member timestamps up to date
+GROUP_INDEXES = [
+  IndexModel([('members.filename', ASCENDING)], name='members_filename')
+]
+
+# The indexes on the jobs collection, see jobs.py
+# NOTE: the unique idempotencyKey is what stops the same job being queued twice
+JOB_INDEXES = [
+  IndexModel([('idempotencyKey', ASCENDING)], name='idempotencyKey_unique', unique=True),
+  IndexModel([('state', ASCENDING), ('nextAttemptAt', ASCENDING)], name='state_nextAttemptAt')
+]
+
+COLLECTION_INDEXES = {
+  'media': MEDIA_INDEXES,
+  'groups': GROUP_INDEXES,
+  'jobs': JOB_INDEXES
+}
+
+#================================================================
+
+def ensureIndexes(mongo_db):
+  created = []
+
+  for collection, indexes in COLLECTION_INDEXES.items():
+    existing = mongo_db[collection].index_information()
+    missing = [index for index in indexes if index.document['name'] not in existing]
+
+    for index in missing:
+      print(f"creating index: { collection }.{ index.document['name'] } { dict(index.document['key']) }")
+
+    if missing:
+      mongo_db[collection].create_indexes(missing)
+
+    created += [index.document['name'] for index in missing]
+
+  return created
+
+#================================================================
+
+def botQueries():
+  # representative versions of the queries made by the bots and utils/update.py
+  queries = {
+    f'eligible {platform.value}': eligibleQuery(platform, 7.0)
+    for platform in (Platform.INSTAGRAM, Platform.X, Platform.FACEBOOK)
+  }
+  queries.update({
+    'filename lookup': { 'filename': 'example.jpg' },
+    'group expansion': { 'groupList': { '$eq': 'example' } }
+  })
+  return queries
+
+def planStages(plan):
+  # walk the winning plan and collect every stage name in it
+  # NOTE: plans from the slot based engine nest the stages under 'queryPlan'
+  stages = [plan['stage']] if 'stage' in plan else []
+  for child in plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+    stages += planStages(child)
+  return stages
+
+def checkQueries(mongo_db):
+  unindexed = []
+
+  for name, query in botQueries().items():
+    explanation = mongo_db['media'].find(query).explain()
+    stages = planStages(explanation['queryPlanner']['winningPlan'])
+
+    if 'COLLSCAN' in stages:
+      unindexed.append(name)
+      print(f"NOT INDEXED - { name }: { query }")
+    else:
+      print(f"ok - { name }: { ' <- '.join(stages) }")
+
+  return unindexed
+
+#================================================================
+# Executed while run as a script
+
+if __name__ == '__main__':
+
+  try:
+    parser = argparse.ArgumentParser(
+      prog='Media Indexes',
+      description='Ensures the media collection indexes exist and checks the bot queries use them'
+    )
+    parser.add_argument('--check-only', action='store_true', help="don't create missing indexes")
+    args = parser.parse_args()
+
+    mongo_db = getMongoDatabase()
+
+    if not args.check_only:
+      print(f"created { len(ensureIndexes(mongo_db)) } missing index(es)")
+
+    if (unindexed := checkQueries(mongo_db)):
+      print(f"{ len(unindexed) } bot quer(y/ies) not using an index: { unindexed }")
+
+  except Exception as e:
+    print(f"Oops! {repr(e)}")
+  finally:
+    exit()
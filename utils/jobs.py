@@ -0,0 +1,164 @@
+# A durable queue of post jobs in the jobs collection (an outbox).
+# Instead of a failed post being lost until the next cron tick, a job is retried
+# with exponential backoff until it's published or runs out of attempts.
+# Delivery is at least once: a job whose worker died mid post is picked up again
+# once its lease expires.
+#
+# Each job has an idempotencyKey, so enqueueing the same slot twice (say two
+# schedulers ticking at once) only queues one job. Workers claim jobs with
+# find_one_and_update, so any number of them can drain the queue concurrently.
+# Everything used here is supported by mongomock as well as mongod, see tests/test_jobs.py.
+
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Imports the shared helpers
+from enums import JobState
+
+# states a job can still make progress from
+ACTIVE_STATES = [JobState.PENDING.value, JobState.UPLOADING.value, JobState.CONTAINER_READY.value]
+
+#================================================================
+
+def jobKey(platform, account_name=None, slot=None):
+  # one job per platform, account and minute
+  slot = time.time() if slot is None else slot
+  return f"{ platform.value }:{ account_name or 'default' }:{ int(slot // 60) }"
+
+def enqueueJob(mongo_db, platform, account_name=None, key=None, run_at=None, max_attempts=5, now=None):
+  # returns the job's idempotencyKey, or None if a job with that key was already queued
+  now = time.time() if now is None else now
+  key = key or jobKey(platform, account_name, now)
+
+  try:
+    result = mongo_db['jobs'].update_one(
+      { 'idempotencyKey': key },
+      { '$setOnInsert': {
+        'idempotencyKey': key,
+        'platform': platform.value,
+        'account': account_name,
+        'state': JobState.PENDING.value,
+        'attempts': 0,
+        'maxAttempts': max_attempts,
+        'nextAttemptAt': now if run_at is None else run_at,
+        'createdAt': now,
+        'updatedAt': now
+      } },
+      upsert=True
+    )
+  except DuplicateKeyError:
+    # another process inserted the same key between our filter and insert
+    return None
+
+  if not result.upserted_id:
+    logging.info(f"enqueueJob() - { key } is already queued")
+    return None
+
+  logging.info(f"enqueueJob() - queued { key }")
+  return key
+
+def claimJob(mongo_db, worker, lease_seconds=900.0, now=None):
+  # the job that has been due the longest, leased to worker, or None
+  now = time.time() if now is None else now
+
+  return mongo_db['jobs'].find_one_and_update(
+    {
+      'state': { '$in': ACTIVE_STATES },
+      'nextAttemptAt': { '$lte': now },
+      # $not also matches jobs that were never leased
+      'leaseUntil': { '$not': { '$gt': now } }
+    },
+    {
+      '$set': { 'worker': worker, 'leaseUntil': now + lease_seconds, 'updatedAt': now },
+      '$inc': { 'attempts': 1 }
+    },
+    sort=[('nextAttemptAt', 1)],
+    return_document=ReturnDocument.AFTER
+  )
+
+def setJobState(mongo_db, job, state, **fields):
+  # only the worker holding the job may move it on
+  return mongo_db['jobs'].update_one(
+    { '_id': job['_id'], 'worker': job['worker'] },
+    { '$set': { 'state': state.value, 'updatedAt': time.time(), **fields } }
+  ).modified_count == 1
+
+def retryDelay(attempts, backoff=60.0, max_backoff=3600.0):
+  # exponential backoff with full jitter, like HttpClient.retryDelay
+  return random.uniform(0, min(max_backoff, backoff * 2 ** (attempts - 1)))
+
+def finishJob(mongo_db, job, result=None):
+  return mongo_db['jobs'].update_one(
+    { '_id': job['_id'], 'worker': job['worker'] },
+    {
+      '$set': {
+        'state': JobState.PUBLISHED.value,
+        'result': result if isinstance(result, (str, dict)) else repr(result),
+        'updatedAt': time.time()
+      },
+      '$unset': { 'leaseUntil': '' }
+    }
+  )
+
+def failJob(mongo_db, job, error, backoff=60.0, max_backoff=3600.0, now=None):
+  # schedules another attempt, or gives up after maxAttempts
+  now = time.time() if now is None else now
+  update = { 'lastError': error, 'updatedAt': now }
+
+  if job['attempts'] >= job['maxAttempts']:
+    update['state'] = JobState.FAILED.value
+    logging.error(f"failJob() - { job['idempotencyKey'] } failed after { job['attempts'] } attempts: { error }")
+  else:
+    update['nextAttemptAt'] = now + retryDelay(job['attempts'], backoff, max_backoff)
+    logging.warning(f"failJob() - { job['idempotencyKey'] } attempt { job['attempts'] } failed, retrying in {update['nextAttemptAt'] - now:.0f}s: { error }")
+
+  return mongo_db['jobs'].update_one(
+    { '_id': job['_id'], 'worker': job['worker'] },
+    { '$set': update, '$unset': { 'leaseUntil': '' } }
+  )
+
+#================================================================
+
+def runJob(mongo_db, job, handler, backoff=60.0, max_backoff=3600.0):
+  # handler(job, progress) posts the job and returns a result, falsy or raising means it failed
+  # progress(state, **fields) records how far the post got
+  try:
+    if job['state'] == JobState.PENDING.value:
+      setJobState(mongo_db, job, JobState.UPLOADING)
+
+    progress = lambda state, **fields: setJobState(mongo_db, job, state, **fields)
+
+    if not (result := handler(job, progress)):
+      raise Exception('post failed')
+
+    finishJob(mongo_db, job, result)
+    logging.info(f"runJob() - { job['idempotencyKey'] } published")
+    return result
+
+  except Exception as e:
+    failJob(mongo_db, job, repr(e), backoff, max_backoff)
+    return None
+
+def drainJobs(mongo_db, handler, workers=4, poll_seconds=5.0, lease_seconds=900.0, backoff=60.0, max_backoff=3600.0, stopping=None):
+  # runs workers threads that claim and run jobs until stopping is set
+  stopping = stopping or threading.Event()
+
+  def work(number):
+    worker = f'{ socket.gethostname() }-{ os.getpid() }-{ number }'
+    while not stopping.is_set():
+      if not (job := claimJob(mongo_db, worker, lease_seconds)):
+        stopping.wait(poll_seconds)
+        continue
+      logging.info(f"drainJobs() - { worker } running { job['idempotencyKey'] } (attempt { job['attempts'] })")
+      runJob(mongo_db, job, handler, backoff, max_backoff)
+
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job') as executor:
+    for future in [executor.submit(work, number) for number in range(workers)]:
+      future.result()
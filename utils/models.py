@@ -1,6 +1,6 @@
-# Imports MediaType from enums.py
-from enums import MediaType
-from pydantic import BaseModel, HttpUrl
+# Imports MediaType and Platform from enums.py
+from enums import MediaType, Platform
+from pydantic import BaseModel, Field, HttpUrl
 
 # MediaObject is a subclass of pydantic's BaseModel.
 # This model defines how media is structured in the database.
@@ -25,3 +25,22 @@ class MediaObject(BaseModel):
   tagList : list[str] = []
   groupList : list[str] = []
   captionList : list[str] = []
+
+# AccountProfile is a subclass of pydantic's BaseModel.
+# It describes one account a bot can post to.
+# credentials holds the same keys the bot would otherwise read from .env,
+# e.g. INSTAGRAM_ACCOUNT_ID and SYSTEM_USER_TOKEN for instagram.
+# Each account has its own cool down stored on the media entries under
+# accountPosts.<name>, unless coolDownField names a shared field like lastIGPost.
+
+class AccountProfile(BaseModel):
+  name: str = Field(pattern=r'^[A-Za-z0-9_-]+$')
+  platform: Platform
+  enabled: bool = True
+  credentials: dict[str, str] = {}
+  coolDownField: str = ""
+  minIntervalMinutes: float = 0.0
+
+  @property
+  def lastPostField(self):
+    return self.coolDownField or f'accountPosts.{self.name}'
@@ -0,0 +1,286 @@
+# Checks images against each platform's limits before anything is posted.
+# Instagram only finds out an image is the wrong shape or too big after
+# createImageContainer, and X only after the whole image was sent, so this runs
+# ahead of time over the media collection in a process pool. Each worker reads the
+# image's header (format and dimensions) from a ranged GET of its first bytes,
+# without decoding it, and records the results on the media document under imageInfo.
+# The whole image is only downloaded (into the image cache, see image_cache.py) when
+# a derivative has to be made, or the header doesn't fit in HEADER_BYTES.
+# When an image doesn't fit a platform and Pillow is installed, a conforming JPEG
+# derivative is written to DERIVATIVE_DIR, which has to be served at
+# DERIVATIVE_BASE_URL, and the bots post its url instead (see selection.mediaUrl).
+# Without a derivative the platform is listed in imageInfo.rejected and selection
+# skips the image for that platform.
+# ref: https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-user/media#image-specifications
+# ref: https://developer.x.com/en/docs/x-api/v1/media/upload-media/uploading-media/media-best-practices
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import struct
+import time
+from pymongo import UpdateOne
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# Imports the shared helpers
+from enums import MediaType, Platform
+from http_client import client
+from image_cache import cache
+
+# Pillow is only needed to make derivatives
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+MB = 1024 * 1024
+
+# What each platform accepts. max_side is None where larger images are scaled down rather than rejected.
+PLATFORM_LIMITS = {
+  Platform.INSTAGRAM: { 'formats': ('jpeg',), 'max_bytes': 8 * MB, 'min_ratio': 4 / 5, 'max_ratio': 1.91, 'max_side': None },
+  Platform.X: { 'formats': ('jpeg', 'png', 'gif', 'webp'), 'max_bytes': 5 * MB, 'min_ratio': 0.0, 'max_ratio': float('inf'), 'max_side': 8192 },
+  Platform.FACEBOOK: { 'formats': ('jpeg', 'png', 'gif'), 'max_bytes': 4 * MB, 'min_ratio': 0.0, 'max_ratio': float('inf'), 'max_side': None }
+}
+
+# the longest side of a derivative when the platform doesn't set one
+DERIVATIVE_SIDE = 2048
+
+# read from the start of each image, enough for the header of all but JPEGs with large embedded profiles
+HEADER_BYTES = 64 * 1024
+
+#================================================================
+# Image headers
+
+def imageHeader(data):
+  # returns (format, width, height) from the first bytes of a PNG, JPEG, GIF or WebP image
+  if data[:8] == b'\x89PNG\r\n\x1a\n':
+    width, height = struct.unpack_from('>II', data, 16)
+    return 'png', width, height
+
+  if data[:6] in (b'GIF87a', b'GIF89a'):
+    width, height = struct.unpack_from('<HH', data, 6)
+    return 'gif', width, height
+
+  if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+    chunk = bytes(data[12:16])
+    if chunk == b'VP8 ':
+      width, height = struct.unpack_from('<HH', data, 26)
+      return 'webp', width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+      bits = struct.unpack_from('<I', data, 21)[0]
+      return 'webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+      width = int.from_bytes(data[24:27], 'little') + 1
+      height = int.from_bytes(data[27:30], 'little') + 1
+      return 'webp', width, height
+
+  if data[:2] == b'\xff\xd8':
+    # walk the segments up to the start of frame, which holds the dimensions
+    offset = 2
+    while offset + 9 <= len(data):
+      if data[offset] != 0xff:
+        break
+      marker = data[offset + 1]
+      if marker == 0xff:
+        # fill byte
+        offset += 1
+        continue
+      if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+        offset += 2
+        continue
+      if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+        height, width = struct.unpack_from('>HH', data, offset + 5)
+        return 'jpeg', width, height
+      offset += 2 + struct.unpack_from('>H', data, offset + 2)[0]
+
+  raise ValueError('not a PNG, JPEG, GIF or WebP image, or the header is truncated')
+
+def readHeader(url, timeout=30.0):
+  # returns (the first HEADER_BYTES of the image, its size in bytes or None if the server didn't say)
+  with client.get(url, headers={ 'Range': f'bytes=0-{ HEADER_BYTES - 1 }' }, stream=True, timeout=timeout) as response:
+    if response.status_code == 416:
+      # nothing to read
+      return b'', 0
+    if response.status_code == 206:
+      # Content-Range: bytes 0-65535/<size>, the size can be *
+      size = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+    elif response.status_code == 200:
+      # a server that ignores Range, stop reading after the header
+      size = response.headers.get('Content-Length', '')
+    else:
+      raise Exception(f"Failed to fetch image header. { response.status_code }")
+
+    data = b''
+    for chunk in response.iter_content(chunk_size=HEADER_BYTES):
+      data += chunk
+      if len(data) >= HEADER_BYTES:
+        break
+
+  return data[:HEADER_BYTES], int(size) if size.isdigit() else None
+
+def problems(info, platform):
+  # the reasons an image described by info would be rejected by platform
+  limits = PLATFORM_LIMITS[platform]
+  found = []
+  if info['format'] not in limits['formats']:
+    found.append(f"format { info['format'] }")
+  if info['bytes'] > limits['max_bytes']:
+    found.append(f"{ info['bytes'] } bytes")
+  if not info['width'] or not info['height']:
+    found.append('no dimensions')
+  elif not limits['min_ratio'] <= info['width'] / info['height'] <= limits['max_ratio']:
+    found.append(f"aspect ratio { round(info['width'] / info['height'], 2) }")
+  if limits['max_side'] and max(info['width'], info['height']) > limits['max_side']:
+    found.append(f"{ info['width'] }x{ info['height'] }")
+  return found
+
+#================================================================
+# Derivatives
+
+def derivativeSettings():
+  # both are needed, a derivative nobody can fetch is no use to the bots
+  directory = config('DERIVATIVE_DIR', cast=str, default='')
+  base_url = config('DERIVATIVE_BASE_URL', cast=str, default='')
+  return (directory, base_url.rstrip('/')) if Image and directory and base_url else None
+
+def makeDerivative(path, platform, name, settings):
+  # writes a JPEG of the image at path that fits platform's limits, returns its url or None
+  directory, base_url = settings
+  limits = PLATFORM_LIMITS[platform]
+  os.makedirs(os.path.join(directory, platform.value), exist_ok=True)
+  target = os.path.join(directory, platform.value, f'{ name }.jpg')
+
+  with Image.open(path) as image:
+    image = image.convert('RGB')
+
+    # crop the middle to the nearest ratio the platform accepts
+    width, height = image.size
+    if width / height > limits['max_ratio']:
+      crop = round(height * limits['max_ratio'])
+      image = image.crop(((width - crop) // 2, 0, (width - crop) // 2 + crop, height))
+    elif width / height < limits['min_ratio']:
+      crop = round(width / limits['min_ratio'])
+      image = image.crop((0, (height - crop) // 2, width, (height - crop) // 2 + crop))
+
+    image.thumbnail((limits['max_side'] or DERIVATIVE_SIDE,) * 2)
+
+    for quality in (90, 80, 70, 60):
+      image.save(f'{ target }.{ os.getpid() }', 'JPEG', quality=quality, optimize=True)
+      if os.path.getsize(f'{ target }.{ os.getpid() }') <= limits['max_bytes']:
+        os.replace(f'{ target }.{ os.getpid() }', target)
+        return f'{ base_url }/{ platform.value }/{ name }.jpg'
+
+  os.remove(f'{ target }.{ os.getpid() }')
+  return None
+
+#================================================================
+
+def inspectImage(filename, url):
+  # runs in a worker process, returns the fields to $set on the media document
+  entry = None
+
+  try:
+    data, size = readHeader(url)
+    try:
+      image_format, width, height = imageHeader(data)
+    except (ValueError, struct.error):
+      if size is not None and len(data) >= size:
+        raise
+      # the header runs past the bytes read, try again with the whole image
+      entry = cache.fetch(url)
+      with cache.mapped(entry) as view:
+        image_format, width, height = imageHeader(view)
+
+    if size is None and not entry:
+      # the size is one of the limits, download it to find out
+      entry = cache.fetch(url)
+
+  except (ValueError, struct.error) as e:
+    # not an image any platform will take
+    logging.warning(f"inspectImage() - { repr(filename) }: { repr(e) }")
+    return filename, { 'imageInfo': { 'url': url, 'error': repr(e), 'rejected': [platform.value for platform in PLATFORM_LIMITS], 'checkedAt': time.time() }, 'derivatives': {} }
+  except Exception as e:
+    # left unchecked so the next run tries again
+    logging.warning(f"inspectImage() - couldn't fetch { repr(filename) }: { repr(e) }")
+    return filename, None
+
+  info = { 'url': url, 'format': image_format, 'width': width, 'height': height, 'bytes': entry['size'] if entry else size }
+  derivatives = {}
+  rejected = []
+  settings = derivativeSettings()
+
+  for platform in PLATFORM_LIMITS:
+    if not (found := problems(info, platform)):
+      continue
+    try:
+      if settings and not entry:
+        # only now is the whole image needed
+        entry = cache.fetch(url)
+      # named after the content, so images shared by several entries get one derivative
+      derivative = makeDerivative(cache.objectPath(entry['object']), platform, entry['object'], settings) if settings else None
+    except Exception as e:
+      logging.warning(f"inspectImage() - couldn't make a { platform.value } derivative of { repr(filename) }: { repr(e) }")
+      derivative = None
+
+    if derivative:
+      derivatives[platform.value] = derivative
+    else:
+      logging.info(f"inspectImage() - { repr(filename) } can't be posted to { platform.value }: { ', '.join(found) }")
+      rejected.append(platform.value)
+
+  return filename, { 'imageInfo': { **info, 'rejected': rejected, 'checkedAt': time.time() }, 'derivatives': derivatives }
+
+def runPreflight(mongo_db, workers=None, force=False, batch_size=100):
+  # checks every image that hasn't been checked at its current url, or all of them with force
+  documents = [
+    (document['filename'], document['url'])
+    for document in mongo_db['media'].find({ 'type': MediaType.IMAGE.value }, { 'filename': 1, 'url': 1, 'imageInfo.url': 1 })
+    if force or document.get('imageInfo', {}).get('url') != document['url']
+  ]
+  summary = { 'checked': 0, 'failed': 0, 'derivatives': 0, 'rejected': 0 }
+  operations = []
+
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    for filename, fields in executor.map(inspectImage, *zip(*documents), chunksize=8) if documents else ():
+      if fields is None:
+        summary['failed'] += 1
+        continue
+      summary['checked'] += 1
+      summary['derivatives'] += len(fields['derivatives'])
+      summary['rejected'] += len(fields['imageInfo']['rejected'])
+      operations.append(UpdateOne({ 'filename': filename }, { '$set': { **fields, 'updatedAt': time.time() } }))
+      if len(operations) >= batch_size:
+        mongo_db['media'].bulk_write(operations, ordered=False)
+        operations = []
+
+  if operations:
+    mongo_db['media'].bulk_write(operations, ordered=False)
+
+  logging.info(f"runPreflight() - { summary }")
+  return summary
+
+#================================================================
+# Executed while run as a script
+
+if __name__ == '__main__':
+
+  from db import getMongoDatabase
+
+  logging.basicConfig(
+    level=config('LOG_LEVEL', default=20, cast=int),
+    format='[Preflight] - %(levelname)s | %(message)s'
+  )
+
+  parser = argparse.ArgumentParser(
+    prog='Preflight',
+    description='Checks media against each platform\'s image limits and makes derivatives where needed'
+  )
+  parser.add_argument('--force', action='store_true', help='check images that were already checked')
+  parser.add_argument('--workers', type=int, default=config('PREFLIGHT_WORKERS', cast=int, default=os.cpu_count()), help='worker processes')
+  args = parser.parse_args()
+
+  print(f"summary: { runPreflight(getMongoDatabase(), workers=args.workers, force=args.force) }")
@@ -0,0 +1,44 @@
+# Saves how far a multi step post got, so a failed post can be resumed instead
+# of starting over. Instagram posts take several calls (child containers, a
+# carousel container, then publish) and containers stay valid for 24 hours, so
+# a retry can publish the containers a failed run already created.
+# The publishState collection has one document per post in progress, keyed by the
+# queue job running it (see utils/jobs.py), since worker.py can run several jobs
+# for the same account at once, or by the account name for a run outside the queue.
+# ref: https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-user/media
+
+import logging
+import time
+
+#================================================================
+
+def savePublishState(mongo_db, key, lifetime_hours=23.0, fresh=False, **fields):
+  # fields are merged into the saved state, expiresAt is set by the first save,
+  # or again with fresh by a new post's first save
+  now = time.time()
+  started = { 'createdAt': now, 'expiresAt': now + lifetime_hours * 3600, 'resumes': 0 }
+  return mongo_db['publishState'].update_one(
+    { '_id': key },
+    { '$set': { **fields, 'updatedAt': now, **started } } if fresh else {
+      '$set': { **fields, 'updatedAt': now },
+      '$setOnInsert': started
+    },
+    upsert=True
+  )
+
+def loadPublishState(mongo_db, key, max_resumes=3):
+  # the state to resume from, or None if there is none or it expired or was resumed too often
+  now = time.time()
+
+  if (state := mongo_db['publishState'].find_one_and_update(
+    { '_id': key, 'expiresAt': { '$gt': now }, 'resumes': { '$lt': max_resumes } },
+    { '$inc': { 'resumes': 1 } }
+  )):
+    logging.info(f"loadPublishState() - resuming { key } from { len(state.get('children', [])) } container(s), attempt { state['resumes'] + 1 }")
+    return state
+
+  clearPublishState(mongo_db, key)
+  return None
+
+def clearPublishState(mongo_db, key):
+  return mongo_db['publishState'].delete_one({ '_id': key })
@@ -0,0 +1,127 @@
+# Checks the media collection for entries the bots would fail to post.
+# Streams the collection in batches, validates every document against
+# MediaObject and sends a HEAD request to each url, writing the result to a
+# healthy flag that selection skips (see selection.postable). Entries are checked
+# again on every scan, so a fixed url is picked up the next time it runs.
+# The requests run concurrently from asyncio on a thread pool over the shared
+# pooled client (see http_client.py), limited overall and per host so a scan
+# doesn't swamp the server behind MEDIA_BASE_URL.
+# ref: https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from urllib.parse import urlsplit
+from pydantic import ValidationError
+from pymongo import UpdateOne
+import requests
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# Imports the shared helpers
+from http_client import client
+from importer import chunked
+from models import MediaObject
+
+#================================================================
+
+def checkUrl(url, timeout):
+  # returns (status code, error), runs on the executor's threads
+  try:
+    response = client.request('HEAD', url, allow_redirects=True, timeout=timeout)
+    if response.status_code in (405, 501):
+      # some servers don't answer HEAD, only read the headers of a GET
+      with client.get(url, stream=True, timeout=timeout) as response:
+        pass
+    return response.status_code, None
+  except requests.RequestException as e:
+    return None, repr(e)
+
+async def checkUrls(urls, executor, limit, hosts, per_host, timeout):
+  loop = asyncio.get_running_loop()
+
+  async def check(url):
+    host = hosts.setdefault(urlsplit(url).netloc, asyncio.Semaphore(per_host))
+    # wait for the host before taking one of the shared slots
+    async with host, limit:
+      return await loop.run_in_executor(executor, checkUrl, url, timeout)
+
+  return await asyncio.gather(*(check(url) for url in urls))
+
+#================================================================
+
+def health(document, status=None, error=None):
+  # the fields to $set on a scanned document
+  healthy = error is None and status is not None and status < 400
+  fields = { 'healthy': healthy, 'health': { 'status': status, 'error': error, 'checkedAt': time.time() } }
+  # only wake up a polling Catalog (see catalog.py) when the flag changes
+  if document.get('healthy', True) != healthy:
+    fields['updatedAt'] = time.time()
+  return fields
+
+async def scanBatches(mongo_db, batch_size, concurrency, per_host, timeout):
+  summary = { 'scanned': 0, 'invalid': 0, 'unreachable': 0, 'changed': 0 }
+  limit = asyncio.Semaphore(concurrency)
+  hosts = {}
+
+  with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='scan') as executor:
+    for batch in chunked(mongo_db['media'].find({}, { 'leases': 0, 'health': 0 }).batch_size(batch_size), batch_size):
+      results = {}
+      valid = []
+
+      for document in batch:
+        try:
+          MediaObject(**document)
+          valid.append(document)
+        except ValidationError as e:
+          summary['invalid'] += 1
+          errors = '; '.join(f"{ '.'.join(str(part) for part in error['loc']) }: { error['msg'] }" for error in e.errors())
+          logging.warning(f"scanBatches() - invalid { repr(document.get('filename')) }: { errors }")
+          results[document['_id']] = health(document, error=errors)
+
+      for document, (status, error) in zip(valid, await checkUrls([str(document['url']) for document in valid], executor, limit, hosts, per_host, timeout)):
+        if error is not None or status >= 400:
+          summary['unreachable'] += 1
+          logging.warning(f"scanBatches() - { repr(document['filename']) } unreachable: { error or status }")
+        results[document['_id']] = health(document, status, error)
+
+      summary['scanned'] += len(batch)
+      summary['changed'] += sum('updatedAt' in fields for fields in results.values())
+      if results:
+        mongo_db['media'].bulk_write([UpdateOne({ '_id': _id }, { '$set': fields }) for _id, fields in results.items()], ordered=False)
+
+      logging.info(f"scanBatches() - { summary }")
+
+  return summary
+
+def scanMedia(mongo_db, batch_size=500, concurrency=32, per_host=8, timeout=10.0):
+  # per_host should stay within HTTP_POOL_SIZE, the connections the client keeps per host
+  return asyncio.run(scanBatches(mongo_db, batch_size, concurrency, per_host, timeout))
+
+#================================================================
+# Executed while run as a script
+
+if __name__ == '__main__':
+
+  from db import getMongoDatabase
+
+  logging.basicConfig(
+    level=config('LOG_LEVEL', default=20, cast=int),
+    format='[Scan] - %(levelname)s | %(message)s'
+  )
+
+  parser = argparse.ArgumentParser(
+    prog='Scan Media',
+    description='Validates media entries and checks their urls, flagging the broken ones so the bots skip them'
+  )
+  parser.add_argument('--batch-size', type=int, default=500, help='documents read and checked at a time (default: 500)')
+  parser.add_argument('--concurrency', type=int, default=config('SCAN_CONCURRENCY', cast=int, default=32), help='requests in flight (default: 32)')
+  parser.add_argument('--per-host', type=int, default=config('SCAN_PER_HOST', cast=int, default=8), help='requests in flight to one host (default: 8)')
+  parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for each url (default: 10)')
+  args = parser.parse_args()
+
+  print(f"summary: { scanMedia(getMongoDatabase(), args.batch_size, args.concurrency, args.per_host, args.timeout) }")
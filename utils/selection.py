@@ -0,0 +1,169 @@
+# Server side selection of media that is eligible to be posted.
+# Instead of pulling the whole media collection and rolling the dice in python,
+# the type filter and the per platform cool down predicate are pushed into an
+# aggregation pipeline and MongoDB draws a uniform random sample from the
+# eligible documents only.
+# ref: https://www.mongodb.com/docs/manual/reference/operator/aggregation/sample/
+
+import logging
+import time
+from pymongo import UpdateMany
+
+# Imports MediaType and Platform from enums.py
+from enums import MediaType, Platform
+
+# Maps each platform to the field recording when a mediaObject was last posted there
+LAST_POST_FIELDS = {
+  Platform.INSTAGRAM: 'lastIGPost',
+  Platform.X: 'lastXPost',
+  Platform.FACEBOOK: 'lastFBPost',
+  Platform.LINKEDIN: 'lastLIPost',
+  Platform.TIKTOK: 'lastTTPost'
+}
+
+# Only the fields used by the caption builders and the posting functions
+MEDIA_PROJECTION = {
+  'filename': 1,
+  'type': 1,
+  'url': 1,
+  'name': 1,
+  'description': 1,
+  'projectName': 1,
+  'projectURL': 1,
+  'tagList': 1,
+  'groupList': 1,
+  'captionList': 1,
+  'accountPosts': 1,
+  # written by preflight.py, scan.py and importer.syncImport
+  'imageInfo.rejected': 1,
+  'derivatives': 1,
+  'healthy': 1,
+  'removedAt': 1,
+  **{ field: 1 for field in LAST_POST_FIELDS.values() }
+}
+
+#================================================================
+
+def coolDownCutoff(cool_down_days, now=None):
+  # anything posted before this timestamp has finished cooling down
+  return (time.time() if now is None else now) - cool_down_days * 86400
+
+def lastPostTime(mediaObject, field):
+  # reads a lastXXPost field or a dotted per account field like 'accountPosts.<name>'
+  value = mediaObject
+  for key in field.split('.'):
+    if not isinstance(value, dict) or key not in value:
+      return 0.0
+    value = value[key]
+  return value
+
+def coolDownDays(mediaObject, cool_down_days, group_days=None):
+  # the longest override of the mediaObject's groups wins over cool_down_days, see cooldown.py
+  return max((group_days[group] for group in mediaObject.get('groupList') or [] if group in (group_days or {})), default=cool_down_days)
+
+def coolDownQuery(field, cool_down_days, group_days=None, now=None):
+  # $not also matches documents that were never posted on field
+  if not group_days:
+    return { field: { '$not': { '$gte': coolDownCutoff(cool_down_days, now) } } }
+  return { '$and': [
+    # cool_down_days only applies outside the groups with an override
+    { '$or': [
+      { 'groupList': { '$in': list(group_days) } },
+      { field: { '$not': { '$gte': coolDownCutoff(cool_down_days, now) } } }
+    ] },
+    # and each override to its members, so the longest of them wins
+    *(
+      { '$or': [{ 'groupList': { '$ne': group } }, { field: { '$not': { '$gte': coolDownCutoff(days, now) } } }] }
+      for group, days in group_days.items()
+    )
+  ] }
+
+def eligibleQuery(platform, cool_down_days, media_type=MediaType.IMAGE, now=None, field=None, group_days=None):
+  # field overrides the platform's lastXXPost field, e.g. for per account cool downs
+  # group_days maps group names to their cool down, see cooldown.loadEvaluator
+  now = time.time() if now is None else now
+  field = field or LAST_POST_FIELDS[platform]
+  return {
+    'type': media_type.value,
+    **coolDownQuery(field, cool_down_days, group_days, now),
+    # and skips anything another worker is posting right now, see claims.py
+    f'leases.{ field }.expiresAt': { '$not': { '$gt': now } },
+    **postableQuery(platform)
+  }
+
+def postableQuery(platform):
+  return {
+    # skips anything the platform would reject, see preflight.py
+    'imageInfo.rejected': { '$ne': platform.value },
+    # whose url was broken the last time scan.py checked
+    'healthy': { '$ne': False },
+    # or that was dropped from the spreadsheet, see importer.syncImport
+    'removedAt': None
+  }
+
+def postable(mediaObject, platform=None):
+  # the same checks as postableQuery on a document, platform is optional
+  if mediaObject.get('healthy') is False or mediaObject.get('removedAt'):
+    return False
+  return platform is None or platform.value not in (mediaObject.get('imageInfo') or {}).get('rejected', [])
+
+def mediaUrl(mediaObject, platform):
+  # the derivative made for platform by preflight.py, or the original
+  return (mediaObject.get('derivatives') or {}).get(platform.value) or mediaObject['url']
+
+#================================================================
+
+def sampleEligibleMedia(mongo_db, platform, cool_down_days, size=1, media_type=MediaType.IMAGE, field=None, group_days=None):
+  pipeline = [
+    { '$match': eligibleQuery(platform, cool_down_days, media_type, field=field, group_days=group_days) },
+    { '$sample': { 'size': size } },
+    { '$project': MEDIA_PROJECTION }
+  ]
+  return list(mongo_db['media'].aggregate(pipeline))
+
+def getMediaEligibleEverywhere(mongo_db, platforms, cool_down_days, media_type=MediaType.IMAGE, group_days=None):
+  # a single mediaObject that has cooled down on every one of the platforms
+  # cool_down_days is a number or a dict of days by platform
+  match = { '$and': [
+    eligibleQuery(platform, cool_down_days[platform] if isinstance(cool_down_days, dict) else cool_down_days, media_type, group_days=group_days)
+    for platform in platforms
+  ] }
+
+  if not (sample := list(mongo_db['media'].aggregate([
+    { '$match': match },
+    { '$sample': { 'size': 1 } },
+    { '$project': MEDIA_PROJECTION }
+  ]))):
+    logging.warning(f"getMediaEligibleEverywhere() - nothing eligible to post to { [platform.value for platform in platforms] }")
+    return None
+
+  return sample[0]
+
+def getEligibleMediaObject(mongo_db, platform, cool_down_days, media_type=MediaType.IMAGE, field=None, group_days=None):
+  # returns a single eligible mediaObject, or None if everything is cooling down
+  if not (sample := sampleEligibleMedia(mongo_db, platform, cool_down_days, 1, media_type, field, group_days)):
+    logging.warning(f"getEligibleMediaObject() - nothing eligible to post to { platform.value } (cool down: { cool_down_days } days)")
+    return None
+
+  return sample[0]
+
+def markPosted(mongo_db, filenames, fields, now=None):
+  # records a post on one or more lastXXPost (or per account) fields, see Claims.commit
+  now = time.time() if now is None else now
+  filenames = list(filenames)
+
+  markGroupMembers(mongo_db, filenames, fields, now)
+  return mongo_db['media'].update_many(
+    { 'filename': { '$in': filenames } },
+    { '$set': { **{ field: now for field in fields }, 'updatedAt': now } }
+  )
+
+def markGroupMembers(mongo_db, filenames, fields, now):
+  # keeps the timestamps on the members of the groups collection in step, see groups.py
+  # a filename is a member of a group once, so the positional $ finds it without array_filters
+  if not (filenames := list(filenames)):
+    return None
+  return mongo_db['groups'].bulk_write([
+    UpdateMany({ 'members.filename': filename }, { '$set': { f'members.$.{ field }': now for field in fields } })
+    for filename in filenames
+  ], ordered=False)
@@ -0,0 +1,346 @@
+# Selection policies for choosing what to post next.
+# Each policy keeps a structure over the whole catalog that makes a pick
+# O(log n) no matter how much of the catalog is cooling down:
+#
+#   lru      - the item that has waited longest since it was last posted
+#   age      - a random item, weighted by how long it has waited
+#   project  - spreads posts evenly over projects, longest waiting item within each
+#   group    - spreads posts evenly over groups, longest waiting item within each
+#
+# 'uniform' (the default) uses the $sample query in selection.py instead.
+# Each item cools down for its longest group override (GROUP_COOL_DOWNS, see
+# cooldown.py) or cool_down_days, so the structures order items by when they
+# become eligible again rather than by when they were last posted.
+# In a long running process (scheduler.py) the structures are kept between
+# picks and rebuilt from the database every refresh_minutes.
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# Imports the shared helpers
+from cooldown import loadEvaluator
+from enums import MediaType
+from selection import LAST_POST_FIELDS, MEDIA_PROJECTION, coolDownCutoff, coolDownDays, eligibleQuery, getEligibleMediaObject, lastPostTime, postable, postableQuery
+
+#================================================================
+
+class SelectionPolicy:
+
+  def __init__(self, candidates, field, cool_down_days, now=None, group_days=None):
+    # candidates need _id, the cool down field, groupList and, for the project policy, projectName
+    self.field = field
+    self.coolDowns = [coolDownDays(candidate, cool_down_days, group_days) * 86400 for candidate in candidates]
+    self.ids = [candidate['_id'] for candidate in candidates]
+    self.positions = { _id: i for i, _id in enumerate(self.ids) }
+    self.lastPosts = [lastPostTime(candidate, field) for candidate in candidates]
+    self.build(candidates, time.time() if now is None else now)
+
+  def build(self, candidates, now):
+    pass
+
+  def pick(self, now):
+    # returns the _id of the next item to post, or None if nothing is eligible
+    raise NotImplementedError
+
+  def eligibleAt(self, i):
+    return self.lastPosts[i] + self.coolDowns[i]
+
+  def update(self, _id, lastPost):
+    # records that an item was posted at lastPost
+    if (i := self.positions.get(_id)) is not None:
+      self.lastPosts[i] = lastPost
+      self.updated(i, lastPost)
+
+  def updated(self, i, lastPost):
+    pass
+
+#================================================================
+
+class LeastRecentlyPosted(SelectionPolicy):
+  # a heap ordered by the time each item cooled down, stale entries are skipped when they reach the top
+
+  def build(self, candidates, now):
+    # the random number breaks ties between items that were never posted
+    self.heap = [(self.eligibleAt(i), random.random(), i) for i in range(len(self.ids))]
+    heapq.heapify(self.heap)
+
+  def pick(self, now):
+    while self.heap:
+      eligible_at, _, i = self.heap[0]
+      if eligible_at != self.eligibleAt(i):
+        heapq.heappop(self.heap)
+        continue
+      return self.ids[i] if eligible_at < now else None
+    return None
+
+  def updated(self, i, lastPost):
+    heapq.heappush(self.heap, (self.eligibleAt(i), random.random(), i))
+
+#================================================================
+
+class FenwickTree:
+  # prefix sums over item weights, for O(log n) weighted random picks
+  # ref: https://en.wikipedia.org/wiki/Fenwick_tree
+
+  def __init__(self, size):
+    self.size = size
+    self.tree = [0.0] * (size + 1)
+    self.total = 0.0
+
+  def add(self, i, delta):
+    self.total += delta
+    i += 1
+    while i <= self.size:
+      self.tree[i] += delta
+      i += i & -i
+
+  def find(self, value):
+    # the first i where the sum of weights up to and including i exceeds value
+    position = 0
+    step = 1 << self.size.bit_length()
+    while step:
+      if position + step <= self.size and self.tree[position + step] <= value:
+        position += step
+        value -= self.tree[position]
+      step >>= 1
+    return min(position, self.size - 1)
+
+class AgeWeighted(SelectionPolicy):
+  # Eligible items are weighted by how long they've waited since their last post,
+  # capped at max_wait_days so items that were never posted don't crowd out the rest.
+  # An item's weight is fixed when it becomes eligible. Items cooling down have no
+  # weight and sit in a heap until they become eligible again.
+
+  max_wait_days = 70.0
+
+  def build(self, candidates, now):
+    self.weights = [0.0] * len(self.ids)
+    self.tree = FenwickTree(len(self.ids))
+    self.waiting = []
+
+    for i, lastPost in enumerate(self.lastPosts):
+      self.updated(i, lastPost)
+    self.activate(now)
+
+  def setWeight(self, i, weight):
+    self.tree.add(i, weight - self.weights[i])
+    self.weights[i] = weight
+
+  def activate(self, now):
+    while self.waiting and self.waiting[0][0] <= now:
+      eligible_at, i = heapq.heappop(self.waiting)
+      if eligible_at == self.eligibleAt(i):
+        self.setWeight(i, min(now - self.lastPosts[i], self.max_wait_days * 86400))
+
+  def pick(self, now):
+    self.activate(now)
+    if self.tree.total <= 0:
+      return None
+    return self.ids[self.tree.find(random.uniform(0, self.tree.total))]
+
+  def updated(self, i, lastPost):
+    self.setWeight(i, 0.0)
+    heapq.heappush(self.waiting, (self.eligibleAt(i), i))
+
+#================================================================
+
+class GroupQuota(SelectionPolicy):
+  # Every group gets an equal share of the posts: the group with the fewest picks
+  # that has something eligible goes next, and posts its longest waiting item.
+  # Groups with nothing eligible wait in a heap until their first item cools down.
+
+  key = 'projectName'
+
+  def build(self, candidates, now):
+    self.groups = {}
+    self.memberships = []
+
+    for i, candidate in enumerate(candidates):
+      groups = candidate.get(self.key) or ''
+      groups = groups if isinstance(groups, list) else [groups]
+      self.memberships.append(groups)
+      for group in groups:
+        self.groups.setdefault(group, []).append((self.eligibleAt(i), random.random(), i))
+
+    for members in self.groups.values():
+      heapq.heapify(members)
+
+    self.picks = { group: 0 for group in self.groups }
+    # only the latest entry of each group in active/waiting is valid
+    self.tokens = { group: 0 for group in self.groups }
+    self.active = []
+    self.waiting = []
+
+    for group in self.groups:
+      self.schedule(group, now)
+
+  def oldest(self, group):
+    members = self.groups[group]
+    while members and members[0][0] != self.eligibleAt(members[0][2]):
+      heapq.heappop(members)
+    return members[0] if members else None
+
+  def schedule(self, group, now):
+    self.tokens[group] += 1
+    if not (oldest := self.oldest(group)):
+      return
+    if oldest[0] < now:
+      heapq.heappush(self.active, (self.picks[group], random.random(), self.tokens[group], group))
+    else:
+      heapq.heappush(self.waiting, (oldest[0], self.tokens[group], group))
+
+  def pick(self, now):
+    while self.waiting and self.waiting[0][0] <= now:
+      _, token, group = heapq.heappop(self.waiting)
+      if token == self.tokens[group]:
+        self.schedule(group, now)
+
+    while self.active:
+      _, _, token, group = heapq.heappop(self.active)
+      if token != self.tokens[group]:
+        continue
+
+      oldest = self.oldest(group)
+      if not oldest or oldest[0] >= now:
+        # posted from another group since it was scheduled
+        self.schedule(group, now)
+        continue
+
+      self.picks[group] += 1
+      self.schedule(group, now)
+      return self.ids[oldest[2]]
+
+    return None
+
+  def updated(self, i, lastPost):
+    for group in self.memberships[i]:
+      heapq.heappush(self.groups[group], (self.eligibleAt(i), random.random(), i))
+
+class GroupListQuota(GroupQuota):
+  key = 'groupList'
+
+POLICIES = {
+  'lru': LeastRecentlyPosted,
+  'age': AgeWeighted,
+  'project': GroupQuota,
+  'group': GroupListQuota
+}
+
+#================================================================
+
+# policies kept between picks in a long running process, by (policy, field, cool downs)
+policy_cache = {}
+policy_lock = threading.Lock()
+# picks that haven't been published yet, by _id: [(policy, last post before the pick)]
+pending_picks = {}
+
+def selectMediaObject(mongo_db, platform, cool_down_days, field=None, policy='uniform', refresh_minutes=60.0, max_tries=5, media_type=MediaType.IMAGE, catalog=None, group_days=None):
+  # with a Catalog (see catalog.py) the whole selection runs from memory
+  # group_days maps group names to their cool down, see cooldown.loadEvaluator
+  if policy == 'uniform':
+    if catalog:
+      return catalog.sample(platform, cool_down_days, media_type, field, group_days)
+    return getEligibleMediaObject(mongo_db, platform, cool_down_days, media_type, field, group_days)
+
+  field = field or LAST_POST_FIELDS[platform]
+  now = time.time()
+
+  def cooledDown(document):
+    return lastPostTime(document, field) < coolDownCutoff(coolDownDays(document, cool_down_days, group_days), now)
+
+  with policy_lock:
+    key = (policy, field, cool_down_days, tuple(sorted((group_days or {}).items())))
+
+    if not (cached := policy_cache.get(key)) or now - cached[1] > refresh_minutes * 60:
+      candidates = [candidate for candidate in catalog.ofType(media_type) if postable(candidate, platform)] if catalog else list(mongo_db['media'].find(
+        { 'type': media_type.value, **postableQuery(platform) },
+        { field: 1, 'projectName': 1, 'groupList': 1 }
+      ))
+      cached = policy_cache[key] = (POLICIES[policy](candidates, field, cool_down_days, now, group_days), now)
+      logging.debug(f"selectMediaObject() - built { policy } policy over { len(candidates) } candidates")
+
+    strategy = cached[0]
+    # items another worker has claimed right now, skipped for the rest of this selection only
+    leased = []
+
+    try:
+      for _ in range(max_tries):
+        if (_id := strategy.pick(now)) is None:
+          break
+
+        # the structure may be stale if another process posted since it was built
+        if catalog:
+          current = catalog.getById(_id)
+          mediaObject = current if current and postable(current, platform) and cooledDown(current) else None
+        elif (mediaObject := mongo_db['media'].find_one(
+          { '_id': _id, **eligibleQuery(platform, cool_down_days, media_type, now, field, group_days) },
+          MEDIA_PROJECTION
+        )) is None:
+          current = mongo_db['media'].find_one({ '_id': _id }, { field: 1, 'groupList': 1, 'imageInfo.rejected': 1, 'healthy': 1, 'removedAt': 1 })
+
+        if mediaObject:
+          # assume it's about to be posted so the next pick moves on,
+          # until Claims settles or rolls back the pick, see claims.py
+          pending_picks.setdefault(_id, []).append((strategy, strategy.lastPosts[strategy.positions[_id]]))
+          strategy.update(_id, now)
+          return mediaObject
+
+        if current and postable(current, platform) and cooledDown(current):
+          # cooled down but leased by another worker
+          leased.append((_id, lastPostTime(current, field)))
+          strategy.update(_id, now)
+        else:
+          # never again if it's gone or the platform won't take it
+          strategy.update(_id, lastPostTime(current, field) if current and postable(current, platform) else float('inf'))
+
+    finally:
+      for _id, lastPost in leased:
+        strategy.update(_id, lastPost)
+
+  logging.warning(f"selectMediaObject() - nothing eligible to post to { platform.value } with the { policy } policy")
+  return None
+
+def pickMediaObject(mongo_db, platform, field=None, evaluator=None, catalog=None):
+  # selectMediaObject with the bot's settings, or None if nothing could be picked
+  # SELECTION_POLICY picks how: uniform, lru, age, project or group
+  # evaluator holds the cool downs (POST_COOL_DOWN, <PLATFORM>_POST_COOL_DOWN, GROUP_COOL_DOWNS), see cooldown.py
+  evaluator = evaluator or loadEvaluator()
+  field = field or LAST_POST_FIELDS[platform]
+
+  try:
+    if (mediaObject := selectMediaObject(
+      mongo_db=mongo_db,
+      platform=platform,
+      cool_down_days=evaluator.fieldDays(field),
+      field=field,
+      policy=config('SELECTION_POLICY', cast=str, default='uniform'),
+      refresh_minutes=config('SELECTION_REFRESH_MINUTES', cast=float, default=60.0),
+      catalog=catalog,
+      group_days=evaluator.group_days
+    )):
+      logging.info(f"pickMediaObject() - { platform.value }: mediaObject ID: { str(mediaObject['_id']) }, filename: { repr(mediaObject['filename']) }")
+    return mediaObject
+
+  except Exception as e:
+    logging.error(f"pickMediaObject() - { platform.value }: { repr(e) }")
+    return None
+
+def settlePicks(ids):
+  # the picks were published, keep them as posted
+  with policy_lock:
+    for _id in ids:
+      pending_picks.pop(_id, None)
+
+def rollbackPicks(ids):
+  # the picks weren't claimed or published, make them eligible again
+  with policy_lock:
+    for _id in ids:
+      for strategy, lastPost in pending_picks.pop(_id, []):
+        strategy.update(_id, lastPost)
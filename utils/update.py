@@ -1,17 +1,22 @@
 # This script uses a .tsv (tab-separated values) spreadsheet to update (overwrite)
 # existing MongoDB entry data or to insert new entries where none exists
 # The assumption is that filenames for media entered into the database are unique (case-sensitive)
+# By default the rows are written one at a time, see importer.rowImport
 
+# Pass --bulk to stream the file in batches of upserts instead, see importer.py
+# Pass --sync to only write the rows that changed since the last run, see importer.syncImport
+# Bad rows are skipped, pass --error-report <path> to save them as JSON lines
+
+import argparse
 import csv
-import json
 from pymongo import MongoClient
 
 # Python Decouple: Strict separation of settings from code
 # https://pypi.org/project/python-decouple/
 from decouple import config
 
-# Imports MediaObject from models.py
-from models import MediaObject
+from importer import bulkImport, printReport, rowImport, syncImport
+from groups import rebuildGroups
 
 #================================================================
 # Executed while run as a script
@@ -20,6 +25,20 @@ if __name__ == '__main__':
 
   try:
 
+    parser = argparse.ArgumentParser(
+      prog='Update Media',
+      description='Creates or updates media entries from a .tsv spreadsheet'
+    )
+    parser.add_argument('--bulk', action='store_true', help='write rows with batched bulk upserts')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per bulk_write batch (default: 1000)')
+    parser.add_argument('--unordered', action='store_true', help="don't stop a batch at the first write error")
+    parser.add_argument('--sync', action='store_true', help='skip unchanged rows and only write the fields that changed')
+    parser.add_argument('--prune', choices=['flag', 'delete'], help='with --sync, flag or delete entries missing from the spreadsheet')
+    parser.add_argument('--dry-run', action='store_true', help='with --sync, print the differences without writing them')
+    parser.add_argument('--workers', type=int, default=config('IMPORT_WORKERS', cast=int, default=0), help='with --bulk or --sync, processes validating rows (default: one per CPU)')
+    parser.add_argument('--error-report', help='write the rows that failed validation to this file as JSON lines')
+    args = parser.parse_args()
+
     # Create an instance of the MongoDB client
     # ref: https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
     mongo_client = MongoClient(
@@ -45,64 +64,51 @@ if __name__ == '__main__':
         delimiter="\t" #tab seperated
     )
 
-    # Iterate through the rows in tsv_file
-    for row in tsv_file:
-      # Skip if the row doesn't contain a filename value
-      if not 'filename' in row:
-        print(f"Row is missing 'filename' field. row: {row}")
-        continue
-      
-      # This step pre-formats some of the data we know that we want to store
-      row.update({
-        "projectURL": row['projectURL'] if row['projectURL'] else None,
-        "url": f"{config('MEDIA_BASE_URL', cast=str)}/{row['filename']}",
-        "tagList": json.loads(row['tagList']) if 'tagList' in row else [],
-        "groupList": json.loads(row['groupList']) if 'groupList' in row else [],
-        "captionList": json.loads(row['captionList']) if 'captionList' in row else []
-      })
-
-      # Look for an entry matching this query
-      query = { 'filename': row['filename'] }
-
-      # If there an entry for the given filename, update it
-      if (find_result := mongo_db['media'].find_one(query)):
-        print(f"found mediaObject ID: { str(find_result['_id']) }, filename: { find_result['filename'] }")
-        
-        row.update({
-          "lastIGPost": find_result['lastIGPost'] if 'lastIGPost' in find_result else 0.0,
-          "lastXPost": find_result['lastXPost'] if 'lastXPost' in find_result else 0.0,
-          "lastFBPost": find_result['lastFBPost'] if 'lastFBPost' in find_result else 0.0,
-          "lastLIPost": find_result['lastLIPost'] if 'lastLIPost' in find_result else 0.0,
-          "lastTTPost": find_result['lastTTPost'] if 'lastTTPost' in find_result else 0.0
-        })
-
-        # This step validates the modified row data
-        # NOTES: It discards any keys not in the model without raising an exception.
-        # This maintains conformity with the model so junk keys don't make it into the DB entries
-        mediaObject = MediaObject(**row)
-
-        # If the update operation was successful, let us know.
-        if (update_result := mongo_db['media'].update_one(
-          filter=query,
-          update={ '$set': mediaObject.model_dump(mode="json") }
-        )):
-          print(f"documents matched: { update_result.matched_count }, documents modified: { update_result.modified_count }")
-          continue
-
-        # Let us know if there was a problem with the update operation
-        print(f"Failed to update entry for {mediaObject.filename}")
-        continue
-
-      # There wasn't a matching entry for the filename query
-      # Validate the row object against the MediaObject model 
-      mediaObject = MediaObject(**row)
-      # Insert it in the database and let us know if successful
-      if (media_object_id := mongo_db['media'].insert_one(mediaObject.model_dump(mode="json")).inserted_id):
-        print(f"Entry for {mediaObject['filename']} created. ID: {media_object_id}")
-        continue
-      # Let us know if the insert operation failed.
-      print(f"Failed to create new entry for {mediaObject.filename}")
-      continue
+    media_base_url = config('MEDIA_BASE_URL', cast=str)
+
+    # line buffered, the script ends with exit()
+    error_report = open(args.error_report, 'w', buffering=1) if args.error_report else None
+
+    if args.sync:
+      report = syncImport(
+        mongo_db=mongo_db,
+        rows=tsv_file,
+        media_base_url=media_base_url,
+        batch_size=args.batch_size,
+        prune=args.prune,
+        dry_run=args.dry_run,
+        workers=args.workers,
+        error_report=error_report
+      )
+      printReport(report)
+      if not args.dry_run:
+        print(f"groups indexed: { rebuildGroups(mongo_db) }")
+      exit()
+
+    if args.bulk:
+      summary = bulkImport(
+        mongo_db=mongo_db,
+        rows=tsv_file,
+        media_base_url=media_base_url,
+        batch_size=args.batch_size,
+        ordered=not args.unordered,
+        workers=args.workers,
+        error_report=error_report
+      )
+      print(f"summary: { summary }")
+      print(f"groups indexed: { rebuildGroups(mongo_db) }")
+      exit()
+
+    summary = rowImport(
+      mongo_db=mongo_db,
+      rows=tsv_file,
+      media_base_url=media_base_url,
+      error_report=error_report
+    )
+    print(f"summary: { summary }")
+
+    # Rebuild the group index used for carousels and multi image posts
+    print(f"groups indexed: { rebuildGroups(mongo_db) }")
     
   except Exception as e:
     print(f"Oops! {repr(e)}")
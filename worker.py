@@ -0,0 +1,100 @@
+# Drains the post job queue (see utils/jobs.py) with a pool of worker threads.
+# Jobs are queued by scheduler.py when QUEUE_JOBS=True, or from the command line:
+#
+#   python3 worker.py --enqueue instagram [--account artist-one-ig]
+#
+# Failed posts are retried with backoff, so recovering from an API hiccup doesn't
+# wait for the next scheduled run. Any number of workers can drain the same queue.
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+
+# Python Decouple: Strict separation of settings from code
+# https://pypi.org/project/python-decouple/
+from decouple import config
+
+# The modules shared by all the bots live in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from accounts import defaultAccount, loadAccounts
+from bots import BOT_DIRECTORIES, loadBot
+from db import getMongoDatabase
+from enums import Platform
+from http_client import client
+from jobs import drainJobs, enqueueJob
+
+#================================================================
+
+def jobHandler(mongo_db, accounts):
+  # runs a job with the bot for its platform, loading bots as they're needed
+  bots = {}
+  lock = threading.Lock()
+
+  def handle(job, progress):
+    platform = Platform(job['platform'])
+
+    with lock:
+      if platform not in bots:
+        bots[platform] = loadBot(platform, mongo_db)
+
+    if job['account'] and job['account'] not in accounts:
+      raise Exception(f"unknown account: { job['account'] }")
+
+    account = accounts[job['account']] if job['account'] else defaultAccount(platform)
+    # the job's key keeps its resumable state apart from other jobs for the account
+    return bots[platform].run(account, progress, job['idempotencyKey'])
+
+  return handle
+
+#================================================================
+# MAIN
+
+if __name__ == '__main__':
+  try:
+
+    logging.basicConfig(
+      level=config('LOG_LEVEL', default=20, cast=int),
+      format='[Worker] - %(levelname)s | %(threadName)s | %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(
+      prog='Post Worker',
+      description='Runs queued post jobs, retrying failed posts with backoff'
+    )
+    parser.add_argument('--enqueue', choices=[platform.value for platform in BOT_DIRECTORIES], help='queue a post job and exit')
+    parser.add_argument('--account', default=None, help='account profile name for --enqueue (default: the .env account)')
+    args = parser.parse_args()
+
+    mongo_db = getMongoDatabase()
+
+    if args.enqueue:
+      print(f"queued: { enqueueJob(mongo_db, Platform(args.enqueue), args.account) }")
+      exit()
+
+    accounts = { account.name: account for account in loadAccounts(mongo_db, config('ACCOUNTS_PATH', default=None)) }
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      signal.signal(signum, lambda *args: stopping.set())
+
+    # SIGINT/SIGTERM let the jobs in progress finish
+    drainJobs(
+      mongo_db=mongo_db,
+      handler=jobHandler(mongo_db, accounts),
+      workers=config('JOB_WORKERS', cast=int, default=4),
+      poll_seconds=config('JOB_POLL_SECONDS', cast=float, default=5.0),
+      lease_seconds=config('JOB_LEASE_MINUTES', cast=float, default=15.0) * 60,
+      backoff=config('JOB_RETRY_BACKOFF_SECONDS', cast=float, default=60.0),
+      stopping=stopping
+    )
+
+    logging.info(f'HTTP latency: { client.latencyStats() }')
+
+  except Exception as e:
+    logging.error(f'__main__(): {repr(e)}')
+  finally:
+    exit()
@@ -1,60 +1,74 @@
 import logging
-import requests
 import json
 import random
 import time
+import mimetypes
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from requests_oauthlib import OAuth1Session
 from decouple import config
 from base64 import b64encode
 from pymongo import MongoClient
+import os
+import sys
+
+# The modules shared by all the bots live in ../utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+from enums import JobState, Platform
+from selection import mediaUrl
+from claims import fieldClaims
+from cooldown import loadEvaluator
+from groups import eligibleGroupMembers
+from strategies import pickMediaObject
+from accounts import defaultAccount
+from captions import CaptionTemplate, allTags, mediaTags, randomTags
+from fitting import fitCaption
+from http_client import client
+from image_cache import cache
 
 from templates import (
   single_image_template,
   multiple_image_template
 )
 
-from oauth_helper import oauth
+from oauth_helper import auth, authFor
 
-#================================================================
-
-def getRandomMediaObject(max_tries=5):
-  try:
-    tries = 0
-    candidates = list(mongo_db['media'].find({'type':'image'}))
-    mediaObject = None
-
-    while not mediaObject:
-
-      candidate = random.choice(candidates)
-
-      if time.time() - candidate['lastXPost'] > (config('POST_COOL_DOWN', cast=float, default=7.0) * 86400):
-        mediaObject = candidate
-
-      tries += 1
-      if tries >= max_tries:
-        break
+single_image = CaptionTemplate(single_image_template)
+multiple_image = CaptionTemplate(multiple_image_template)
 
-    logging.info(f"getRandomMediaObject() - tries: { tries } | mediaObject ID: { str(mediaObject['_id']) }, filename: { repr(mediaObject['filename']) }")
+# maximum number of images downloaded and uploaded at the same time
+UPLOAD_WORKERS = config('UPLOAD_WORKERS', cast=int, default=4)
 
-  except Exception as e:
-    logging.error(f'getRandomMediaObject: { repr(e) }')
+# 'chunked' streams media with INIT/APPEND/FINALIZE, 'simple' sends it base64 encoded in one request
+UPLOAD_MODE = config('X_UPLOAD_MODE', cast=str, default='chunked')
+UPLOAD_CHUNK_SIZE = config('X_UPLOAD_CHUNK_SIZE', cast=int, default=1024 * 1024)
+# keep downloaded images on disk and revalidate them instead of downloading again, see utils/image_cache.py
+IMAGE_CACHE = config('IMAGE_CACHE', cast=bool, default=True)
+# point this at a local stand-in server to exercise uploads without hitting X
+UPLOAD_URL = config('X_UPLOAD_URL', cast=str, default='https://upload.twitter.com/1.1/media/upload.json')
+# seconds to wait for X to process uploaded media before giving up on it
+PROCESSING_TIMEOUT = config('X_PROCESSING_TIMEOUT', cast=float, default=120.0)
 
-  finally:
-    return mediaObject
+# set by a long running process (scheduler.py) to select from memory, see utils/catalog.py
+catalog = None
 
 #================================================================
 
 def buildSingleImageText(mediaObject):
   try:
     url = mediaObject['projectURL'] if mediaObject['projectURL'] else config('DEFAULT_URL', cast=str)
-    random.shuffle(mediaObject['tagList'])
-    tags = ' '.join(['#' + tag for tag in mediaObject['tagList'][:5]])
-
-    text = single_image_template.format(
-      title=mediaObject['projectName'],
+    # trimmed to fit the platform's limits, see utils/fitting.py
+    text = fitCaption(
+      platform=Platform.X,
+      render=lambda body, tags: single_image.render(
+        title=mediaObject['projectName'],
+        body=body,
+        url=url,
+        tags=tags,
+      ),
       body=f"{ mediaObject['name'] } { mediaObject['description'] }",
-      url=url,
-      tags=tags,
+      # 5 random '#'-prefixed tags, see utils/captions.py
+      tags=randomTags(mediaTags(mediaObject), 5)
     )
     return text
 
@@ -64,21 +78,21 @@ def buildSingleImageText(mediaObject):
 
 def buildMultiImageText(mediaObjects):
   try:
-    body = ""
-    tagList = []
-
-    for i, mediaObject in enumerate(mediaObjects):
-      body += f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n"
-      tagList += mediaObject['tagList']
-
-    tagList = list(set(tagList))
-    random.shuffle(tagList)
-    tags = ' '.join(['#' + tag for tag in tagList[:5]])
-
-    text = multiple_image_template.format(
-      title=mediaObjects[0]['projectName'],
+    body = ''.join([
+      f"{i+1}. {mediaObject['name']} - {mediaObject['description']}\n"
+      for i, mediaObject in enumerate(mediaObjects)
+    ])
+
+    text = fitCaption(
+      platform=Platform.X,
+      render=lambda body, tags: multiple_image.render(
+        title=mediaObjects[0]['projectName'],
+        body=body,
+        tags=tags
+      ),
       body=body,
-      tags=tags
+      # 5 random tags from all the mediaObjects
+      tags=randomTags(allTags(mediaObjects), 5)
     )
     return text
 
@@ -89,68 +103,72 @@ def buildMultiImageText(mediaObjects):
 #================================================================
 # MEDIA POST
 
-def mediaPost(mediaObject=None):
+def mediaPost(mediaObject=None, auth=auth, claims=None, progress=None, evaluator=None):
+  # claims holds mediaObject for this post, the rest of the group is claimed here, see utils/claims.py
+  # progress is set when run from the job queue, see utils/jobs.py
+  # evaluator holds the run's cool downs, see utils/cooldown.py
   logging.info(f"mediaPost() - mediaObject ID: { str(mediaObject['_id']) }, filename: { repr(mediaObject['filename']) }")
 
   try:
     #select the first group
     group = random.choice(mediaObject['groupList'])
 
-    #find all other members of the group
-    groupMembers = mongo_db['media'].find({ 'groupList' : { '$eq': group } })
-
-    #build a list of candidates
-    logging.debug(f'Looking for candidates in group: { group }, groupMembers: { groupMembers }')
-    candidates = []
-    for candidate in groupMembers:
-      # check that the last post was not sooner than the cool down duration
-      coolDownCheck = time.time() - candidate['lastXPost'] > (config('POST_COOL_DOWN', cast=float, default=7.0) * 86400)
-      # if it passes the cool down check and is not the mediaObject add it to the list
-      if candidate['filename'] != mediaObject['filename'] and coolDownCheck:
-        candidates.append(candidate)
-
-    # mix them all up
-    random.shuffle(candidates)
+    # twitter posts can have 1-4 images
+    max_media_uploads = random.randrange(1, 5)
+
+    # a random sample of the other members of the group that have cooled down, see utils/groups.py
+    # with spares in case some of the uploads fail
+    candidates = claims.claimAll(eligibleGroupMembers(
+      mongo_db=mongo_db,
+      group=group,
+      exclude=[mediaObject['filename']],
+      field=claims.fields[0],
+      evaluator=evaluator or loadEvaluator(),
+      k=2 * max_media_uploads,
+      catalog=catalog,
+      platform=Platform.X
+    ))
+    logging.debug(f'Looking for candidates in group: { group }, found: { len(candidates) }')
+
     # put the mediaObject first
     candidates.insert(0, mediaObject)
 
-    # twitter posts can have 1-4 images
-    max_media_uploads = random.randrange(1, 5)
+    # make sure the text can be made to fit before uploading anything
+    if not buildSingleImageText(mediaObject):
+      raise Exception("buildSingleImageText() returned an empty string")
 
     text = ""
     media = { 'media_ids' : [] }
     published_mediaObjects = []
 
-    for candidate in candidates:
-      if not (upload_result := upload_media(candidate)):
-        continue
-
-      if 'media_id_string' in upload_result:
-        mongo_db['media'].update_one(
-          { 'filename': mediaObject['filename'] },
-          { '$set': { 'lastXPost': time.time() } }
-        )
-        media['media_ids'].append(upload_result['media_id_string'])
-        published_mediaObjects.append(candidate)
-
-      # stop once we've reached the max
-      if len(media['media_ids']) >= max_media_uploads:
-        logging.debug(f'Reached max_media_uploads count: { max_media_uploads }')
-        break
+    for candidate, upload_result in uploadCandidates(candidates, max_media_uploads, auth):
+      media['media_ids'].append(upload_result['media_id_string'])
+      published_mediaObjects.append(candidate)
 
     if not media['media_ids']:
       raise Exception('Post has media ids.')
-    elif len(media['media_ids']) == 1:
-      if not( text := buildSingleImageText(mediaObject)):
+
+    if progress:
+      progress(JobState.CONTAINER_READY, mediaIds=media['media_ids'])
+
+    if len(media['media_ids']) == 1:
+      # the mediaObject itself may have failed to upload
+      if not( text := buildSingleImageText(published_mediaObjects[0])):
         raise Exception("buildSingleImageText() returned an empty string")
     else:
       if not (text := buildMultiImageText(published_mediaObjects)):
         raise Exception("buildMultiImageText() returned an empty string")
 
-    return submit_post(
+    if not (result := submit_post(
       text=text,
-      media=media
-    )
+      media=media,
+      auth=auth
+    )):
+      raise Exception('failed to submit post')
+
+    # set the lastXPost (or per account) time of exactly the images that went out
+    claims.commit(published_mediaObjects)
+    return result
 
   except Exception as e:
     logging.error(f'mediaPost: {repr(e)}')
@@ -158,17 +176,68 @@ def mediaPost(mediaObject=None):
 
 #================================================================
 
-def upload_media(mediaObject=None):
+def uploadCandidates(candidates, max_media_uploads, auth=auth):
+  # Downloads and uploads candidates in parallel, in order of preference.
+  # No more uploads are started than are still needed to reach max_media_uploads,
+  # so once enough have succeeded the remaining candidates are never touched.
+  # Returns (candidate, upload_result) pairs in the order the candidates were given.
+  uploaded = []
+  queue = iter(enumerate(candidates))
+
+  with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+    in_flight = {}
+
+    while True:
+      while len(in_flight) < min(UPLOAD_WORKERS, max_media_uploads - len(uploaded)):
+        if not (item := next(queue, None)):
+          break
+        in_flight[executor.submit(upload_media, item[1], auth)] = item
+
+      if not in_flight:
+        break
+
+      done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+      for future in done:
+        index, candidate = in_flight.pop(future)
+        try:
+          if (upload_result := future.result()) and 'media_id_string' in upload_result:
+            uploaded.append((index, candidate, upload_result))
+        except Exception as e:
+          logging.warning(f"Failed to upload { repr(candidate['filename']) }: { repr(e) }")
+
+  if len(uploaded) >= max_media_uploads:
+    logging.debug(f'Reached max_media_uploads count: { max_media_uploads }')
+
+  uploaded.sort(key=lambda item: item[0])
+  return [(candidate, upload_result) for _, candidate, upload_result in uploaded]
+
+#================================================================
+
+def upload_media(mediaObject=None, auth=auth):
+  if UPLOAD_MODE == 'simple':
+    return upload_media_simple(mediaObject, auth)
+  return upload_media_chunked(mediaObject, auth=auth)
+
+def upload_media_simple(mediaObject=None, auth=auth):
   # fetch the image data from the mediaObject url
-  if (fetch_response := requests.get(mediaObject['url'])).status_code != 200:
+  if IMAGE_CACHE:
+    try:
+      with cache.open(mediaUrl(mediaObject, Platform.X)) as (_, view):
+        media_data = b64encode(view)
+    except Exception as e:
+      logging.warning(f"Failed to fetch image data. { repr(e) }")
+      return None
+  elif (fetch_response := client.get(mediaUrl(mediaObject, Platform.X))).status_code != 200:
     logging.warning(f"Failed to fetch image data. { fetch_response.status_code } | { fetch_response.content }")
     return None
+  else:
+    media_data = b64encode(fetch_response.content)
 
-  # encode base64
-  media_data = b64encode(fetch_response.content)
-
-  if (post_response := oauth.post(
-    url="https://upload.twitter.com/1.1/media/upload.json",
+  if (post_response := client.post(
+    url=UPLOAD_URL,
+    auth=auth,
+    idempotent=True,
     data={
       "media_data" : media_data,
       "media_category" : "tweet_image"
@@ -181,8 +250,124 @@ def upload_media(mediaObject=None):
   return post_response.json()
 
 #================================================================
+# Chunked media upload
+# ref: https://developer.x.com/en/docs/x-api/v1/media/upload-media/uploading-media/chunked-media-upload
+
+def openMediaSource(source, chunk_size=None, media_type=None):
+  # Opens a mediaObject, url, local file path or bytes already in memory for streaming.
+  # Returns the total size in bytes, the mime type and an iterator over the chunks,
+  # so the whole payload never has to be held in memory.
+  chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+  if isinstance(source, dict):
+    source = mediaUrl(source, Platform.X)
+
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    data = memoryview(source)
+    return len(data), media_type, (bytes(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+
+  if os.path.isfile(source):
+    def read_chunks():
+      with open(source, 'rb') as file:
+        while (chunk := file.read(chunk_size)):
+          yield chunk
+
+    return os.path.getsize(source), mimetypes.guess_type(source)[0], read_chunks()
+
+  if IMAGE_CACHE:
+    # downloaded (or revalidated) once up front, INIT needs the size
+    entry = cache.fetch(source)
+
+    def read_mapped_chunks():
+      with cache.mapped(entry) as view:
+        for i in range(0, len(view), chunk_size):
+          yield bytes(view[i:i + chunk_size])
+
+    return entry['size'], entry['contentType'] or mimetypes.guess_type(source)[0], read_mapped_chunks()
+
+  if (fetch_response := client.get(source, stream=True)).status_code != 200:
+    fetch_response.close()
+    raise Exception(f"Failed to fetch image data. { fetch_response.status_code }")
+
+  # INIT needs the total size up front
+  if not (total_bytes := fetch_response.headers.get('Content-Length')):
+    fetch_response.close()
+    raise Exception(f"No Content-Length for { source }")
+
+  media_type = fetch_response.headers.get('Content-Type', '').split(';')[0] or mimetypes.guess_type(source)[0]
 
-def submit_post(text="", media=None):
+  return int(total_bytes), media_type, fetch_response.iter_content(chunk_size=chunk_size)
+
+def upload_media_chunked(mediaObject=None, source=None, auth=auth, media_type=None):
+  # streams from source (a local file or bytes) if given, otherwise from mediaObject['url']
+  try:
+    total_bytes, media_type, chunks = openMediaSource(source or mediaObject, media_type=media_type)
+
+    if (init_response := client.post(
+      url=UPLOAD_URL,
+      auth=auth,
+      idempotent=True,
+      data={
+        "command": "INIT",
+        "total_bytes": total_bytes,
+        "media_type": media_type,
+        "media_category": "tweet_image"
+      }
+    )).status_code not in (200, 201, 202):
+      raise Exception(f"INIT failed. { init_response.status_code } | { init_response.content }")
+
+    media_id = init_response.json()['media_id_string']
+
+    for segment_index, chunk in enumerate(chunks):
+      if (append_response := client.post(
+        url=UPLOAD_URL,
+        auth=auth,
+        idempotent=True,
+        data={
+          "command": "APPEND",
+          "media_id": media_id,
+          "segment_index": segment_index
+        },
+        files={ "media": chunk }
+      )).status_code not in (200, 204):
+        raise Exception(f"APPEND of segment { segment_index } failed. { append_response.status_code } | { append_response.content }")
+
+    if (finalize_response := client.post(
+      url=UPLOAD_URL,
+      auth=auth,
+      idempotent=True,
+      data={
+        "command": "FINALIZE",
+        "media_id": media_id
+      }
+    )).status_code not in (200, 201):
+      raise Exception(f"FINALIZE failed. { finalize_response.status_code } | { finalize_response.content }")
+
+    result = finalize_response.json()
+
+    # larger media may need processing before it can be attached to a post
+    deadline = time.time() + PROCESSING_TIMEOUT
+    while (processing_info := result.get('processing_info', {})).get('state') in ('pending', 'in_progress'):
+      if time.time() + (delay := processing_info.get('check_after_secs', 1)) > deadline:
+        raise Exception(f"Processing didn't finish in { PROCESSING_TIMEOUT }s. { processing_info }")
+      time.sleep(delay)
+      result = client.get(
+        url=UPLOAD_URL,
+        auth=auth,
+        params={ "command": "STATUS", "media_id": media_id }
+      ).json()
+
+    if result.get('processing_info', {}).get('state') == 'failed':
+      raise Exception(f"Processing failed. { result['processing_info'] }")
+
+    return result
+
+  except Exception as e:
+    logging.warning(f"upload_media_chunked(): { repr(e) }")
+    return None
+
+#================================================================
+
+def submit_post(text="", media=None, auth=auth):
   logging.info(f"text: {text}")
   logging.info(f"media: {media}")
 
@@ -192,8 +377,9 @@ def submit_post(text="", media=None):
   if media:
     payload['media'] = media
 
-  if (response := oauth.post(
+  if (response := client.post(
     "https://api.twitter.com/2/tweets",
+    auth=auth,
     json=payload,
   )).status_code != 201:
     logging.warning(f"Request returned an error: { response.status_code } { response.text }")
@@ -204,6 +390,27 @@ def submit_post(text="", media=None):
   logging.info(f"result: { json.dumps(result, indent=4, sort_keys=True) }")
   return result
 
+#================================================================
+# RUN
+# A single posting job. Used by __main__ and by the scheduler in ../scheduler.py
+# Posts to the given AccountProfile, or to the account configured in .env
+
+def run(account=None, progress=None, job_key=None):
+  # job_key is accepted for the job queue (see utils/jobs.py), an X post has nothing to resume
+  account = account or defaultAccount(Platform.X)
+  # the cool downs for selecting and claiming, read once for the run
+  evaluator = loadEvaluator()
+
+  if not (mediaObject := pickMediaObject(mongo_db, Platform.X, account.lastPostField, evaluator, catalog)):
+    raise Exception('Failed to retrieve a mediaObject to post')
+
+  # reserve it so no other worker posts it at the same time, whatever isn't committed is released
+  with fieldClaims(mongo_db, account.lastPostField, evaluator) as claims:
+    if not claims.claim(mediaObject):
+      raise Exception('mediaObject was claimed by another worker')
+
+    return mediaPost(mediaObject, authFor(account.credentials), claims, progress, evaluator)
+
 #================================================================
 # MAIN
 
@@ -229,7 +436,9 @@ if __name__ == '__main__':
     # This will be used to interface with the collections within the database
     mongo_db = mongo_client[config('MONGO_DB')]
 
-    mediaPost(getRandomMediaObject())
+    run()
+
+    logging.debug(f'HTTP latency: { client.latencyStats() }')
 
   except Exception as e:
     logging.error(f"__main__(): {repr(e)}")
@@ -1,5 +1,5 @@
 from decouple import config
-from requests_oauthlib import OAuth1Session
+from requests_oauthlib import OAuth1, OAuth1Session
 
 # create the OAuth1Session using the access keys and tokens saved in .env
 oauth = OAuth1Session(
@@ -7,4 +7,21 @@ oauth = OAuth1Session(
     client_secret=config("API_SECRET", cast=str),
     resource_owner_key=config("OAUTH1_TOKEN", cast=str),
     resource_owner_secret=config("OAUTH1_TOKEN_SECRET", cast=str),
-)
\ No newline at end of file
+)
+
+# a requests auth object for an account's tokens, for use with any session
+# such as the shared client in utils/http_client.py
+# API_KEY and API_SECRET belong to the app and default to the values in .env
+def authFor(credentials):
+    return OAuth1(
+        client_key=credentials.get("API_KEY") or config("API_KEY", cast=str),
+        client_secret=credentials.get("API_SECRET") or config("API_SECRET", cast=str),
+        resource_owner_key=credentials["OAUTH1_TOKEN"],
+        resource_owner_secret=credentials["OAUTH1_TOKEN_SECRET"],
+    )
+
+# the same credentials as the OAuth1Session above
+auth = authFor({
+    "OAUTH1_TOKEN": config("OAUTH1_TOKEN", cast=str),
+    "OAUTH1_TOKEN_SECRET": config("OAUTH1_TOKEN_SECRET", cast=str),
+})